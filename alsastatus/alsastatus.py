@@ -21,7 +21,17 @@ along with this program.  If not, see [http://www.gnu.org/licenses/].
 
 """
 
+from ctypes import byref, CDLL, c_int, c_long, c_short, c_void_p, Structure
+from ctypes.util import find_library
+from collections import OrderedDict
+from os import close, environ, getuid, pipe, write
+from os.path import expanduser, join
+import re
+from select import poll, POLLERR, POLLHUP, POLLIN, POLLNVAL
+from socket import socket, AF_UNIX, SHUT_RDWR, SOCK_STREAM
+from struct import calcsize, pack, unpack, unpack_from
 from subprocess import check_output, CalledProcessError, STDOUT
+from threading import Lock, Thread
 from time import time
 # TODO
 # * Add workaround for cards which cannot mute/unmute mixers
@@ -39,77 +49,975 @@ class AlsastatusException(Exception):
         return "alsastatus: {exception}".format(exception=self.exception)
 
 
+AMIXER_CONTROL = re.compile(rb"^Simple mixer control '(.*)',\d+$")
+AMIXER_LIMITS = re.compile(rb"Limits: (?:Playback|Capture) (-?\d+) - (-?\d+)")
+AMIXER_VOLUME = re.compile(rb"(?:Playback|Capture) (-?\d+) \[(\d+%)\]")
+AMIXER_SWITCH = re.compile(rb"\[(on|off)\]")
+
+
+def parse_amixer(out):
+    """Parse controls printed by ``amixer get`` or ``amixer scontents``.
+
+    Return dict mapping control names to volume, mute state, raw volume and
+    limits. Values are taken from the last channel of each control.
+
+    """
+    controls = OrderedDict()
+    name = None
+    for line in out:
+        match = AMIXER_CONTROL.match(line)
+        if match:
+            name = match.group(1).decode('utf-8')
+            controls[name] = ["-", False, None, None]
+            continue
+        if name is None:
+            continue
+        control = controls[name]
+        match = AMIXER_LIMITS.search(line)
+        if match:
+            control[3] = int(match.group(1)), int(match.group(2))
+            continue
+        match = AMIXER_VOLUME.search(line)
+        if match:
+            control[2] = int(match.group(1))
+            control[0] = match.group(2).decode('utf-8')
+        match = AMIXER_SWITCH.search(line)
+        if match:
+            control[1] = match.group(1) == b"off"
+
+    return OrderedDict((name, tuple(control))
+                       for name, control in controls.items())
+
+
 class Data:
-    """Aquire data."""
+    """Aquire data.
 
-    def __init__(self, mixer='Master'):
+    Clicks only update the cached state and queue the change. A background
+    thread sums up queued changes and applies them with a single ``amixer``
+    call before reading back the actual mixer state.
+
+    """
+
+    def __init__(self, mixer='Master', card='default'):
         """Initialise ALSA stuff."""
         self.volume = "-"
         self.mute = False
         self.mixer = mixer
+        self.card = card
         self.error = (None, None)
+        # Raw volume and limits as of the last read, for optimistic updates
+        self.raw = None
+        self.limits = None
+        self.delta = 0
+        self.toggle = False
+        self.fresh = False
+        self.lock = Lock()
+        self.writer = None
 
-    def decrease_volume(self, step=3):
-        """Decrease volume."""
-        self.error = (None, None)
+    def _amixer(self, *args):
+        """Return amixer command line for the configured card."""
+        if self.card == 'default':
+            return ["amixer"] + list(args)
+        return ["amixer", "-D", self.card] + list(args)
 
+    def _get_mixer(self):
+        """Run ``amixer get`` and parse its output."""
         try:
-            check_output(
-                ["amixer", "-q", "sset", self.mixer, "{}-".format(step)])
+            out = check_output(
+                self._amixer("get", self.mixer), stderr=STDOUT).splitlines()
         except CalledProcessError as e:
-            msg = "failed to decrease volume"
+            msg = "failed to get mixer state"
             self.error = (msg, time())
             raise AlsastatusException(msg + ": {}".format(str(e.output)))
+        except OSError as e:
+            msg = "failed to execute amixer"
+            self.error = (msg, time())
+            raise AlsastatusException(msg + ": {}".format(str(e)))
 
-    def increase_volume(self, step=3):
-        """Increase volume."""
+        controls = parse_amixer(out)
+        if not controls:
+            msg = "failed to get mixer state"
+            self.error = (msg, time())
+            raise AlsastatusException(msg)
+
+        return next(iter(controls.values()))
+
+    def _queue(self, delta=0, toggle=False):
+        """Update cached state and queue the change."""
         self.error = (None, None)
 
+        with self.lock:
+            self.delta += delta
+            self.toggle ^= toggle
+            if toggle:
+                self.mute = not self.mute
+            if delta and self.raw is not None and self.limits:
+                vmin, vmax = self.limits
+                self.raw = max(vmin, min(vmax, self.raw + delta))
+                if vmax > vmin:
+                    self.volume = "{}%".format(int(round(
+                        (self.raw - vmin) * 100 / (vmax - vmin))))
+            if not self.writer:
+                self.writer = Thread(target=self._write, daemon=True)
+                self.writer.start()
+
+    def _write(self):
+        """Apply queued changes until there are none left."""
+        while True:
+            with self.lock:
+                delta, toggle = self.delta, self.toggle
+                self.delta, self.toggle = 0, False
+            if not delta and not toggle:
+                break
+
+            args = []
+            if delta:
+                sign = "+" if delta > 0 else "-"
+                args.append("{}{}".format(abs(delta), sign))
+            if toggle:
+                args.append("toggle")
+            try:
+                check_output(
+                    self._amixer("-q", "sset", self.mixer, *args),
+                    stderr=STDOUT)
+            except (CalledProcessError, OSError):
+                self.error = ("failed to set mixer state", time())
+
+        # Reconcile cached state with the mixer
         try:
-            check_output(
-                ["amixer", "-q", "sset", self.mixer, "{}+".format(step)],
-                stderr=STDOUT)
-        except CalledProcessError as e:
-            msg = "failed to increase volume"
+            state = self._get_mixer()
+        except AlsastatusException:
+            state = None
+        with self.lock:
+            if state and not self.delta and not self.toggle:
+                self.volume, self.mute, self.raw, self.limits = state
+                self.fresh = True
+            self.writer = None
+            if self.delta or self.toggle:
+                # Clicked again while reading back the state
+                self.writer = Thread(target=self._write, daemon=True)
+                self.writer.start()
+
+    def decrease_volume(self, step=3):
+        """Decrease volume."""
+        self._queue(delta=-step)
+
+    def increase_volume(self, step=3):
+        """Increase volume."""
+        self._queue(delta=step)
+
+    def toggle_mute(self):
+        """Toggle mute."""
+        self._queue(toggle=True)
+
+    def get_stats(self):
+        """Return volume and mute status."""
+        with self.lock:
+            # Pending changes or state which was just read back by the writer
+            if self.writer or self.fresh:
+                self.fresh = False
+                return self.volume, self.mute
+
+        volume, mute, raw, limits = self._get_mixer()
+        with self.lock:
+            if not self.writer:
+                self.volume, self.mute, self.raw, self.limits = (
+                    volume, mute, raw, limits)
+
+        return self.volume, self.mute
+
+
+BACKENDS = ('amixer', 'libasound', 'pulse')
+
+# SND_MIXER_SCHN_FRONT_LEFT, also used for mono controls
+CHANNEL = 0
+
+# How long to cache output in event mode if py3status can be told to refresh
+EVENT_CACHE_TIMEOUT = 3600
+
+
+class Pollfd(Structure):
+    """struct pollfd from <poll.h>."""
+
+    _fields_ = [('fd', c_int), ('events', c_short), ('revents', c_short)]
+
+
+def load_libasound():
+    """Return libasound with return types of pointer functions set."""
+    name = find_library('asound')
+    if not name:
+        raise AlsastatusException("libasound not found")
+    lib = CDLL(name)
+    lib.snd_mixer_find_selem.restype = c_void_p
+    return lib
+
+
+class LibasoundData(Data):
+    """Aquire data through libasound.
+
+    The mixer is opened once and read directly instead of running amixer on
+    every refresh. Volume steps are raw mixer units, just like with amixer.
+
+    """
+
+    def __init__(self, mixer='Master', card='default', lib=None, handle=None):
+        """Open mixer.
+
+        An already opened handle of the same card can be passed in to share
+        it between controls. It is not closed by this instance.
+
+        """
+        Data.__init__(self, mixer, card)
+        self.lib = lib or load_libasound()
+        self.handle = c_void_p()
+        self.owner = handle is None
+        self.elem = None
+        # Either 'playback' or 'capture'
+        self.direction = 'playback'
+        self.events = None
+        self.callback = None
+        # Set when the mixer failed, e.g. because the card was unplugged
+        self.lost = False
+        if self.owner:
+            self._open()
+        else:
+            self.handle = handle
+        self._find()
+
+    def _check(self, ret, msg):
+        """Raise exception if a libasound call failed."""
+        if ret < 0:
             self.error = (msg, time())
-            raise AlsastatusException(msg + ": {}".format(str(e.output)))
+            raise AlsastatusException(msg + ": error {}".format(ret))
+
+    def _call(self, name, *args):
+        """Call libasound function for the control's direction."""
+        return getattr(self.lib, name.format(self.direction))(*args)
+
+    def _open(self):
+        """Open mixer."""
+        lib = self.lib
+        self._check(lib.snd_mixer_open(byref(self.handle), 0),
+                    "failed to open mixer")
+        self._check(lib.snd_mixer_attach(self.handle, self.card.encode()),
+                    "failed to attach mixer")
+        self._check(lib.snd_mixer_selem_register(self.handle, None, None),
+                    "failed to register mixer")
+        self._check(lib.snd_mixer_load(self.handle), "failed to load mixer")
+
+    def _find(self):
+        """Look up the configured control."""
+        lib = self.lib
+        sid = c_void_p()
+        self._check(lib.snd_mixer_selem_id_malloc(byref(sid)),
+                    "failed to allocate mixer id")
+        try:
+            lib.snd_mixer_selem_id_set_index(sid, 0)
+            lib.snd_mixer_selem_id_set_name(sid, self.mixer.encode())
+            elem = lib.snd_mixer_find_selem(self.handle, sid)
+        finally:
+            lib.snd_mixer_selem_id_free(sid)
+        if not elem:
+            msg = "unknown mixer {}".format(self.mixer)
+            self.error = (msg, -1)
+            raise AlsastatusException(msg)
+        self.elem = c_void_p(elem)
+        if (not lib.snd_mixer_selem_has_playback_volume(self.elem) and
+                lib.snd_mixer_selem_has_capture_volume(self.elem)):
+            self.direction = 'capture'
+
+    def close(self):
+        """Close mixer."""
+        self.stop_events()
+        if self.handle and self.owner:
+            self.lib.snd_mixer_close(self.handle)
+            self.handle = c_void_p()
+
+    def _reopen(self):
+        """Reopen a failed mixer and poll it from now on."""
+        self.stop_events()
+        if self.owner:
+            if self.handle:
+                self.lib.snd_mixer_close(self.handle)
+                self.handle = c_void_p()
+            self._open()
+        self._find()
+        self.lost = False
+
+    def _handle_events(self):
+        """Process pending mixer events, marking the mixer lost on errors."""
+        ret = self.lib.snd_mixer_handle_events(self.handle)
+        if ret < 0:
+            self.lost = True
+        self._check(ret, "failed to get mixer state")
+
+    def start_events(self, callback=None):
+        """Update volume and mute state from mixer events.
+
+        A background thread waits on the mixer's poll descriptors and calls
+        callback whenever volume or mute state actually changed. get_stats
+        then only returns the cached state.
+
+        """
+        count = self.lib.snd_mixer_poll_descriptors_count(self.handle)
+        self._check(count, "failed to get poll descriptors")
+        pfds = (Pollfd * count)()
+        self._check(self.lib.snd_mixer_poll_descriptors(
+            self.handle, pfds, count), "failed to get poll descriptors")
+        poller = poll()
+        for pfd in pfds:
+            poller.register(pfd.fd, pfd.events)
+        # Writing to this pipe wakes up and stops the thread
+        self.wakeup = pipe()
+        poller.register(self.wakeup[0], POLLIN)
+
+        self.callback = callback
+        self._update()
+        self.events = Thread(target=self._watch, args=(poller,), daemon=True)
+        self.events.start()
+
+    def stop_events(self):
+        """Stop watching mixer events."""
+        if self.events:
+            write(self.wakeup[1], b'x')
+            self.events.join()
+            self.events = None
+            for fd in self.wakeup:
+                close(fd)
+
+    def _watch(self, poller):
+        """Wait for mixer events until woken up through the pipe.
+
+        Stops if a mixer descriptor fails, e.g. when the card is unplugged.
+        get_stats then reopens the mixer and polls it instead.
+
+        """
+        while True:
+            ready = poller.poll()
+            if any(fd == self.wakeup[0] for fd, _event in ready):
+                return
+            if any(event & (POLLERR | POLLHUP | POLLNVAL)
+                   for _fd, event in ready):
+                self.lost = True
+                self.error = ("mixer disconnected", time())
+                break
+            try:
+                changed = self._update()
+            except AlsastatusException:
+                break
+            if changed and self.callback:
+                self.callback()
+        if self.callback:
+            # Show the error and stop waiting for events that never come
+            self.callback()
+
+    def _update(self):
+        """Read mixer state into the cache.
+
+        Return True if volume or mute state changed.
+
+        """
+        with self.lock:
+            self._handle_events()
+            state = self._read_stats()
+        changed = state != (self.volume, self.mute)
+        self.volume, self.mute = state
+        return changed
+
+    def _get_range(self):
+        """Return minimum and maximum raw volume."""
+        vmin, vmax = c_long(), c_long()
+        self._call('snd_mixer_selem_get_{}_volume_range',
+                   self.elem, byref(vmin), byref(vmax))
+        return vmin.value, vmax.value
+
+    def _get_raw_volume(self):
+        """Return current raw volume."""
+        value = c_long()
+        self._check(self._call('snd_mixer_selem_get_{}_volume',
+                               self.elem, CHANNEL, byref(value)),
+                    "failed to get mixer state")
+        return value.value
+
+    def _get_switch(self):
+        """Return True if the mixer is unmuted."""
+        if not self._call('snd_mixer_selem_has_{}_switch', self.elem):
+            return True
+        switch = c_int()
+        self._check(self._call('snd_mixer_selem_get_{}_switch',
+                               self.elem, CHANNEL, byref(switch)),
+                    "failed to get mixer state")
+        return bool(switch.value)
+
+    def _set_raw_volume(self, value, msg):
+        """Set raw volume of all channels."""
+        vmin, vmax = self._get_range()
+        value = max(vmin, min(vmax, value))
+        self._check(self._call('snd_mixer_selem_set_{}_volume_all',
+                               self.elem, c_long(value)), msg)
+
+    def decrease_volume(self, step=3):
+        """Decrease volume."""
+        self.error = (None, None)
+        with self.lock:
+            self._handle_events()
+            self._set_raw_volume(self._get_raw_volume() - step,
+                                 "failed to decrease volume")
+
+    def increase_volume(self, step=3):
+        """Increase volume."""
+        self.error = (None, None)
+        with self.lock:
+            self._handle_events()
+            self._set_raw_volume(self._get_raw_volume() + step,
+                                 "failed to increase volume")
 
     def toggle_mute(self):
         """Toggle mute."""
         self.error = (None, None)
+        with self.lock:
+            self._handle_events()
+            switch = self._get_switch()
+            msg = ("failed to mute mixer" if switch
+                   else "failed to unmute mixer")
+            self._check(self._call('snd_mixer_selem_set_{}_switch_all',
+                                   self.elem, int(not switch)), msg)
+        self.mute = switch
+
+    def _read_stats(self):
+        """Return volume and mute status as read from the mixer."""
+        vmin, vmax = self._get_range()
+        value = self._get_raw_volume()
+        percent = 0
+        if vmax > vmin:
+            percent = int(round((value - vmin) * 100 / (vmax - vmin)))
+        return "{}%".format(percent), not self._get_switch()
+
+    def get_stats(self):
+        """Return volume and mute status."""
+        if self.lost:
+            self._reopen()
+        if self.events:
+            # Kept up to date by the event thread
+            return self.volume, self.mute
+
+        with self.lock:
+            # Pick up changes made by other programs
+            self._handle_events()
+            self.volume, self.mute = self._read_stats()
+
+        return self.volume, self.mute
+
+
+# PulseAudio native protocol
+PULSE_PROTOCOL_VERSION = 32
+PULSE_COMMAND_ERROR = 0
+PULSE_COMMAND_REPLY = 2
+PULSE_COMMAND_AUTH = 8
+PULSE_COMMAND_SET_CLIENT_NAME = 9
+PULSE_COMMAND_GET_SINK_INFO = 21
+PULSE_COMMAND_GET_SOURCE_INFO = 23
+PULSE_COMMAND_SUBSCRIBE = 35
+PULSE_COMMAND_SET_SINK_VOLUME = 36
+PULSE_COMMAND_SET_SOURCE_VOLUME = 38
+PULSE_COMMAND_SET_SINK_MUTE = 39
+PULSE_COMMAND_SET_SOURCE_MUTE = 40
+PULSE_COMMAND_SUBSCRIBE_EVENT = 66
+PULSE_CHANNEL_COMMAND = 0xffffffff
+PULSE_INVALID_INDEX = 0xffffffff
+PULSE_VOLUME_NORM = 0x10000
+PULSE_COOKIE_LENGTH = 256
+# Subscription masks and event facilities
+PULSE_SUBSCRIPTION_MASK_SINK = 0x01
+PULSE_SUBSCRIPTION_MASK_SOURCE = 0x02
+PULSE_SUBSCRIPTION_MASK_SERVER = 0x80
+PULSE_EVENT_FACILITY_MASK = 0x0f
+PULSE_EVENT_SINK = 0
+PULSE_EVENT_SOURCE = 1
+PULSE_EVENT_SERVER = 7
+PULSE_EVENT_TYPE_MASK = 0x30
+PULSE_EVENT_CHANGE = 0x10
+PULSE_TIMEOUT = 5
+
+# Tags with fixed size values
+PULSE_FIXED_TAGS = {
+    b'L': '>I', b'B': '>B', b'R': '>Q', b'r': '>q', b'U': '>Q', b'V': '>I',
+    b'T': '>II', b'a': '>BBI',
+}
 
-        out = check_output(
-            ["amixer", "get", self.mixer], stderr=STDOUT).splitlines()
-        mute = out[-1].split()[5].strip(b'[]').decode('utf-8')  # whut?
 
-        if mute == "on":
+def pack_tags(*tags):
+    """Pack (tag, value) pairs into a PulseAudio tagstruct.
+
+    Supported tags are 't' (string or None), 'L' (uint32), 'b' (boolean),
+    'x' (bytes), 'v' (channel volumes) and 'P' (dict of strings).
+
+    """
+    out = bytearray()
+    for tag, value in tags:
+        if tag == 't' and value is None:
+            out += b'N'
+        elif tag == 't':
+            out += b't' + value.encode('utf-8') + b'\0'
+        elif tag == 'L':
+            out += b'L' + pack('>I', value)
+        elif tag == 'b':
+            out += b'1' if value else b'0'
+        elif tag == 'x':
+            out += b'x' + pack('>I', len(value)) + value
+        elif tag == 'v':
+            out += b'v' + pack('>B{}I'.format(len(value)), len(value), *value)
+        elif tag == 'P':
+            out += b'P'
+            for key, data in value.items():
+                data = data.encode('utf-8') + b'\0'
+                out += pack_tags(('t', key), ('L', len(data)), ('x', data))
+            out += b'N'
+    return bytes(out)
+
+
+def unpack_tag(data, offset):
+    """Return value of the tag at offset and offset of the next tag."""
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag in PULSE_FIXED_TAGS:
+        fmt = PULSE_FIXED_TAGS[tag]
+        value = unpack_from(fmt, data, offset)
+        offset += calcsize(fmt)
+        if len(value) == 1:
+            value = value[0]
+    elif tag == b't':
+        end = data.index(b'\0', offset)
+        value = data[offset:end].decode('utf-8', 'replace')
+        offset = end + 1
+    elif tag in (b'N', b'1', b'0'):
+        value = {b'N': None, b'1': True, b'0': False}[tag]
+    elif tag == b'x':
+        length, = unpack_from('>I', data, offset)
+        value = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+    elif tag == b'm':
+        value = tuple(data[offset + 1:offset + 1 + data[offset]])
+        offset += 1 + data[offset]
+    elif tag == b'v':
+        value = list(unpack_from('>{}I'.format(data[offset]), data,
+                                 offset + 1))
+        offset += 1 + 4 * data[offset]
+    elif tag == b'P':
+        value = {}
+        while True:
+            key, offset = unpack_tag(data, offset)
+            if key is None:
+                break
+            _length, offset = unpack_tag(data, offset)
+            prop, offset = unpack_tag(data, offset)
+            value[key] = prop.rstrip(b'\0').decode('utf-8', 'replace')
+    elif tag == b'f':
+        encoding, offset = unpack_tag(data, offset)
+        props, offset = unpack_tag(data, offset)
+        value = (encoding, props)
+    else:
+        raise AlsastatusException("invalid PulseAudio tag {!r}".format(tag))
+    return value, offset
+
+
+def unpack_tags(data):
+    """Return list of all values in a PulseAudio tagstruct."""
+    values = []
+    offset = 0
+    while offset < len(data):
+        value, offset = unpack_tag(data, offset)
+        values.append(value)
+    return values
+
+
+def find_pulse_server():
+    """Return path of the PulseAudio socket."""
+    server = environ.get('PULSE_SERVER', '')
+    if server.startswith('unix:'):
+        return server[len('unix:'):]
+    if server.startswith('/'):
+        return server
+    runtime = environ.get('XDG_RUNTIME_DIR', '/run/user/{}'.format(getuid()))
+    return join(runtime, 'pulse', 'native')
+
+
+def read_pulse_cookie():
+    """Return PulseAudio authentication cookie.
+
+    pipewire-pulse doesn't check it, so an empty cookie is sent if none was
+    found.
+
+    """
+    paths = [environ.get('PULSE_COOKIE'),
+             join(environ.get('XDG_CONFIG_HOME', expanduser('~/.config')),
+                  'pulse', 'cookie'),
+             expanduser('~/.pulse-cookie')]
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                cookie = f.read(PULSE_COOKIE_LENGTH)
+        except (OSError, TypeError):
+            continue
+        if len(cookie) == PULSE_COOKIE_LENGTH:
+            return cookie
+    return bytes(PULSE_COOKIE_LENGTH)
+
+
+class PulseData(Data):
+    """Aquire data through the PulseAudio native protocol.
+
+    A single connection is kept open and subscribed to sink, source and
+    server events. Volume and mute state are only requested again when the
+    server reports a change, get_stats returns the cached state. Volume steps
+    are in percent.
+
+    """
+
+    def __init__(self, device='@DEFAULT_SINK@', server=None, callback=None):
+        """Connect to PulseAudio."""
+        self.source = (device == '@DEFAULT_SOURCE@' or
+                       device.startswith('source:'))
+        if device.startswith('source:'):
+            device = device[len('source:'):]
+        Data.__init__(self, device)
+        self.server = server or find_pulse_server()
+        self.callback = callback
+        self.sock = None
+        self.reader = None
+        self.closing = False
+        self.tag = 0
+        # Reply callbacks by tag
+        self.replies = {}
+        self.index = PULSE_INVALID_INDEX
+        self.channels = []
+        self.querying = False
+        self.dirty = False
+        # Whether a reply changed the state since the last callback
+        self.changed = False
+        self._connect()
+
+    def _send(self, command, *tags, callback=None):
+        """Send command and return its tag."""
+        with self.lock:
+            tag = self.tag
+            self.tag += 1
+            self.replies[tag] = callback
+            payload = pack_tags(('L', command), ('L', tag), *tags)
+            header = pack('>5I', len(payload), PULSE_CHANNEL_COMMAND, 0, 0, 0)
+            self.sock.sendall(header + payload)
+        return tag
+
+    def _recv(self, size):
+        """Read exactly size bytes."""
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise AlsastatusException("disconnected from PulseAudio")
+            data += chunk
+        return bytes(data)
+
+    def _receive(self):
+        """Return values of the next command packet."""
+        while True:
+            length, channel, _, _, _ = unpack('>5I', self._recv(20))
+            payload = self._recv(length)
+            # Skip memory blocks, we never create streams
+            if channel == PULSE_CHANNEL_COMMAND:
+                return unpack_tags(payload)
+
+    def _request(self, command, *tags):
+        """Send command and wait for its reply.
+
+        Only used while connecting, before the reader thread is started.
+
+        """
+        tag = self._send(command, *tags)
+        while True:
+            values = self._receive()
+            if values[1] != tag:
+                continue
+            del self.replies[tag]
+            if values[0] != PULSE_COMMAND_REPLY:
+                raise AlsastatusException("error {}".format(values[2]))
+            return values[2:]
+
+    def _get_info(self, callback=None):
+        """Request sink or source info."""
+        command = (PULSE_COMMAND_GET_SOURCE_INFO if self.source else
+                   PULSE_COMMAND_GET_SINK_INFO)
+        tags = (('L', PULSE_INVALID_INDEX), ('t', self.mixer))
+        if not callback:
+            return self._request(command, *tags)
+        self.querying = True
+        self._send(command, *tags, callback=callback)
+
+    def _connect(self):
+        """Connect, authenticate and subscribe to events."""
+        self.error = (None, None)
+        self.closing = False
+        self.replies = {}
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.settimeout(PULSE_TIMEOUT)
+        try:
+            self.sock.connect(self.server)
+            self._request(PULSE_COMMAND_AUTH, ('L', PULSE_PROTOCOL_VERSION),
+                          ('x', read_pulse_cookie()))
+            self._request(PULSE_COMMAND_SET_CLIENT_NAME,
+                          ('P', {'application.name': 'py3status'}))
+        except (OSError, AlsastatusException) as e:
+            self.sock.close()
+            msg = "failed to connect to PulseAudio"
+            self.error = (msg, time())
+            raise AlsastatusException(msg + ": {}".format(str(e)))
+        try:
+            self._set_info(self._get_info())
+        except (OSError, AlsastatusException) as e:
+            self.sock.close()
+            msg = "unknown device {}".format(self.mixer)
+            self.error = (msg, time())
+            raise AlsastatusException(msg + ": {}".format(str(e)))
+
+        self.sock.settimeout(None)
+        self._send(PULSE_COMMAND_SUBSCRIBE, ('L',
+                   PULSE_SUBSCRIPTION_MASK_SINK |
+                   PULSE_SUBSCRIPTION_MASK_SOURCE |
+                   PULSE_SUBSCRIPTION_MASK_SERVER))
+        self.reader = Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def close(self):
+        """Close connection."""
+        if self.reader:
+            self.closing = True
             try:
-                check_output(
-                    ["amixer", "-q", "sset", self.mixer, "mute"],
-                    stderr=STDOUT)
-            except CalledProcessError as e:
-                msg = "failed to mute mixer"
-                self.error = (msg, time())
-                raise AlsastatusException(msg + ": {}".format(str(e.output)))
-            else:
-                self.mute = True
-        else:
+                self.sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self.reader.join()
+            self.reader = None
+            self.sock.close()
+
+    def _read(self):
+        """Handle replies and events until the connection is closed."""
+        while True:
             try:
-                check_output(
-                    ["amixer", "-q", "sset", self.mixer, "unmute"],
-                    stderr=STDOUT)
-            except CalledProcessError:
-                msg = "failed to unmute mixer"
-                self.error = (msg, time())
-                raise AlsastatusException(msg + ": {}".format(str(e.output)))
+                self._dispatch(self._receive())
+            except (OSError, AlsastatusException):
+                break
+
+        if not self.closing:
+            self.error = ("disconnected from PulseAudio", time())
+            if self.callback:
+                self.callback()
+
+    def _dispatch(self, values):
+        """Handle a single reply or event."""
+        command, tag = values[:2]
+        if command == PULSE_COMMAND_SUBSCRIBE_EVENT:
+            self._event(*values[2:4])
+        elif command == PULSE_COMMAND_REPLY:
+            callback = self.replies.pop(tag, None)
+            if callback:
+                callback(values[2:])
+        elif command == PULSE_COMMAND_ERROR:
+            callback = self.replies.pop(tag, None)
+            self.error = ("PulseAudio error {}".format(values[2]), time())
+            if callback:
+                # Failed query, retry only if events arrived meanwhile
+                self.querying = False
+                if self.dirty:
+                    self.dirty = False
+                    self._update_info()
             else:
-                self.mute = False
+                # Failed write, undo the state shown in advance
+                self._update_info()
+
+    def _event(self, event, index):
+        """Request info again if the device might have changed."""
+        facility = event & PULSE_EVENT_FACILITY_MASK
+        own = PULSE_EVENT_SOURCE if self.source else PULSE_EVENT_SINK
+        if facility == own:
+            # New or removed devices might change what the name refers to
+            if (event & PULSE_EVENT_TYPE_MASK == PULSE_EVENT_CHANGE and
+                    index != self.index):
+                return
+        elif facility != PULSE_EVENT_SERVER:
+            return
+
+        self._update_info()
+
+    def _update_info(self):
+        """Request info, coalescing requests while one is in flight."""
+        if self.querying:
+            self.dirty = True
+        else:
+            self._get_info(self._set_info)
+
+    def _set_info(self, values):
+        """Update cached state from sink or source info."""
+        self.querying = False
+        index, channels, mute = values[0], values[6], values[7]
+        with self.lock:
+            volume = self._get_percent(channels)
+            if (volume, mute) != (self.volume, self.mute):
+                self.changed = True
+            self.index, self.channels = index, channels
+            self.volume, self.mute = volume, mute
+        if self.dirty:
+            self.dirty = False
+            self._get_info(self._set_info)
+        elif self.changed and self.callback and self.reader:
+            self.changed = False
+            self.callback()
+
+    def _get_percent(self, channels):
+        """Return loudest channel volume in percent."""
+        volume = max(channels) if channels else 0
+        return "{}%".format(int(round(volume * 100 / PULSE_VOLUME_NORM)))
+
+    def _set_volume(self, step):
+        """Change volume by step percent, keeping the balance.
+
+        Raising the volume stops at 100%, unless it was already above that.
+
+        """
+        self.error = (None, None)
+        channels = self.channels
+        if not channels:
+            return
+        current = max(channels)
+        target = current + step * PULSE_VOLUME_NORM // 100
+        target = max(0, min(max(current, PULSE_VOLUME_NORM), target))
+        if current:
+            channels = [int(channel * target / current)
+                        for channel in channels]
+        else:
+            channels = [target] * len(channels)
+
+        # Shown right away, before the reply can roll it back. The change
+        # event sent by the server confirms the new state.
+        with self.lock:
+            self.channels = channels
+            self.volume = self._get_percent(channels)
+        command = (PULSE_COMMAND_SET_SOURCE_VOLUME if self.source else
+                   PULSE_COMMAND_SET_SINK_VOLUME)
+        self._send(command, ('L', self.index), ('t', None), ('v', channels))
+
+    def decrease_volume(self, step=3):
+        """Decrease volume."""
+        self._set_volume(-step)
+
+    def increase_volume(self, step=3):
+        """Increase volume."""
+        self._set_volume(step)
+
+    def toggle_mute(self):
+        """Toggle mute."""
+        self.error = (None, None)
+        command = (PULSE_COMMAND_SET_SOURCE_MUTE if self.source else
+                   PULSE_COMMAND_SET_SINK_MUTE)
+        self.mute = not self.mute
+        self._send(command, ('L', self.index), ('t', None),
+                   ('b', self.mute))
 
     def get_stats(self):
         """Return volume and mute status."""
+        if not self.reader or not self.reader.is_alive():
+            self.close()
+            self._connect()
+
+        return self.volume, self.mute
+
+
+def parse_control(control):
+    """Split control of the form 'mixer' or 'mixer@card'."""
+    mixer, _, card = control.partition('@')
+    return mixer, card or 'default'
+
+
+class Controls:
+    """Aquire data for several controls at once.
+
+    Controls are read card by card. With libasound each card is opened only
+    once, with amixer all controls of a card are printed by a single call.
+    Volume and mute controls act on the first control.
+
+    """
+
+    def __init__(self, controls, backend='amixer', lib=None):
+        """Open controls."""
+        self.controls = list(controls)
+        self.backend = backend
+        self.error = (None, None)
+        self.data = []
+        # Indexes of controls by card
+        self.cards = OrderedDict()
+        handles = {}
+
+        for i, control in enumerate(self.controls):
+            mixer, card = parse_control(control)
+            self.cards.setdefault(card, []).append(i)
+            if backend == 'libasound':
+                data = LibasoundData(mixer, card, lib, handles.get(card))
+                handles.setdefault(card, data.handle)
+            else:
+                data = Data(mixer, card)
+            self.data.append(data)
+
+    def close(self):
+        """Close mixers."""
+        for data in self.data:
+            if isinstance(data, LibasoundData):
+                data.close()
+
+    def decrease_volume(self, step=3):
+        """Decrease volume of the first control."""
+        self.data[0].decrease_volume(step)
+
+    def increase_volume(self, step=3):
+        """Increase volume of the first control."""
+        self.data[0].increase_volume(step)
+
+    def toggle_mute(self):
+        """Toggle mute of the first control."""
+        self.data[0].toggle_mute()
+
+    def _reopen(self, indexes):
+        """Reopen the mixer of a card which went away.
+
+        The other controls of the card share the new handle.
+
+        """
+        owner = self.data[indexes[0]]
+        owner._reopen()
+        for i in indexes[1:]:
+            self.data[i].handle = owner.handle
+            self.data[i]._reopen()
+
+    def _read_libasound(self, indexes):
+        """Read controls of a single card through libasound."""
+        owner = self.data[indexes[0]]
+        with owner.lock:
+            if owner.lost:
+                self._reopen(indexes)
+            owner._handle_events()
+            for i in indexes:
+                data = self.data[i]
+                data.volume, data.mute = data._read_stats()
+
+    def _read_amixer(self, indexes):
+        """Read controls of a single card with one amixer call."""
+        # Skip controls with pending or just reconciled changes
+        indexes = [i for i in indexes
+                   if not (self.data[i].writer or self.data[i].fresh)]
+        if not indexes:
+            return
+
         try:
-            out = check_output(
-                ["amixer", "get", self.mixer], stderr=STDOUT).splitlines()
+            out = check_output(self.data[indexes[0]]._amixer("scontents"),
+                               stderr=STDOUT).splitlines()
         except CalledProcessError as e:
             msg = "failed to get mixer state"
             self.error = (msg, time())
@@ -119,12 +1027,36 @@ class Data:
             self.error = (msg, time())
             raise AlsastatusException(msg + ": {}".format(str(e)))
 
-        self.volume = out[-1].split()[3].strip(b'[]').decode('utf-8')  # whut?
+        controls = parse_amixer(out)
+        for i in indexes:
+            data = self.data[i]
+            if data.mixer not in controls:
+                msg = "unknown mixer {}".format(self.controls[i])
+                self.error = (msg, -1)
+                raise AlsastatusException(msg)
+            with data.lock:
+                if not data.writer:
+                    (data.volume, data.mute, data.raw,
+                     data.limits) = controls[data.mixer]
 
-        mute_str = out[-1].split()[5].strip(b'[]').decode('utf-8')  # whut?
-        self.mute = mute_str == "off"
+    def get_stats(self):
+        """Return list of volume and mute status of all controls."""
+        for indexes in self.cards.values():
+            if self.backend == 'libasound':
+                self._read_libasound(indexes)
+            else:
+                self._read_amixer(indexes)
 
-        return self.volume, self.mute
+        stats = []
+        for data in self.data:
+            with data.lock:
+                data.fresh = False
+                stats.append((data.volume, data.mute))
+            if data.error[0]:
+                self.error = data.error
+                data.error = (None, None)
+
+        return stats
 
 
 class Py3status:
@@ -134,6 +1066,13 @@ class Py3status:
     error_timeout = 10
     name = 'ALSA:'
     mixer = 'Master'
+    card = 'default'
+    backend = 'amixer'
+    device = '@DEFAULT_SINK@'
+    pulse_server = None
+    events = False
+    controls = []
+    format = None
     step = 3
     indicator = '[M]'
 
@@ -153,6 +1092,19 @@ class Py3status:
             msg.append("invalid name")
         if type(self.mixer) != str or len(self.mixer) < 1:
             msg.append("invalid mixer")
+        if self.backend not in BACKENDS:
+            msg.append("invalid backend")
+        if type(self.events) != bool or (
+                self.events and (self.backend != 'libasound' or
+                                 self.controls)):
+            msg.append("invalid events")
+        if type(self.controls) != list or (
+                self.controls and self.backend == 'pulse') or not all(
+                type(control) == str and parse_control(control)[0]
+                for control in self.controls):
+            msg.append("invalid controls")
+        if self.format is not None and type(self.format) != str:
+            msg.append("invalid format")
 
         if msg:
             self.data.error = ("configuration error: {}".format(
@@ -160,7 +1112,31 @@ class Py3status:
 
     def kill(self, json, i3status_config, event):
         """Handle termination."""
-        pass
+        if isinstance(self.data, (LibasoundData, PulseData, Controls)):
+            self.data.close()
+
+    def _get_update(self):
+        """Return function which makes py3status refresh the module.
+
+        Only available in py3status versions providing the py3 helper.
+
+        """
+        return getattr(getattr(self, 'py3', None), 'update', None)
+
+    def _get_volume(self, volume, mute):
+        """Return volume prefixed with the mute indicator if muted."""
+        if mute:
+            return "{mute} {volume}".format(mute=self.indicator, volume=volume)
+        return volume
+
+    def _format_controls(self, stats):
+        """Return output for all controls."""
+        volumes = [self._get_volume(volume, mute) for volume, mute in stats]
+        if self.format is None:
+            return " ".join(volumes)
+
+        return self.format.format(
+            *volumes, control=dict(zip(self.controls, volumes)))
 
     def on_click(self, json, i3status_config, event):
         """Handle mouse clicks."""
@@ -180,7 +1156,17 @@ class Py3status:
         """Return response for i3status bar."""
         # Initialise Data class only once
         if not self.data:
-            self.data = Data()
+            if self.controls:
+                self.data = Controls(self.controls, self.backend)
+            elif self.backend == 'pulse':
+                self.data = PulseData(self.device, self.pulse_server,
+                                      self._get_update())
+            elif self.backend == 'libasound':
+                self.data = LibasoundData(self.mixer, self.card)
+                if self.events:
+                    self.data.start_events(self._get_update())
+            else:
+                self.data = Data(self.mixer, self.card)
             self._validate_config()
 
         response = {'full_text': '', 'name': 'alsastatus'}
@@ -192,7 +1178,14 @@ class Py3status:
                     self.data.error[1] != -1)):
             self.data.error = (None, None)
 
-        if not self.data.error[0]:
+        if not self.data.error[0] and self.controls:
+            stats = self.data.get_stats()
+
+            response['full_text'] = "{title} {controls}".format(
+                title=self.name, controls=self._format_controls(stats))
+            if stats[0][1]:
+                response['color'] = i3status_config['color_degraded']
+        elif not self.data.error[0]:
             volume, mute = self.data.get_stats()
 
             response['full_text'] = "{title} {volume}".format(
@@ -208,5 +1201,9 @@ class Py3status:
             response['color'] = i3status_config['color_bad']
 
         response['cached_until'] = time() + self.cache_timeout
+        if ((self.backend == 'pulse' or
+                (self.events and self.data.events)) and self._get_update()):
+            # Mixer events trigger a refresh
+            response['cached_until'] = time() + EVENT_CACHE_TIMEOUT
 
         return response
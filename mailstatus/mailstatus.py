@@ -22,10 +22,56 @@ along with this program.  If not, see [http://www.gnu.org/licenses/].
 
 """
 
-from mailbox import Maildir, NoSuchMailboxError
-from os import listdir, path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from glob import glob, has_magic
+from hashlib import sha1
+from json import dump, load
+from mailbox import Babyl, MH, Maildir, NoSuchMailboxError, mbox as Mbox
+from mmap import mmap, ACCESS_READ
+from os import (close, environ, fsencode, makedirs, path, read, replace,
+                scandir, stat, strerror)
+import re
 from shlex import split
-from time import time
+from struct import calcsize, unpack_from
+from threading import Thread
+from time import monotonic, time
+
+try:
+    import notmuch2
+except ImportError:
+    notmuch2 = None
+
+# inotify constants from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = calcsize(EVENT_HEADER)
+
+# Directory mtimes are only trusted once they are older than this many
+# seconds, since several changes within the filesystem's timestamp
+# granularity would otherwise go unnoticed.
+MTIME_GRANULARITY = 2
+
+COUNT_MODES = ('new_only', 'flags')
+ENGINES = ('files', 'notmuch')
+
+BABYL_MAGIC = b'BABYL OPTIONS:'
+MBOX_STATUS = re.compile(rb'^(X-)?Status:[ \t]*([^\r\n]*)',
+                         re.IGNORECASE | re.MULTILINE)
 
 
 class MailstatusException(Exception):
@@ -40,82 +86,857 @@ class MailstatusException(Exception):
         return "mailstatus: {exception}".format(exception=self.exception)
 
 
+class Counts(dict):
+    """Unread mails per mailbox, unknown mailboxes count as 0."""
+
+    def __missing__(self, key):
+        """Return 0 for unknown mailboxes."""
+        return 0
+
+
+class Watcher:
+    """Minimal inotify wrapper.
+
+    Talks to the kernel through ctypes so no third party library is needed.
+
+    """
+
+    def __init__(self):
+        """Initialise inotify instance.
+
+        Raise OSError if inotify is not available.
+
+        """
+        libc_name = find_library('c') or 'libc.so.6'
+        self.libc = CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not supported on this system")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, directory, key):
+        """Watch directory and tag its events with key."""
+        wd = self.libc.inotify_add_watch(
+            self.fd, fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno), directory)
+        self.watches[wd] = key
+
+    def read_events(self):
+        """Return list of pending (key, mask, name) tuples.
+
+        An event with key None signals that the event queue overflowed or a
+        watch was removed, i.e. that the caller can no longer rely on the
+        events it has seen so far.
+
+        """
+        events = []
+        while True:
+            try:
+                buf = read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = unpack_from(
+                    EVENT_HEADER, buf, offset)
+                offset += EVENT_HEADER_SIZE
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF |
+                           IN_MOVE_SELF):
+                    events.append((None, mask, None))
+                elif wd in self.watches:
+                    events.append((self.watches[wd], mask,
+                                   name.decode('utf-8', 'surrogateescape')))
+        return events
+
+    def close(self):
+        """Release inotify file descriptor."""
+        if self.fd >= 0:
+            close(self.fd)
+            self.fd = -1
+
+
+class MboxScanner:
+    """Incremental unread counter for mbox files.
+
+    Remembers up to which offset the file has been parsed. As long as the
+    file only grows, only the appended part is parsed on the next call.
+
+    """
+
+    fingerprint_size = 64
+
+    def __init__(self, filename):
+        """Initialisation."""
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        """Forget everything and start over at the beginning of the file."""
+        self.inode = None
+        self.size = 0
+        self.offset = 0
+        self.unread = 0
+        self.fingerprint = b''
+
+    def _is_append(self, st, buf):
+        """Check whether the file was only appended to since the last call."""
+        if st.st_ino != self.inode or st.st_size <= self.size:
+            return False
+        start = self.offset - len(self.fingerprint)
+        return buf[start:self.offset] == self.fingerprint
+
+    def _is_unread(self, headers):
+        """Check message headers for the read and deleted flags."""
+        for x_status, flags in MBOX_STATUS.findall(headers):
+            if x_status and b'D' in flags:
+                return False
+            if not x_status and b'R' in flags:
+                return False
+        return True
+
+    def _parse(self, buf, offset):
+        """Count unread messages starting at offset.
+
+        Return the number of unread messages and the offset parsing stopped
+        at. Parsing stops in front of a message whose headers are not
+        completely written yet.
+
+        """
+        unread = 0
+        while True:
+            if offset == 0 and buf[:5] == b'From ':
+                start = 0
+            else:
+                start = buf.find(b'\nFrom ', max(offset - 1, 0))
+                if start < 0:
+                    return unread, len(buf)
+                start += 1
+            end = buf.find(b'\n\n', start)
+            if end < 0:
+                return unread, start
+            if self._is_unread(buf[start:end]):
+                unread += 1
+            offset = end + 1
+
+    def count(self):
+        """Return number of unread messages in the mbox file.
+
+        A full reparse only happens if the file shrank, was replaced or
+        rewritten in place.
+
+        """
+        st = stat(self.filename)
+        if st.st_size == 0:
+            self.reset()
+            self.inode = st.st_ino
+            return 0
+        with open(self.filename, 'rb') as f:
+            try:
+                buf = mmap(f.fileno(), st.st_size, access=ACCESS_READ)
+            except ValueError:
+                # File shrank in the meantime, keep the last count and
+                # reparse from the beginning next time
+                self.inode = None
+                return self.unread
+            with buf:
+                if not self._is_append(st, buf):
+                    self.reset()
+                unread, self.offset = self._parse(buf, self.offset)
+                self.unread += unread
+                self.fingerprint = buf[
+                    max(self.offset - self.fingerprint_size, 0):self.offset]
+        self.inode = st.st_ino
+        self.size = st.st_size
+        return self.unread
+
+
 class Data:
     """Aquire data."""
 
-    def __init__(self, mailboxes):
+    def __init__(self, mailboxes, watch=False, count_mode='new_only',
+                 workers=1, scan_timeout=5, cache_file=None):
         """Initialisation."""
+        self.count_mode = count_mode
+        self.workers = workers
+        self.scan_timeout = scan_timeout
+        self.cache_file = cache_file
+        self.cache = {}
+        self.dirty = False
+        self.validate = False
+        self.validator = None
+        self.watcher = None
+        self.executor = None
+        self.rescan = True
+        # Maildirs which changed while being counted
+        self.recount = set()
         self.read_mailboxes(mailboxes)
         self.error = (None, None)
+        if cache_file:
+            self.load_cache()
+        self.deadlines = {}
+        if watch:
+            self.start_watcher()
 
     def read_mailboxes(self, mailboxes):
         """Return list of mailboxes.
 
-        Raise exception on invalid mailbox.
+        Raise exception on invalid mailbox. Glob patterns are expanded and
+        silently skip matches which are not valid mailboxes.
+
+        """
+        self.paths = []
+        self.sources = []
+        for mdir in mailboxes:
+            mdir = path.expanduser(mdir)
+            if has_magic(mdir):
+                pattern = {'pattern': mdir, 'prefix': self._glob_prefix(mdir)}
+                self._expand(pattern)
+                self.sources.append(pattern)
+            else:
+                self.sources.append(
+                    (mdir, path.basename(path.normpath(mdir)), True))
+        self._set_mailboxes(self._get_entries())
+
+    def _get_entries(self):
+        """Return (path, name, strict) tuples for all configured mailboxes."""
+        entries = []
+        for source in self.sources:
+            if isinstance(source, dict):
+                entries.extend(source['matches'])
+            else:
+                entries.append(source)
+        return entries
+
+    def _set_mailboxes(self, entries):
+        """Set mailboxes from list of (path, name, strict) tuples.
+
+        State of mailboxes which were already known is kept, so only new
+        mailboxes have to be opened.
 
         """
+        known = dict((mdir, i) for i, mdir in enumerate(self.paths))
+        paths = []
+        names = []
         mboxes = []
         state = []
+        checked = []
         unread = []
-        if mailboxes:
-            for mdir in mailboxes:
+        scanners = []
+        stale = []
+        pending = []
+        for mdir, name, strict in entries:
+            if mdir in paths:
+                continue
+            if mdir in known:
+                i = known[mdir]
+                mbox = self.mboxes[i]
+                state.append(self.mbox_state[i])
+                checked.append(self.mbox_checked[i])
+                unread.append(self.unread[i])
+                scanners.append(self.scanners[i])
+                stale.append(self.stale[i])
+                pending.append(self.pending[i])
+            else:
                 try:
-                    mbox = Maildir(mdir, create=False)
-                    mbox.keys()
-                    mboxes.append(mbox)
-                    state.append('')
-                    unread.append(0)
+                    mbox = self._open_mailbox(mdir)
                 except NoSuchMailboxError:
+                    if not strict:
+                        continue
                     raise MailstatusException(
                         "invalid path: {path}".format(path=mdir))
                 except FileNotFoundError:
+                    if not strict:
+                        continue
                     raise MailstatusException(
                         "invalid maildir: {path}".format(path=mdir))
+                state.append('')
+                checked.append(0)
+                unread.append(0)
+                if isinstance(mbox, Mbox):
+                    scanners.append(MboxScanner(mdir))
+                else:
+                    scanners.append(None)
+                stale.append(False)
+                pending.append(None)
+            paths.append(mdir)
+            names.append(name)
+            mboxes.append(mbox)
+        self.paths = paths
+        self.names = names
         self.mboxes = mboxes
         self.mbox_state = state
+        self.mbox_checked = checked
         self.unread = unread
+        self.scanners = scanners
+        self.stale = stale
+        self.pending = pending
+
+    def _glob_prefix(self, pattern):
+        """Return leading part of pattern which contains no wildcards."""
+        parts = pattern.split(path.sep)
+        for n, part in enumerate(parts):
+            if has_magic(part):
+                break
+        return path.sep.join(parts[:n]) or path.curdir
+
+    def _expand(self, pattern):
+        """Expand glob pattern and remember the directories it depends on.
+
+        These are the pattern's non-wildcard prefix and the parents of all
+        matches. Mailboxes are named after their path below the prefix.
+
+        """
+        parent = path.dirname(pattern['pattern'])
+        dirs = [pattern['prefix']]
+        if has_magic(parent):
+            dirs.extend(sorted(glob(parent)))
+        pattern['dirs'] = dirs
+        pattern['checked'] = time()
+        pattern['state'] = self._stat(dirs)
+        pattern['matches'] = [
+            (mdir, path.relpath(mdir, pattern['prefix']), False)
+            for mdir in sorted(glob(pattern['pattern']))]
+
+    def _refresh_patterns(self):
+        """Re-expand glob patterns whose directories changed."""
+        changed = False
+        for pattern in self.sources:
+            if not isinstance(pattern, dict):
+                continue
+            state = self._stat(pattern['dirs'])
+            if self._is_unchanged(state, pattern['state'],
+                                  pattern['checked']):
+                continue
+            matches = pattern['matches']
+            self._expand(pattern)
+            changed = changed or matches != pattern['matches']
+        if not changed:
+            return
+        self._set_mailboxes(self._get_entries())
+        if self.watcher:
+            # Watches are keyed by index, which may have changed
+            self.stop_watcher()
+            self.start_watcher()
+
+    def _open_mailbox(self, mdir):
+        """Return mailbox object of the right format for mdir.
+
+        Files are treated as mbox or Babyl, directories containing a
+        '.mh_sequences' file as MH and any other directory as Maildir.
+
+        """
+        if path.isfile(mdir):
+            with open(mdir, 'rb') as f:
+                magic = f.read(len(BABYL_MAGIC))
+            if magic == BABYL_MAGIC:
+                return Babyl(mdir, create=False)
+            return Mbox(mdir, create=False)
+        if path.isfile(path.join(mdir, '.mh_sequences')):
+            return MH(mdir, create=False)
+        mbox = Maildir(mdir, create=False)
+        # Cheap sanity check instead of reading the whole maildir
+        for subdir in ('new', 'cur'):
+            stat(mbox._paths[subdir])
+        return mbox
+
+    def load_cache(self):
+        """Load unread counters of the last run from the cache file.
+
+        The cached counters are used until they have been validated.
+
+        """
+        try:
+            with open(self.cache_file) as f:
+                self.cache = load(f)
+        except (OSError, ValueError):
+            self.cache = {}
+            return
+        for i, mdir in enumerate(self.paths):
+            entry = self.cache.get(mdir)
+            if not entry or entry.get('count_mode') != self.count_mode:
+                continue
+            self.mbox_state[i] = tuple(
+                tuple(item) for item in entry['signature'])
+            self.mbox_checked[i] = entry['checked']
+            self.unread[i] = entry['unread']
+            self.validate = True
+
+    def save_cache(self):
+        """Write unread counters to the cache file.
+
+        Entries of mailboxes which are no longer configured are dropped.
+
+        """
+        cache = {}
+        for i, mdir in enumerate(self.paths):
+            if not self.mbox_state[i]:
+                if mdir in self.cache:
+                    cache[mdir] = self.cache[mdir]
+                continue
+            cache[mdir] = {
+                'count_mode': self.count_mode,
+                'signature': self.mbox_state[i],
+                'checked': self.mbox_checked[i],
+                'unread': self.unread[i],
+            }
+        self.cache = cache
+        tmp = self.cache_file + '.tmp'
+        try:
+            makedirs(path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp, 'w') as f:
+                dump(self.cache, f)
+            replace(tmp, self.cache_file)
+        except OSError:
+            # The cache is merely an optimisation
+            pass
+        self.dirty = False
+
+    def start_watcher(self):
+        """Set up inotify watches for all maildirs.
+
+        Fall back to polling if inotify is not available.
+
+        """
+        watcher = None
+        try:
+            watcher = Watcher()
+            for i, mbox in enumerate(self.mboxes):
+                if isinstance(mbox, Maildir):
+                    for subdir in ('new', 'cur'):
+                        watcher.add_watch(mbox._paths[subdir], (i, subdir))
+        except OSError:
+            if watcher:
+                watcher.close()
+            self.watcher = None
+            return
+        self.watcher = watcher
+        self.rescan = True
+        self.recount = set()
+
+    def stop_watcher(self):
+        """Remove inotify watches."""
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+    def close(self):
+        """Release inotify watches and worker threads."""
+        self.stop_watcher()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _is_unread(self, subdir, name):
+        """Check whether a message file in subdir counts as unread.
+
+        Messages in 'cur' are only counted with count_mode 'flags' and if the
+        info part of their file name lacks the 'S' (seen) flag.
+
+        """
+        if subdir == 'new':
+            return True
+        if self.count_mode != 'flags':
+            return False
+        _uniq, _colon, info = name.partition(Maildir.colon)
+        if not info.startswith('2,'):
+            return True
+        return 'S' not in info[2:]
+
+    def _apply_events(self, events, recount):
+        """Update unread counters from inotify events.
+
+        Events of mailboxes in recount are skipped, as those are counted from
+        scratch. Return the set of skipped mailboxes which had events, or None
+        if the events cannot be trusted and a rescan is needed.
+
+        """
+        touched = set()
+        for key, mask, name in events:
+            if key is None:
+                return None
+            if mask & IN_ISDIR:
+                continue
+            i, subdir = key
+            if i in recount:
+                touched.add(i)
+                continue
+            if not self._is_unread(subdir, name):
+                continue
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.unread[i] += 1
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unread[i] = max(self.unread[i] - 1, 0)
+            else:
+                continue
+            self.dirty = True
+        return touched
+
+    def _get_unread_watched(self):
+        """Update unread counters from inotify events.
+
+        Queued events are applied before recounting any maildir. A maildir
+        which changes while it is counted may or may not have the change in
+        its new count, so it is counted again on the next refresh instead of
+        applying its events.
+
+        """
+        maildirs = set(i for i, mbox in enumerate(self.mboxes)
+                       if isinstance(mbox, Maildir))
+        recount = self.recount
+        if self.rescan:
+            # Counts may be stale from before the watches were set up
+            self.rescan = False
+            recount = maildirs
+        if self._apply_events(self.watcher.read_events(), recount) is None:
+            recount = maildirs
+        for i in recount:
+            self.mbox_state[i] = ''
+        # Only maildirs are watched, everything else is still polled
+        self._scan([i for i in range(len(self.mboxes))
+                    if i in recount or i not in maildirs])
+        touched = self._apply_events(self.watcher.read_events(), recount)
+        self.recount = maildirs if touched is None else touched
 
     def _get_unread_maildir(self, mbox):
         """Shortcut for maildir format.
 
         Get number of unread mails by simply counting the number of files in
-        the 'new' folder.
+        the 'new' folder. With count_mode 'flags' unseen messages in the
+        'cur' folder are added based on their file names. No message is
+        opened either way.
 
         """
-        mdir = mbox._paths['new']
-        unread = len(
-            [item for item in listdir(mdir) if path.isfile(path.join(
-                mdir, item))])
+        unread = 0
+        subdirs = ('new', 'cur') if self.count_mode == 'flags' else ('new',)
+        for subdir in subdirs:
+            for entry in scandir(mbox._paths[subdir]):
+                if entry.is_file() and self._is_unread(subdir, entry.name):
+                    unread += 1
         return unread
 
+    def _get_unread_mh(self, mbox):
+        """Get number of unread mails from the 'unseen' sequence."""
+        return len(mbox.get_sequences().get('unseen', ()))
+
+    def _get_unread_babyl(self, mbox):
+        """Get number of unread mails from the Babyl labels.
+
+        The mailbox is re-opened since Babyl objects never refresh their
+        table of contents on their own.
+
+        """
+        babyl = Babyl(mbox._path, create=False)
+        try:
+            babyl.keys()
+            return sum(1 for labels in babyl._labels.values()
+                       if b'unseen' in labels)
+        finally:
+            babyl.close()
+
+    def _get_signature(self, mbox):
+        """Return inode, mtime and size of the files backing mbox.
+
+        For maildirs these are the 'new' and 'cur' folders, for MH the
+        folder itself and its sequences file.
+
+        """
+        if isinstance(mbox, Maildir):
+            paths = (mbox._paths['new'], mbox._paths['cur'])
+        elif isinstance(mbox, MH):
+            paths = (mbox._path, path.join(mbox._path, '.mh_sequences'))
+        else:
+            paths = (mbox._path,)
+        return self._stat(paths)
+
+    def _stat(self, paths):
+        """Return inode, mtime and size for each of paths.
+
+        Missing files are reported as (0, 0, 0).
+
+        """
+        signature = []
+        for filename in paths:
+            try:
+                st = stat(filename)
+            except FileNotFoundError:
+                signature.append((0, 0, 0))
+            else:
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def _is_unchanged(self, signature, last_signature, checked):
+        """Check whether signature still matches the last known one.
+
+        The signature is only trusted if it was taken well after the last
+        recorded modification.
+
+        """
+        if signature != last_signature:
+            return False
+        newest = max(mtime for _inode, mtime, _size in signature) / 1e9
+        return checked - newest > MTIME_GRANULARITY
+
     def get_unread(self):
         """Return number of unread emails."""
         unread_mails = 0
+        if self.validator:
+            if self.validator.is_alive():
+                # Serve cached counts until they have been validated
+                return sum(self.unread)
+            self.validator = None
+            if self.error[0]:
+                return self.error[0]
+        if self.sources:
+            self._refresh_patterns()
         if not self.mboxes:
             unread_mails = 'no mailbox configured'
             return unread_mails
 
-        last_state = self.mbox_state[:]
-        unread_per_box = self.unread[:]
-        for i, mbox in enumerate(self.mboxes):
-            mbox.keys()
-            self.mbox_state[i] = mbox._toc
-            if self.mbox_state[i] == last_state[i]:
-                pass
-            else:
-                unread_per_box[i] = 0
-                if isinstance(mbox, Maildir):
-                    unread_per_box[i] = self._get_unread_maildir(mbox)
-                else:
-                    for message in mbox:
-                        flags = message.get_flags()
-                        if 'S' not in flags:
-                            unread_per_box[i] += 1
-        self.unread = unread_per_box
-        unread_mails = sum(unread_per_box)
+        if self.validate:
+            self.validate = False
+            self.validator = Thread(target=self._validate, daemon=True)
+            self.validator.start()
+        else:
+            self._refresh()
+        unread_mails = sum(self.unread)
 
         return unread_mails
 
+    def _validate(self):
+        """Update cached unread counters, recording any error."""
+        try:
+            self._refresh()
+        except Exception as e:
+            self.error = ("failed to validate cache: {}".format(e), time())
+
+    def _refresh(self):
+        """Update unread counters and persist them if they changed."""
+        if self.watcher:
+            self._get_unread_watched()
+        else:
+            self._scan()
+        if self.dirty and self.cache_file:
+            self.save_cache()
+
+    def get_breakdown(self):
+        """Return number of unread emails per mailbox name."""
+        breakdown = Counts()
+        for name, unread in zip(self.names, self.unread):
+            breakdown[name] += unread
+        return breakdown
+
+    def _check_mailbox(self, mbox, scanner, last_signature, last_checked):
+        """Return (checked, signature, unread) for mbox.
+
+        Return None if the mailbox did not change since the last scan. This
+        runs in worker threads, so it must not modify any shared state apart
+        from the mailbox's own scanner.
+
+        """
+        # A few stat calls are a lot cheaper than walking the mailbox
+        signature = self._get_signature(mbox)
+        if self._is_unchanged(signature, last_signature, last_checked):
+            return None
+        checked = time()
+        return checked, signature, self._count_unread(mbox, scanner)
+
+    def _get_job(self, i):
+        """Return arguments of _check_mailbox for mailbox i."""
+        return (self.mboxes[i], self.scanners[i], self.mbox_state[i],
+                self.mbox_checked[i])
+
+    def _update_mailbox(self, i, result):
+        """Store result of _check_mailbox for mailbox i."""
+        self.stale[i] = False
+        if result is not None:
+            checked, signature, unread = result
+            # Rescans within the mtime granularity mostly find nothing new
+            if (signature, unread) != (self.mbox_state[i], self.unread[i]):
+                self.dirty = True
+            self.mbox_checked[i], self.mbox_state[i], self.unread[i] = result
+
+    def _scan(self, indices=None):
+        """Rescan changed mailboxes in indices and update unread counters.
+
+        All mailboxes are checked by default. Each scan is waited for until
+        scan_timeout seconds after it was submitted. Mailboxes whose scan
+        from an earlier refresh is still running keep their last known count
+        without being waited for.
+
+        """
+        if indices is None:
+            indices = range(len(self.mboxes))
+        if self.executor is None:
+            # Scans run in worker threads so a stalled mailbox can't block.
+            # Created on first use since NotmuchData never scans.
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        waiting = set()
+        for i in indices:
+            future = self.pending[i]
+            if future is None:
+                future = self.executor.submit(
+                    self._check_mailbox, *self._get_job(i))
+                self.pending[i] = future
+                self.deadlines[future] = monotonic() + self.scan_timeout
+                waiting.add(i)
+            elif future.done():
+                self._finish_scan(i)
+            else:
+                # Still stuck since an earlier refresh
+                self.stale[i] = True
+
+        while waiting:
+            now = monotonic()
+            for i in sorted(waiting):
+                future = self.pending[i]
+                if future.done():
+                    waiting.discard(i)
+                    self._finish_scan(i)
+                elif self.deadlines[future] <= now:
+                    waiting.discard(i)
+                    # Keep last known count until the scan finishes
+                    self.stale[i] = True
+                    if future.running():
+                        self._replace_executor()
+            if not waiting:
+                break
+            futures = [self.pending[i] for i in waiting]
+            timeout = min(self.deadlines[future] for future in futures)
+            wait(futures, timeout=max(timeout - monotonic(), 0),
+                 return_when=FIRST_COMPLETED)
+
+    def _replace_executor(self):
+        """Move queued scans away from the threads of a hung scan.
+
+        The hung scan keeps its thread, so later scans would queue up behind
+        it. They are resubmitted to a new executor with their old deadlines.
+
+        """
+        executor = self.executor
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        for i, future in enumerate(self.pending):
+            if future is not None and future.cancel():
+                self.pending[i] = self.executor.submit(
+                    self._check_mailbox, *self._get_job(i))
+                self.deadlines[self.pending[i]] = self.deadlines.pop(future)
+        executor.shutdown(wait=False)
+
+    def _finish_scan(self, i):
+        """Store result of the finished scan of mailbox i."""
+        future = self.pending[i]
+        self.pending[i] = None
+        self.deadlines.pop(future, None)
+        self._update_mailbox(i, future.result())
+
+    def _count_unread(self, mbox, scanner):
+        """Return number of unread mails in mbox."""
+        if isinstance(mbox, Maildir):
+            return self._get_unread_maildir(mbox)
+        if isinstance(mbox, Mbox):
+            return scanner.count()
+        if isinstance(mbox, MH):
+            return self._get_unread_mh(mbox)
+        if isinstance(mbox, Babyl):
+            return self._get_unread_babyl(mbox)
+        unread = 0
+        for message in mbox:
+            flags = message.get_flags()
+            if 'S' not in flags:
+                unread += 1
+        return unread
+
+
+class NotmuchData(Data):
+    """Aquire data from a notmuch database.
+
+    Counting is left to the Xapian index, so its cost does not grow with the
+    size of the mail store. The database is only queried again once the
+    index changed on disk.
+
+    """
+
+    def __init__(self, database=None, queries=None):
+        """Initialisation.
+
+        queries is a list of (name, query) tuples. Each query is restricted
+        to unread messages. Without any queries all unread messages are
+        counted.
+
+        """
+        if notmuch2 is None:
+            raise MailstatusException("notmuch engine requires notmuch2")
+        super().__init__([])
+        self.database = database
+        if queries:
+            self.names = [name for name, _query in queries]
+            self.queries = ["tag:unread and ({})".format(query)
+                            for _name, query in queries]
+            self.total_query = "tag:unread and ({})".format(
+                " or ".join("({})".format(query) for _name, query in queries))
+        else:
+            self.names = ['unread']
+            self.queries = ['tag:unread']
+            self.total_query = 'tag:unread'
+        self.unread = [0] * len(self.names)
+        self.total = 0
+        self.stale = [False] * len(self.names)
+        self.index = None
+        self.index_state = None
+        self.index_checked = 0
+
+    def _find_index(self, db):
+        """Return files which change whenever the Xapian index is updated.
+
+        Return None if the index can't be found, in which case the database
+        is queried on every refresh.
+
+        """
+        xapian = path.join(str(db.path), '.notmuch', 'xapian')
+        if not path.isdir(xapian):
+            return None
+        return (xapian, path.join(xapian, 'iamglass'))
+
+    def get_unread(self):
+        """Return number of unread emails."""
+        if self.index:
+            state = self._stat(self.index)
+            if self._is_unchanged(state, self.index_state,
+                                  self.index_checked):
+                return self.total
+            checked = time()
+
+        try:
+            db = notmuch2.Database(self.database)
+        except notmuch2.NotmuchError as e:
+            self.stale = [True] * len(self.stale)
+            self.error = ("failed to open database", time())
+            return "failed to open database: {}".format(e)
+        try:
+            if self.index is None:
+                self.index = self._find_index(db)
+                if self.index:
+                    checked = time()
+                    state = self._stat(self.index)
+            self.unread = [db.count_messages(query)
+                           for query in self.queries]
+            self.total = db.count_messages(self.total_query)
+        finally:
+            db.close()
+        # Only trust the index state once the counts match it
+        if self.index:
+            self.index_checked = checked
+            self.index_state = state
+        self.stale = [False] * len(self.stale)
+
+        return self.total
+
 
 class Py3status:
     """This is where all the py3status magic happens."""
@@ -124,6 +945,16 @@ class Py3status:
     error_timeout = 10
     name = 'MAIL:'
     mailboxes = ''
+    watch = False
+    count_mode = 'new_only'
+    workers = 1
+    scan_timeout = 5
+    stale_indicator = '?'
+    format = '{unread}'
+    cache = False
+    engine = 'files'
+    notmuch_database = ''
+    notmuch_queries = ''
 
     def __init__(self):
         """Initialisation."""
@@ -135,19 +966,62 @@ class Py3status:
 
         if type(self.name) != str:
             msg.append("invalid name")
+        if type(self.watch) != bool:
+            msg.append("invalid watch")
+        if self.count_mode not in COUNT_MODES:
+            msg.append("invalid count_mode")
+        if self.engine not in ENGINES:
+            msg.append("invalid engine")
+        if type(self.cache) != bool:
+            msg.append("invalid cache")
+        if type(self.format) != str:
+            msg.append("invalid format")
+        if type(self.workers) != int or self.workers < 1:
+            msg.append("invalid workers")
+        if (type(self.scan_timeout) not in (int, float) or
+                self.scan_timeout <= 0):
+            msg.append("invalid scan_timeout")
+        if (type(self.notmuch_queries) != str or
+                any('=' not in query
+                    for query in split(self.notmuch_queries))):
+            msg.append("invalid notmuch_queries")
 
         if msg:
             self.data.error = ("configuration error: {}".format(
                 ", ".join(msg)), -1)
 
+    def _get_cache_file(self):
+        """Return path of the cache file or None if caching is disabled.
+
+        The file is named after the mailboxes and count_mode, so instances
+        with different settings don't overwrite each other's counts.
+
+        """
+        if not self.cache:
+            return None
+        cache_home = (environ.get('XDG_CACHE_HOME') or
+                      path.expanduser(path.join('~', '.cache')))
+        key = sha1("\0".join([self.count_mode] + split(self.mailboxes))
+                   .encode('utf-8', 'surrogateescape')).hexdigest()
+        return path.join(cache_home, 'py3status-modules',
+                         'mailstatus-{}.json'.format(key[:16]))
+
     def mailstatus(self, json, i3status_config):
         """Return response for i3status bar."""
         response = {'full_text': ''}
 
         # use split from the shlex lib here because it allows you to escape
         # whitespaces
-        if not self.data:
-            self.data = Data(split(self.mailboxes))
+        if not self.data and self.engine == 'notmuch':
+            queries = [query.partition('=')[::2]
+                       for query in split(self.notmuch_queries)]
+            self.data = NotmuchData(self.notmuch_database or None, queries)
+        elif not self.data:
+            self.data = Data(split(self.mailboxes), watch=self.watch,
+                             count_mode=self.count_mode,
+                             workers=self.workers,
+                             scan_timeout=self.scan_timeout,
+                             cache_file=self._get_cache_file())
 
         # Reset error message
         # -1 means we can't recover from this error
@@ -165,9 +1039,24 @@ class Py3status:
         else:
             if unread > 0:
                 response['color'] = i3status_config['color_degraded']
-            response['full_text'] = "%s %d" % (
-                self.name, unread)
+            breakdown = self.data.get_breakdown()
+            response['full_text'] = "%s %s" % (
+                self.name, self.format.format(
+                    unread=unread, mailbox=breakdown,
+                    breakdown=" ".join(
+                        "{}:{}".format(name, count)
+                        for name, count in breakdown.items() if count)))
+            if any(self.data.stale):
+                response['full_text'] += self.stale_indicator
 
         response['cached_until'] = time() + self.cache_timeout
+        if self.data.validator:
+            # Show validated counts as soon as they are available
+            response['cached_until'] = time() + 1
 
         return response
+
+    def kill(self, json, i3status_config, event):
+        """Handle termination."""
+        if self.data:
+            self.data.close()
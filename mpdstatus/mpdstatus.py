@@ -23,10 +23,38 @@ along with this program.  If not, see [http://www.gnu.org/licenses/].
 
 """
 
-from os import path
-from time import time
-
-from mpd import MPDClient, CommandError
+from os import dup, path
+from random import uniform
+import re
+from socket import socket, SHUT_RDWR
+from threading import Event, Thread
+from time import monotonic, time
+from unicodedata import combining, east_asian_width
+
+from mpd import MPDClient, CommandError, MPDError
+from mpd import ConnectionError as MPDConnectionError
+
+
+# Subsystems which change what mpdstatus displays
+IDLE_SUBSYSTEMS = ('player', 'mixer', 'options')
+# Seconds to wait for MPD when connecting or sending commands
+TIMEOUT = 5
+# Delay of the first reconnection attempt, doubled after each failure
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+# Seconds a response is considered proof of a working connection
+HEALTH_INTERVAL = 1
+# How long to cache output in event mode if py3status can be told to refresh
+EVENT_CACHE_TIMEOUT = 3600
+# Seconds between marquee frames
+SCROLL_INTERVAL = 1
+# Tokens of format strings: escaped character, escaped brace, placeholder,
+# section bracket, text and anything else, which is an error
+FORMAT_TOKEN = re.compile(
+    r'\\(.)|(\{\{|\}\})|\{([^{}]*)\}|([\[\]])|([^\\{}\[\]]+)|(.)', re.S)
+FORMAT_PLACEHOLDER = re.compile(
+    r'\s*(?:"[^"]*"|[\w-]+)\s*(?:\|\s*(?:"[^"]*"|[\w-]+)\s*)*')
+FORMAT_ALTERNATIVE = re.compile(r'"([^"]*)"|([\w-]+)')
 
 
 class MPDstatusException(Exception):
@@ -41,18 +69,365 @@ class MPDstatusException(Exception):
         return "mpdstatus: {exception}".format(exception=self.exception)
 
 
+def get_clusters(text):
+    """Split text into characters with their combining marks.
+
+    Return list of (characters, display width) tuples. Wide and fullwidth
+    characters take up two columns, combining marks none.
+
+    """
+    clusters = []
+    for char in text:
+        if combining(char):
+            if clusters:
+                clusters[-1] = (clusters[-1][0] + char, clusters[-1][1])
+            else:
+                clusters.append((char, 0))
+        elif east_asian_width(char) in ('W', 'F'):
+            clusters.append((char, 2))
+        else:
+            clusters.append((char, 1))
+    return clusters
+
+
+class Marquee:
+    """Text scrolling through a fixed number of columns.
+
+    All frames are computed once when the text changes. Which one is shown
+    only depends on the time since then, so extra renders don't speed up
+    scrolling.
+
+    """
+
+    def __init__(self, width, separator=' | ', interval=SCROLL_INTERVAL):
+        """Initialisation."""
+        self.width = width
+        self.separator = separator
+        self.interval = interval
+        self.text = None
+        self.frames = []
+        # Monotonic time the text was set
+        self.started = 0
+
+    def _set_text(self, text, now):
+        """Compute frames of text."""
+        self.text = text
+        self.started = now
+        clusters = get_clusters(text)
+        if sum(width for _, width in clusters) <= self.width:
+            self.frames = [text]
+            return
+
+        clusters += get_clusters(self.separator)
+        self.frames = []
+        for start in range(len(clusters)):
+            frame = []
+            used = 0
+            i = start
+            while used + clusters[i % len(clusters)][1] <= self.width:
+                chars, width = clusters[i % len(clusters)]
+                frame.append(chars)
+                used += width
+                i += 1
+            # Fill the column left by a wide character which didn't fit
+            frame.append(" " * (self.width - used))
+            self.frames.append("".join(frame))
+
+    def is_scrolling(self):
+        """Return True if the text doesn't fit."""
+        return len(self.frames) > 1
+
+    def frame(self, text, now=None):
+        """Return frame of text at monotonic time now.
+
+        Frames advance every interval seconds after the text changed.
+
+        """
+        if now is None:
+            now = monotonic()
+        if text != self.text:
+            self._set_text(text, now)
+        steps = int((now - self.started) // self.interval)
+        return self.frames[steps % len(self.frames)]
+
+    def remaining(self, now=None):
+        """Return seconds until the next frame."""
+        if now is None:
+            now = monotonic()
+        return self.interval - (now - self.started) % self.interval
+
+
+def _render_text(text):
+    """Return render function of literal text."""
+    return lambda get: text
+
+
+def _render_placeholder(alternatives):
+    """Return render function of a placeholder.
+
+    alternatives are (name, literal) tuples, tried in order until one has a
+    value. Return None if none has.
+
+    """
+    def render(get):
+        for name, literal in alternatives:
+            value = literal if name is None else get(name)
+            if value:
+                return value
+        return None
+    return render
+
+
+def _render_section(children):
+    """Return render function of a section.
+
+    Empty if any placeholder of the section is missing.
+
+    """
+    def render(get):
+        values = [child(get) for child in children]
+        if None in values:
+            return ""
+        return "".join(values)
+    return render
+
+
+def compile_format(template):
+    """Compile format string into a render function.
+
+    {name} is replaced by the MPD tag or status value name and
+    {name|other|"text"} by the first one which is available. Sections in
+    square brackets are left out unless all their placeholders are
+    available. Backslashes escape the next character, {{ and }} braces.
+
+    The returned function takes a function returning the value of a name or
+    None and returns the rendered output. Its fields attribute is the set of
+    all names used. Raise MPDstatusException on syntax errors.
+
+    """
+    fields = set()
+    sections = [[]]
+    for match in FORMAT_TOKEN.finditer(template):
+        escaped, brace, placeholder, bracket, text, invalid = match.groups()
+        if invalid is not None:
+            raise MPDstatusException(
+                "invalid format: unexpected {!r}".format(invalid))
+        elif placeholder is not None:
+            if not FORMAT_PLACEHOLDER.fullmatch(placeholder):
+                raise MPDstatusException(
+                    "invalid format: {{{}}}".format(placeholder))
+            alternatives = tuple(
+                (name.lower() if name else None, literal)
+                for literal, name in FORMAT_ALTERNATIVE.findall(placeholder))
+            fields.update(name for name, _ in alternatives if name)
+            sections[-1].append(_render_placeholder(alternatives))
+        elif bracket == '[':
+            sections.append([])
+        elif bracket == ']':
+            if len(sections) == 1:
+                raise MPDstatusException("invalid format: unexpected ']'")
+            children = sections.pop()
+            sections[-1].append(_render_section(children))
+        else:
+            sections[-1].append(_render_text(escaped or text or brace[0]))
+    if len(sections) > 1:
+        raise MPDstatusException("invalid format: missing ']'")
+
+    children = sections[0]
+
+    def render(get):
+        return "".join(child(get) or "" for child in children)
+    render.fields = frozenset(fields)
+    return render
+
+
+def format_time(seconds):
+    """Return seconds as m:ss or h:mm:ss."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+    return "{}:{:02}".format(minutes, seconds)
+
+
+class Clock:
+    """Playback position extrapolated from the last MPD status.
+
+    Only synced when a new status arrives, i.e. on every refresh in polling
+    mode and on player events, which include seeks, in event mode.
+
+    """
+
+    def __init__(self):
+        """Initialisation."""
+        self.elapsed = 0.0
+        self.duration = 0.0
+        self.state = 'stop'
+        self.synced = monotonic()
+
+    def sync(self, status):
+        """Record position and state of a status response."""
+        elapsed = status.get('elapsed')
+        duration = status.get('duration')
+        if 'time' in status and (elapsed is None or duration is None):
+            # Older MPD versions only report whole seconds in time
+            time_elapsed, _, time_duration = status['time'].partition(':')
+            elapsed = elapsed or time_elapsed
+            duration = duration or time_duration
+        self.elapsed = float(elapsed or 0)
+        self.duration = float(duration or 0)
+        self.state = status.get('state', 'stop')
+        self.synced = monotonic()
+
+    def position(self):
+        """Return current playback position in seconds."""
+        if self.state != 'play':
+            return self.elapsed
+        position = self.elapsed + monotonic() - self.synced
+        if self.duration:
+            position = min(position, self.duration)
+        return position
+
+    def progress(self):
+        """Return fraction of the song which has been played."""
+        if not self.duration:
+            return 0.0
+        return self.position() / self.duration
+
+
+class Connection:
+    """Manage a connection to MPD.
+
+    Connection attempts are limited by a timeout. After a failure further
+    attempts are delayed with exponential backoff and jitter; reconnect makes
+    them in a background thread so callers never block on an unreachable
+    host. Hosts starting with '/' or '~' are UNIX sockets.
+
+    """
+
+    def __init__(self, client, host, port, password, timeout=TIMEOUT):
+        """Initialisation."""
+        self.client = client
+        self.host = path.expanduser(host)
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.connected = False
+        self.failures = 0
+        self.next_attempt = 0
+        # Monotonic time of the last response to a command
+        self.last_success = None
+        self.connector = None
+        # Error of the last attempt which needs the user's attention
+        self.error = None
+        # Name of a client method to call once connected
+        self.command = None
+
+    def connect(self):
+        """Try to connect once and return True on success."""
+        self.disconnect()
+        self.client.timeout = self.timeout
+        try:
+            self.client.connect(self.host, self.port)
+            if self.password:
+                self.client.password(self.password)
+            if self.command:
+                # Before connected is set, nothing else uses the client yet
+                command, self.command = self.command, None
+                getattr(self.client, command)()
+        except CommandError as e:
+            self.failed()
+            if "incorrect password" in str(e).lower():
+                raise MPDstatusException("incorrect password")
+            return False
+        except (MPDError, OSError):
+            self.failed()
+            return False
+
+        self.connected = True
+        self.failures = 0
+        self.error = None
+        return True
+
+    def disconnect(self):
+        """Close connection to MPD cleanly."""
+        self.connected = False
+        try:
+            self.client.close()
+            self.client.disconnect()
+        except:
+            # After long idle periods the client reaches a state where mpd2
+            # is neither able to disconnect nor to reconnect anymore. Calling
+            # `_reset` seems to remove the socket and make a new connection
+            # attempt possible.
+            self.client._reset()
+
+    def reconnect(self, command=None):
+        """Start connecting in the background unless backing off.
+
+        command is the name of a client method, which the connector calls
+        once connected. Attempts with a command don't wait for the backoff.
+
+        """
+        if command:
+            self.command = command
+        if (self.connected or (self.delay() and not command) or
+                (self.connector and self.connector.is_alive())):
+            return
+        self.connector = Thread(target=self._reconnect, daemon=True)
+        self.connector.start()
+
+    def _reconnect(self):
+        """Connect, recording a wrong password in error."""
+        try:
+            self.connect()
+        except MPDstatusException as e:
+            self.error = e.exception
+
+    def failed(self):
+        """Mark connection as lost and delay the next attempt."""
+        self.disconnect()
+        self.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (self.failures - 1))
+        # Jitter keeps several clients from reconnecting in lockstep
+        self.next_attempt = monotonic() + uniform(delay / 2, delay)
+
+    def succeeded(self):
+        """Record a response from MPD."""
+        self.last_success = monotonic()
+
+    def is_healthy(self):
+        """Return True if MPD responded recently."""
+        return (self.connected and self.last_success is not None and
+                monotonic() - self.last_success < HEALTH_INTERVAL)
+
+    def delay(self):
+        """Return seconds until the next connection attempt is allowed."""
+        return max(0, self.next_attempt - monotonic())
+
+
 class Data:
     """Aquire data."""
 
-    def __init__(self, host, port, password, max_length):
+    def __init__(self, host, port, password, max_length, timeout=TIMEOUT):
         """Initialise MPD client."""
         self.HOST = host
         self.PORT = port
         self.PW = password
         self.MAX_LENGTH = max_length
+        self.TIMEOUT = timeout
         self.error = (None, None)
         self.client = MPDClient()
-        self._connect()
+        self.connection = Connection(self.client, host, port, password,
+                                     timeout)
+        # Song and status as of the last idle event, None if disconnected
+        self.snapshot = None
+        self.clock = Clock()
+        self.idler = None
+        self.idle_connection = None
+        self.callback = None
+        # Don't block the first refresh on an unreachable host
+        self.reconnect()
 
     def _crop_text(self, text, length):
         """Crop string to specified length."""
@@ -63,72 +438,196 @@ class Data:
 
         return text
 
-    def _connect(self):
-        """Connect to MPD."""
-        try:
-            self.client.connect(self.HOST, self.PORT)
-            if self.PW:
-                self.client.password(self.PW)
-        except CommandError as e:
-            if "incorrect password" in str(e).lower():
-                raise MPDstatusException("incorrect password")
-        except ConnectionRefusedError:
-            # This is handled elsewhere by displaying the text `disconnected`
-            pass
-
     def disconnect(self):
         """Close connection to MPD cleanly."""
-        try:
-            self.client.close()
-            self.client.disconnect()
-        except:
-            # After long idle periods the client reaches a state where mpd2
-            # is neither able to disconnect nor to reconnect anymore. Calling
-            # `_reset` seems to remove the socket and make a new connection
-            # attempt possible.
-            self.client._reset()
+        self.connection.disconnect()
 
     def reconnect(self):
-        """Try to reaquire MPD connection."""
-        self.disconnect()
-        self._connect()
+        """Try to reaquire MPD connection in the background."""
+        self.connection.reconnect()
+
+    def start_idle(self, callback=None):
+        """Keep song and status up to date using MPD's idle command.
+
+        A background thread waits for player, mixer and options changes on a
+        separate connection and calls callback if the snapshot changed.
+        has_connection and get_stats then only look at the snapshot.
+
+        """
+        self.callback = callback
+        self.stopping = Event()
+        self.idle_connection = Connection(MPDClient(), self.HOST, self.PORT,
+                                          self.PW, self.TIMEOUT)
+        self.idler = Thread(target=self._idle, daemon=True)
+        self.idler.start()
+
+    def stop_idle(self):
+        """Stop waiting for MPD events."""
+        if self.idler:
+            self.stopping.set()
+            try:
+                # Interrupt the blocking idle command
+                sock = socket(fileno=dup(
+                    self.idle_connection.client.fileno()))
+            except (MPDError, OSError):
+                pass
+            else:
+                sock.shutdown(SHUT_RDWR)
+                sock.close()
+            self.idler.join()
+            self.idler = None
+
+    def _set_snapshot(self, snapshot):
+        """Update snapshot and call callback on changes."""
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        if snapshot and changed:
+            self.clock.sync(snapshot[1])
+        if changed and self.callback:
+            self.callback()
+
+    def _idle(self):
+        """Refresh snapshot whenever MPD reports a change."""
+        connection = self.idle_connection
+        client = connection.client
+        while not self.stopping.is_set():
+            try:
+                if connection.connected or connection.connect():
+                    snapshot = (client.currentsong(), client.status())
+                    connection.succeeded()
+                    self._set_snapshot(snapshot)
+                    client.idle(*IDLE_SUBSYSTEMS)
+                    continue
+            except MPDstatusException as e:
+                connection.error = e.exception
+            except (MPDError, OSError):
+                if self.stopping.is_set():
+                    break
+                connection.failed()
+            self._set_snapshot(None)
+            self.stopping.wait(connection.delay())
+
+        connection.disconnect()
+
+    def refresh(self):
+        """Fetch current song and status in a single round trip.
+
+        Return False if MPD couldn't be reached. In event mode only the
+        snapshot is checked. Errors of background connection attempts are
+        copied to error.
+
+        """
+        for connection in (self.connection, self.idle_connection):
+            if connection and connection.error:
+                self.error = (connection.error, time())
+        if self.idler:
+            return self.snapshot is not None
+        if not self.connection.connected:
+            self.snapshot = None
+            return False
+
+        try:
+            self.client.command_list_ok_begin()
+            self.client.currentsong()
+            self.client.status()
+            self.snapshot = tuple(self.client.command_list_end())
+            self.clock.sync(self.snapshot[1])
+        except (MPDError, OSError):
+            self.connection.failed()
+            self.snapshot = None
+            return False
+        self.connection.succeeded()
+        return True
 
     def has_connection(self):
         """Check if MPD is reachable."""
+        if self.idler:
+            return self.snapshot is not None
+        if self.connection.is_healthy():
+            return True
+
         try:
             self.client.status()
         except:
+            self.connection.failed()
             return False
         else:
+            self.connection.succeeded()
             return True
 
+    def _command(self, command):
+        """Run command, or leave it to the connector if disconnected.
+
+        Clicks never wait for a connection attempt.
+
+        """
+        if not self.connection.connected:
+            self.connection.reconnect(command)
+            return
+        try:
+            getattr(self.client, command)()
+        except MPDConnectionError:
+            self.connection.failed()
+            self.connection.reconnect(command)
+            return
+        self.connection.succeeded()
+
     def previous(self):
         """Jump to previous song."""
-        self.client.previous()
+        self._command('previous')
 
     def next(self):
         """Go to next song."""
-        self.client.next()
+        self._command('next')
 
     def pause(self):
         """Pause playback."""
-        self.client.pause()
+        self._command('pause')
+
+    def get_stats(self, defaults=True):
+        """Return artist, songtitle and playback state.
 
-    def get_stats(self):
-        """Return artist, songtitle and playback state."""
-        title = "Unknown Title"
-        song = self.client.currentsong()
-        status = self.client.status()
+        A missing artist or title is None unless defaults is true. Then the
+        title falls back to the file name and both to "Unknown ...".
+
+        """
+        artist = title = None
+        if self.idler or self.snapshot:
+            song, status = self.snapshot or ({}, {})
+        else:
+            song = self.client.currentsong()
+            status = self.client.status()
         length = self.MAX_LENGTH
-        artist = self._crop_text(
-            song['artist'], length) if 'artist' in song else "Unknown Artist"
+        if 'artist' in song:
+            artist = self._crop_text(song['artist'], length)
+        elif defaults:
+            artist = "Unknown Artist"
         if 'title' in song:
             title = self._crop_text(song['title'], length)
-        elif 'file' in song:
+        elif defaults and 'file' in song:
             title = self._crop_text(path.basename(song['file']), length)
+        elif defaults:
+            title = "Unknown Title"
 
         return artist, title, status.get('state', "unknown")
 
+    def get_tag(self, name):
+        """Return value of a tag of the current song or of the status.
+
+        Multiple values of a tag are joined. Return None if name is missing.
+
+        """
+        song, status = self.snapshot or ({}, {})
+        value = song.get(name, status.get(name))
+        if isinstance(value, list):
+            value = ", ".join(value)
+        return value
+
+    def get_times(self):
+        """Return elapsed time, duration and fraction played."""
+        return (format_time(self.clock.position()),
+                format_time(self.clock.duration), self.clock.progress())
+
 
 class Py3status:
     """This is where all the py3status magic happens."""
@@ -141,10 +640,20 @@ class Py3status:
     password = ''
     max_length = None
     hide_on_pause = False
+    events = False
+    timeout = TIMEOUT
+    format = '{artist} - {title}'
+    bar_width = 10
+    scroll = False
 
     def __init__(self):
         """Initialisation."""
         self.data = None
+        self.ticking = False
+        self.marquees = None
+        self.render = None
+        # Whether the default format is used
+        self.defaults = True
 
     def _validate_config(self):
         """Validate configuration."""
@@ -156,6 +665,21 @@ class Py3status:
             msg.append("invalid port")
         if type(self.max_length) != int or self.max_length < 1:
             msg.append("invalid max_length")
+        if type(self.events) != bool:
+            msg.append("invalid events")
+        if type(self.timeout) not in (int, float) or self.timeout <= 0:
+            msg.append("invalid timeout")
+        if type(self.format) != str:
+            msg.append("invalid format")
+        else:
+            try:
+                compile_format(self.format)
+            except MPDstatusException:
+                msg.append("invalid format")
+        if type(self.bar_width) != int or self.bar_width < 1:
+            msg.append("invalid bar_width")
+        if type(self.scroll) != bool or (self.scroll and not self.max_length):
+            msg.append("invalid scroll")
 
         if msg:
             self.data.error = ("configuration error: {}".format(
@@ -163,8 +687,22 @@ class Py3status:
 
     def kill(self, json, i3status_config, event):
         """Handle termination."""
+        self.data.stop_idle()
         self.data.disconnect()
 
+    def _get_update(self):
+        """Return function which makes py3status refresh the module.
+
+        Only available in py3status versions providing the py3 helper.
+
+        """
+        return getattr(getattr(self, 'py3', None), 'update', None)
+
+    def _get_bar(self, progress):
+        """Get playback progress representation in bar form."""
+        done = min(self.bar_width, int(progress * self.bar_width))
+        return "[{}{}]".format("#" * done, "_" * (self.bar_width - done))
+
     def on_click(self, json, i3status_config, event):
         """Handle mouse clicks."""
         # Left click: Go to previous song
@@ -183,8 +721,24 @@ class Py3status:
 
         # Initialise Data class only once
         if not self.data:
+            if self.scroll and self.max_length:
+                # Scroll artist and title instead of cropping them
+                self.marquees = (Marquee(self.max_length),
+                                 Marquee(self.max_length))
             self.data = Data(self.host, self.port, self.password,
-                             self.max_length)
+                             None if self.marquees else self.max_length,
+                             self.timeout)
+            if self.events:
+                self.data.start_idle(self._get_update())
+            try:
+                self.render = compile_format(self.format)
+                self.defaults = self.format == Py3status.format
+            except MPDstatusException as e:
+                self.data.error = (str(e), -1)
+                self.render = compile_format(Py3status.format)
+                self.defaults = True
+            # Output changes every second while playing
+            self.ticking = bool(self.render.fields & {'elapsed', 'bar'})
 
         # Reset error message
         # -1 means we can't recover from this error
@@ -193,13 +747,28 @@ class Py3status:
                     self.data.error[1] != -1)):
             self.data.error = (None, None)
 
-        connection = self.data.has_connection()
+        connection = self.data.refresh()
 
         if connection:
-            artist, songtitle, state = self.data.get_stats()
-
-            response['full_text'] = "%s %s - %s" % \
-                (self.name, artist, songtitle)
+            artist, songtitle, state = self.data.get_stats(self.defaults)
+            elapsed, duration, progress = self.data.get_times()
+            if self.marquees:
+                # Missing values stay None for fallbacks and sections
+                if artist is not None:
+                    artist = self.marquees[0].frame(artist)
+                if songtitle is not None:
+                    songtitle = self.marquees[1].frame(songtitle)
+
+            values = {'artist': artist, 'title': songtitle,
+                      'elapsed': elapsed, 'duration': duration,
+                      'bar': self._get_bar(progress)}
+
+            def get(name):
+                if name in values:
+                    return values[name]
+                return self.data.get_tag(name)
+
+            response['full_text'] = "%s %s" % (self.name, self.render(get))
 
             if state == 'play':
                 response['color'] = i3status_config['color_good']
@@ -209,11 +778,29 @@ class Py3status:
                     response['full_text'] = self.name
 
         else:
-            self.data.reconnect()
+            # Reconnects in the background, the idle thread on its own
+            if not self.events:
+                self.data.reconnect()
             response['color'] = i3status_config['color_bad']
-            response['full_text'] = "%s disconnected" % (self.name)
+            response['full_text'] = "%s %s" % (
+                self.name, self.data.error[0] or "disconnected")
 
         response['cached_until'] = time() + self.cache_timeout
+        if self.events and self._get_update():
+            # MPD events trigger a refresh
+            response['cached_until'] = time() + EVENT_CACHE_TIMEOUT
+        scrolling = [marquee for marquee in self.marquees or ()
+                     if marquee.is_scrolling()]
+        if connection and scrolling:
+            # Until the next frame of either marquee
+            response['cached_until'] = min(
+                response['cached_until'],
+                time() + min(marquee.remaining() for marquee in scrolling))
+        if connection and self.ticking and self.data.clock.state == 'play':
+            # Until the clock reaches the next full second
+            response['cached_until'] = min(
+                response['cached_until'],
+                time() + 1 - self.data.clock.position() % 1)
 
         return response
 
@@ -22,8 +22,47 @@ along with this program.  If not, see [http://www.gnu.org/licenses/].
 
 """
 
-from subprocess import check_output, CalledProcessError, STDOUT
-from time import time
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from json import dump, load, loads
+from os import environ, makedirs, path, replace, stat
+import re
+from shutil import which
+import sqlite3
+from subprocess import (check_output, CalledProcessError, DEVNULL, PIPE,
+                        Popen, STDOUT, TimeoutExpired)
+from threading import Event, Thread, Timer
+from shlex import split
+from time import localtime, mktime, strptime, time
+
+MODES = ('auto', 'stats', 'native', 'export')
+
+# Oldest Taskwarrior version with JSON export
+EXPORT_VERSION = (2, 0, 0)
+VERSION = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+# Garbage collection and hooks may modify the data files, which would
+# trigger another export.
+EXPORT_COMMAND = ["task", "rc.json.array=off", "rc.verbose=nothing",
+                  "rc.gc=off", "rc.hooks=off", "status:pending", "export"]
+
+# Attributes in Taskwarrior 2.x data files look like: due:"1500000000"
+FF4_ATTRIBUTE = re.compile(r'([^\s:\[]+):"((?:[^"\\]|\\.)*)"')
+FF4_ESCAPES = (('&open;', '['), ('&close;', ']'), ('&dquot;', '"'),
+               ('\\"', '"'), ('\\\\', '\\'))
+DATE_ATTRIBUTES = ('due', 'wait', 'scheduled', 'until', 'entry', 'end',
+                   'start')
+# Filter modifiers, Taskwarrior treats them all as plain comparisons
+COMPARISONS = ('before', 'after', 'below', 'above', 'over', 'under')
+
+# Taskwarrior's default urgency coefficients
+URGENCY_PRIORITY = {'H': 6.0, 'M': 3.9, 'L': 1.8}
+URGENCY_COEFFICIENTS = {
+    'next': 15.0, 'due': 12.0, 'blocking': 8.0, 'scheduled': 5.0,
+    'active': 4.0, 'age': 2.0, 'annotations': 1.0, 'tags': 1.0,
+    'project': 1.0, 'blocked': -5.0,
+}
+DAY = 86400
 
 
 class TaskstatusException(Exception):
@@ -38,33 +77,638 @@ class TaskstatusException(Exception):
         return "taskstatus: {exception}".format(exception=self.exception)
 
 
+def parse_date(value):
+    """Return Taskwarrior date as epoch.
+
+    Data files store epochs, exports use ISO 8601 in UTC.
+
+    """
+    if value.isdigit():
+        return int(value)
+    return timegm(strptime(value, '%Y%m%dT%H%M%SZ'))
+
+
+def normalise_task(task):
+    """Return task dict with parsed dates, tags and dependencies."""
+    task = dict(task)
+    for attribute in DATE_ATTRIBUTES:
+        if task.get(attribute):
+            task[attribute] = parse_date(task[attribute])
+        else:
+            task[attribute] = None
+    tags = task.get('tags') or []
+    depends = task.get('depends') or []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    if isinstance(depends, str):
+        depends = depends.split(',')
+    # Taskwarrior 3 stores tags and dependencies as separate keys
+    for key in list(task):
+        if key.startswith('tag_'):
+            tags.append(key[4:])
+        elif key.startswith('dep_'):
+            depends.append(key[4:])
+    task['tags'] = set(tag for tag in tags if tag)
+    task['depends'] = set(uuid for uuid in depends if uuid)
+    task['annotations'] = len(task.get('annotations') or []) + len(
+        [key for key in task if key.startswith('annotation_')])
+    return task
+
+
+def resolve_date(value, now):
+    """Return epoch for a date keyword, ISO date or epoch.
+
+    Supports now, today, sod, eod, yesterday, tomorrow, sow, eow, som, eom,
+    soy and eoy. Weeks start on Sunday like in Taskwarrior.
+
+    """
+    local = localtime(now)
+    sod = mktime(local[:3] + (0, 0, 0, 0, 0, -1))
+    sow = sod - ((local.tm_wday + 1) % 7) * DAY
+    som = mktime((local.tm_year, local.tm_mon, 1, 0, 0, 0, 0, 0, -1))
+    eom = mktime((local.tm_year, local.tm_mon + 1, 1, 0, 0, 0, 0, 0, -1))
+    soy = mktime((local.tm_year, 1, 1, 0, 0, 0, 0, 0, -1))
+    eoy = mktime((local.tm_year + 1, 1, 1, 0, 0, 0, 0, 0, -1))
+    keywords = {
+        'now': now, 'today': sod, 'sod': sod, 'eod': sod + DAY,
+        'yesterday': sod - DAY, 'tomorrow': sod + DAY,
+        'sow': sow, 'eow': sow + 7 * DAY, 'som': som, 'eom': eom,
+        'soy': soy, 'eoy': eoy,
+    }
+    if value in keywords:
+        return keywords[value]
+    if value.isdigit():
+        return int(value)
+    try:
+        return mktime(strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        raise TaskstatusException("invalid date: {}".format(value))
+
+
+def get_urgency(task, now, blocking, pending):
+    """Return urgency of task.
+
+    Uses the urgency reported by 'task export' if available and approximates
+    Taskwarrior's default urgency formula otherwise. blocking and pending
+    are sets of uuids; only pending dependencies block a task.
+
+    """
+    if 'urgency' in task:
+        return float(task['urgency'])
+    factors = {
+        'next': 'next' in task['tags'],
+        'blocking': task.get('uuid') in blocking,
+        'scheduled': bool(task['scheduled'] and task['scheduled'] <= now),
+        'active': bool(task['start']),
+        'project': bool(task.get('project')),
+        'blocked': bool(task['depends'] & pending),
+        'tags': min(0.7 + 0.1 * len(task['tags']), 1.0)
+        if task['tags'] else 0,
+        'annotations': min(0.7 + 0.1 * task['annotations'], 1.0)
+        if task['annotations'] else 0,
+        'age': min((now - task['entry']) / (365 * DAY), 1.0)
+        if task['entry'] else 0,
+        'due': 0,
+    }
+    if task['due']:
+        overdue = (now - task['due']) / DAY
+        if overdue >= 7:
+            factors['due'] = 1.0
+        elif overdue >= -14:
+            factors['due'] = (overdue + 14) * 0.8 / 21 + 0.2
+        else:
+            factors['due'] = 0.2
+    urgency = URGENCY_PRIORITY.get(task.get('priority'), 0)
+    for factor, coefficient in URGENCY_COEFFICIENTS.items():
+        urgency += float(factors[factor]) * coefficient
+    return urgency
+
+
+def has_tag(task, tag, context):
+    """Check for regular and virtual tags."""
+    now = context['now']
+    due = task['due']
+    virtual = {
+        'BLOCKED': lambda: bool(task['depends'] & context['pending']),
+        'BLOCKING': lambda: task.get('uuid') in context['blocking'],
+        'OVERDUE': lambda: bool(due and due < now),
+        'TODAY': lambda: bool(
+            due and context['sod'] <= due < context['eod']),
+        'WEEK': lambda: bool(
+            due and context['sow'] <= due < context['eow']),
+        'DUE': lambda: bool(due and due < now + 7 * DAY),
+        'ACTIVE': lambda: bool(task['start']),
+        'SCHEDULED': lambda: bool(task['scheduled']),
+        'TAGGED': lambda: bool(task['tags']),
+        'PROJECT': lambda: bool(task.get('project')),
+    }
+    if tag in virtual:
+        return virtual[tag]()
+    return tag in task['tags']
+
+
+def parse_filter(text):
+    """Compile filter expression into a list of predicates.
+
+    Supports a subset of Taskwarrior's filter syntax: +TAG, -TAG,
+    attribute:value (project:x also matches its subprojects) and the
+    before, after, below, above, over and under modifiers, which compare
+    dates or numbers depending on the attribute. All terms have to match.
+
+    """
+    predicates = []
+    for term in split(text):
+        if term[:1] in '+-' and len(term) > 1:
+            tag, wanted = term[1:], term[0] == '+'
+            predicates.append(
+                lambda task, context, tag=tag, wanted=wanted:
+                has_tag(task, tag, context) == wanted)
+            continue
+        attribute, colon, value = term.partition(':')
+        if not colon:
+            raise TaskstatusException("invalid filter: {}".format(term))
+        attribute, _dot, modifier = attribute.partition('.')
+        if modifier in COMPARISONS and attribute in DATE_ATTRIBUTES:
+            less = modifier in ('before', 'below', 'under')
+            predicates.append(
+                lambda task, context, attribute=attribute, value=value,
+                less=less: compare_date(task, attribute, value, less,
+                                        context))
+        elif modifier in COMPARISONS:
+            less = modifier in ('before', 'below', 'under')
+            try:
+                number = float(value)
+            except ValueError:
+                raise TaskstatusException("invalid filter: {}".format(term))
+            predicates.append(
+                lambda task, context, attribute=attribute, value=number,
+                less=less: compare_number(task, attribute, value, less,
+                                          context))
+        elif modifier:
+            raise TaskstatusException("invalid filter: {}".format(term))
+        elif attribute == 'project':
+            predicates.append(
+                lambda task, context, value=value:
+                (task.get('project') or '') == value or
+                (task.get('project') or '').startswith(value + '.'))
+        else:
+            predicates.append(
+                lambda task, context, attribute=attribute, value=value:
+                str(task.get(attribute) or '') == value)
+    return predicates
+
+
+def compare_date(task, attribute, value, less, context):
+    """Compare date attribute of task against date value."""
+    date = task.get(attribute)
+    if not date:
+        return False
+    date = float(date)
+    reference = context['dates'].get(value)
+    if reference is None:
+        reference = context['dates'][value] = resolve_date(
+            value, context['now'])
+    return date < reference if less else date > reference
+
+
+def compare_number(task, attribute, value, less, context):
+    """Compare numeric attribute of task against value."""
+    if attribute == 'urgency':
+        number = get_urgency(task, context['now'], context['blocking'],
+                             context['pending'])
+    else:
+        try:
+            number = float(task.get(attribute))
+        except (TypeError, ValueError):
+            return False
+    return number < value if less else number > value
+
+
+def read_ff4(filename):
+    """Return tasks from a Taskwarrior 2.x data file.
+
+    Lines in JSON format are accepted as well.
+
+    """
+    tasks = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                tasks.append(loads(line))
+            elif line.startswith('['):
+                task = {}
+                for key, value in FF4_ATTRIBUTE.findall(line):
+                    for escaped, char in FF4_ESCAPES:
+                        value = value.replace(escaped, char)
+                    task[key] = value
+                tasks.append(task)
+    return tasks
+
+
+def read_sqlite(filename):
+    """Return pending tasks from a Taskwarrior 3 database."""
+    db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+    try:
+        rows = db.execute("SELECT data FROM tasks").fetchall()
+    finally:
+        db.close()
+    tasks = [loads(data) for data, in rows]
+    return [task for task in tasks if task.get('status') == 'pending']
+
+
+def read_export(timeout=None):
+    """Return pending tasks from 'task export'.
+
+    Tasks are parsed one line at a time as they are read. 'task' is killed
+    if it takes longer than timeout seconds.
+
+    """
+    tasks = []
+    killed = Event()
+
+    def kill():
+        killed.set()
+        proc.kill()
+
+    try:
+        with Popen(EXPORT_COMMAND, stdout=PIPE, stderr=DEVNULL) as proc:
+            timer = Timer(timeout, kill) if timeout else None
+            if timer:
+                timer.start()
+            try:
+                for line in proc.stdout:
+                    line = line.strip().strip(b',[]')
+                    if line:
+                        tasks.append(loads(line.decode('utf-8')))
+            except (UnicodeDecodeError, ValueError):
+                if killed.is_set():
+                    # Killing 'task' may cut off the last line
+                    raise TaskstatusException("'task export' timed out")
+                raise TaskstatusException("invalid 'task export' output")
+            finally:
+                if timer:
+                    timer.cancel()
+    except OSError:
+        raise TaskstatusException("failed to execute 'task export'")
+    if killed.is_set():
+        raise TaskstatusException("'task export' timed out")
+    if proc.returncode:
+        raise TaskstatusException("failed to execute 'task export'")
+    return tasks
+
+
+def find_data_location():
+    """Return Taskwarrior's data directory.
+
+    Honours $TASKDATA and the data.location setting in $TASKRC or
+    ~/.taskrc.
+
+    """
+    if environ.get('TASKDATA'):
+        return path.expanduser(environ['TASKDATA'])
+    location = path.join('~', '.task')
+    taskrc = path.expanduser(
+        environ.get('TASKRC') or path.join('~', '.taskrc'))
+    try:
+        with open(taskrc, encoding='utf-8') as f:
+            for line in f:
+                key, _sep, value = line.partition('=')
+                if key.strip() == 'data.location':
+                    location = value.split('#')[0].strip()
+    except OSError:
+        pass
+    return path.expanduser(location)
+
+
 class Data:
     """Aquire data."""
 
-    def __init__(self):
-        """Initialise."""
+    def __init__(self, mode='stats', data_location=None, timeout=None,
+                 filters=None):
+        """Initialise.
+
+        filters is a list of (name, filter) tuples which are counted by
+        get_counters.
+
+        """
+        if filters and mode == 'stats':
+            raise TaskstatusException(
+                "filters need 'native' or 'export' mode")
+        self.mode = mode
+        self.data_location = data_location
+        self.timeout = timeout
+        self.filters = [(name, parse_filter(text))
+                        for name, text in filters or []]
+        self.counters = {}
+        self.counters_key = None
+        self.snapshot = None
+        self.state = None
+        self.tasks = []
+        self.due = []
+        self.wait = []
+        self.waiting_due = []
+        self.data_file = None
+        self.version = 0
         self.error = (None, None)
 
+    def _find_data_file(self):
+        """Return path of the task database and its reader.
+
+        Taskwarrior 3 databases take precedence over 2.x data files. The
+        location is only looked up again once reading the file failed.
+
+        """
+        if self.data_file is None:
+            location = self.data_location or find_data_location()
+            sqlite = path.join(location, 'taskchampion.sqlite3')
+            if path.isfile(sqlite):
+                self.data_file = (sqlite, read_sqlite)
+            else:
+                self.data_file = (path.join(location, 'pending.data'),
+                                  read_ff4)
+        return self.data_file
+
+    def _stat_data_file(self, filename):
+        """Return inode, mtime and size of filename and its write-ahead log.
+
+        SQLite databases in WAL mode only write to the -wal file until the
+        next checkpoint. A missing log is left out.
+
+        """
+        state = ()
+        for name in (filename, filename + '-wal'):
+            try:
+                st = stat(name)
+            except FileNotFoundError:
+                if name == filename:
+                    raise
+                continue
+            state += (st.st_ino, st.st_mtime_ns, st.st_size)
+        return state
+
+    def _load(self, tasks):
+        """Store pending tasks and index their due and wait dates.
+
+        Due dates of tasks with a wait date are kept apart, as those tasks
+        aren't overdue while they are waiting.
+
+        """
+        self.tasks = [task for task in map(normalise_task, tasks)
+                      if task.get('status') == 'pending']
+        self.due = sorted(task['due'] for task in self.tasks
+                          if task['due'] and not task['wait'])
+        self.wait = sorted(
+            task['wait'] for task in self.tasks if task['wait'])
+        self.waiting_due = [(task['wait'], task['due'])
+                            for task in self.tasks
+                            if task['due'] and task['wait']]
+        self.version += 1
+
+    def _count(self):
+        """Return number of pending and overdue tasks.
+
+        Waiting tasks are neither counted as pending nor as overdue until
+        their wait date has passed.
+
+        """
+        now = time()
+        waiting = len(self.wait) - bisect_right(self.wait, now)
+        overdue = bisect_left(self.due, now) + sum(
+            1 for wait, due in self.waiting_due if wait <= now and due < now)
+        return len(self.tasks) - waiting, overdue
+
+    def _get_tasks_native(self):
+        """Return number of open and overdue tasks from the data files.
+
+        The data file is only read again if its size or mtime, or those of
+        its SQLite write-ahead log, changed.
+
+        """
+        filename, reader = self._find_data_file()
+        try:
+            state = (filename,) + self._stat_data_file(filename)
+            if state != self.state:
+                self._load(reader(filename))
+                self.state = state
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.data_file = None
+            raise TaskstatusException(
+                "failed to read {}: {}".format(filename, e))
+        return self._count()
+
+    def _get_tasks_export(self):
+        """Return number of open and overdue tasks from 'task export'.
+
+        'task' is only executed again if the data directory changed. The
+        overdue count is recomputed from the due date index on every call.
+
+        """
+        filename, _reader = self._find_data_file()
+        try:
+            st = stat(path.dirname(filename))
+            state = ((st.st_ino, st.st_mtime_ns, st.st_size),
+                     self._stat_data_file(filename))
+        except OSError:
+            # Unknown data location, export on every refresh
+            self.data_file = None
+            state = None
+        if state is None or state != self.state:
+            self._load(read_export(self.timeout))
+            self.state = state
+        return self._count()
+
     def get_tasks(self):
         """Return number of open and overdue tasks as tuple."""
+        if self.mode == 'native':
+            return self._get_tasks_native()
+        if self.mode == 'export':
+            return self._get_tasks_export()
+
+        return self._get_tasks_stats()
+
+    def _get_tasks_stats(self):
+        """Query number of open and overdue tasks from 'task' commands."""
         tasks = 0
         overdue = 0
 
-        stats = check_output(["task", "stats"]).split()
+        try:
+            stats = check_output(
+                ["task", "stats"], timeout=self.timeout).split()
+        except TimeoutExpired:
+            raise TaskstatusException("'task stats' timed out")
         tasks = int(stats[5])
 
         try:
             overdueList = check_output(
-                ["task", "overdue"], stderr=STDOUT).split()
+                ["task", "overdue"], stderr=STDOUT,
+                timeout=self.timeout).split()
             overdue = int(overdueList[len(overdueList)-2])
         except CalledProcessError as e:
             if b"No matches" not in e.output:
                 raise TaskstatusException("failed to execute 'task overdue'")
+        except TimeoutExpired:
+            raise TaskstatusException("'task overdue' timed out")
         except OSError:
             raise TaskstatusException("failed to execute 'task overdue'")
 
         return tasks, overdue
 
+    def get_counters(self):
+        """Return dict of task counts for all filters.
+
+        All filters are evaluated in a single pass over the pending tasks.
+        Results are cached until the tasks change or the minute rolls over,
+        since date keywords like 'now' or 'eod' move along with time.
+
+        """
+        now = time()
+        key = (self.version, int(now // 60))
+        if key == self.counters_key:
+            return self.counters
+
+        pending = set(task.get('uuid') for task in self.tasks)
+        blocking = set()
+        for task in self.tasks:
+            blocking.update(task['depends'] & pending)
+        context = {
+            'now': now, 'pending': pending, 'blocking': blocking,
+            'dates': {},
+        }
+        for keyword in ('sod', 'eod', 'sow', 'eow'):
+            context[keyword] = resolve_date(keyword, now)
+
+        counters = dict((name, 0) for name, _predicates in self.filters)
+        for task in self.tasks:
+            if task['wait'] and task['wait'] > now:
+                continue
+            for name, predicates in self.filters:
+                if all(predicate(task, context) for predicate in predicates):
+                    counters[name] += 1
+        self.counters = counters
+        self.counters_key = key
+        return counters
+
+    def refresh(self):
+        """Store current task counts as snapshot.
+
+        The snapshot is a (tasks, overdue, taken, counters) tuple. Errors are
+        stored instead of raised, since this is called from a background
+        thread.
+
+        """
+        try:
+            tasks, overdue = self.get_tasks()
+        except Exception as e:
+            self.error = (str(e), time())
+        else:
+            self.snapshot = (tasks, overdue, time(), self.get_counters())
+
+
+class Capabilities:
+    """Detect what the installed Taskwarrior supports.
+
+    The binary is looked up in $PATH without running it. Its version is
+    probed in the background and cached on disk, keyed by the binary's path
+    and mtime, so later startups don't have to run 'task' at all.
+
+    """
+
+    def __init__(self, cache_file=None, timeout=None):
+        """Initialisation."""
+        self.binary = which('task')
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.version = None
+        self.prober = None
+        if not self.binary:
+            return
+        self.mtime = stat(self.binary).st_mtime_ns
+        self._load()
+        if self.version is None:
+            self.prober = Thread(target=self._probe, daemon=True)
+            self.prober.start()
+
+    def _load(self):
+        """Read version from the cache file."""
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                entry = load(f).get(self.binary)
+        except (OSError, ValueError, AttributeError):
+            return
+        if entry and entry.get('mtime') == self.mtime:
+            self.version = tuple(entry['version'])
+
+    def _save(self):
+        """Write version to the cache file."""
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                cache = load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self.binary] = {'mtime': self.mtime, 'version': self.version}
+        tmp = self.cache_file + '.tmp'
+        try:
+            makedirs(path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp, 'w') as f:
+                dump(cache, f)
+            replace(tmp, self.cache_file)
+        except OSError:
+            # The cache is merely an optimisation
+            pass
+
+    def _probe(self):
+        """Run 'task --version' and cache the result."""
+        try:
+            out = check_output([self.binary, "--version"], stderr=STDOUT,
+                               timeout=self.timeout)
+        except (OSError, CalledProcessError, TimeoutExpired):
+            return
+        match = VERSION.search(out.decode('utf-8', 'replace'))
+        if match:
+            self.version = tuple(int(part) for part in match.groups())
+            self._save()
+
+    def get_mode(self, filters=False):
+        """Return best query mode for the installed Taskwarrior.
+
+        Until the version is known 'stats' is used, unless filters need the
+        task list.
+
+        """
+        if self.version is None:
+            return 'export' if filters else 'stats'
+        return 'export' if self.version >= EXPORT_VERSION else 'stats'
+
+
+class Refresher(Thread):
+    """Refresh task counts in the background.
+
+    Keeps slow or hanging 'task' processes off the render path.
+
+    """
+
+    def __init__(self, data, interval):
+        """Initialisation."""
+        Thread.__init__(self, daemon=True)
+        self.data = data
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        """Refresh until stopped."""
+        while not self.stopped.is_set():
+            self.data.refresh()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop refreshing."""
+        self.stopped.set()
+
 
 class Py3status:
     """Called by py3status."""
@@ -72,16 +716,20 @@ class Py3status:
     cache_timeout = 0
     error_timeout = 10
     name = 'TASK:'
+    mode = 'stats'
+    data_location = ''
+    background = False
+    timeout = 10
+    stale_indicator = '?'
+    filters = ''
+    format = ''
     data = None
+    refresher = None
+    capabilities = None
 
     def __init__(self):
-        """Read config, initialise Data class."""
-        # See if we can find taskwarrior.
-        try:
-            check_output(["task", "--version"], stderr=STDOUT)
-        except OSError:
-            raise TaskstatusException("failed to execute 'task'")
-        self.data = Data()
+        """Initialisation."""
+        self.data = None
 
     def _validate_config(self):
         """Validate configuration."""
@@ -89,15 +737,76 @@ class Py3status:
 
         if type(self.name) != str:
             msg.append("invalid name")
+        if self.mode not in MODES:
+            msg.append("invalid mode")
+        if type(self.background) != bool:
+            msg.append("invalid background")
+        if type(self.timeout) not in (int, float) or self.timeout <= 0:
+            msg.append("invalid timeout")
+        if type(self.format) != str:
+            msg.append("invalid format")
 
         if msg:
             self.data.error = ("configuration error: {}".format(
                 ", ".join(msg)), -1)
 
+    def kill(self, json, i3status_config, event):
+        """Handle termination."""
+        if self.refresher:
+            self.refresher.stop()
+
+    def _get_interval(self):
+        """Return time between two refreshes in seconds."""
+        return max(self.cache_timeout, 1)
+
+    def _get_mode(self):
+        """Return configured query mode, resolving 'auto'."""
+        if self.mode != 'auto':
+            return self.mode
+        return self.capabilities.get_mode(bool(self.filters))
+
+    def _get_cache_file(self):
+        """Return path of the capability cache file."""
+        cache_home = (environ.get('XDG_CACHE_HOME') or
+                      path.expanduser(path.join('~', '.cache')))
+        return path.join(cache_home, 'py3status-modules', 'taskstatus.json')
+
+    def _get_filters(self):
+        """Return list of (name, filter) tuples from the filters setting."""
+        filters = []
+        for item in split(self.filters):
+            name, _sep, text = item.partition('=')
+            if not name.isidentifier() or name in ('tasks', 'overdue'):
+                raise TaskstatusException(
+                    "invalid filter name: {}".format(name))
+            filters.append((name, text))
+        return filters
+
     def taskstatus(self, json, i3status_config):
         """Return response for py3status."""
         response = {'full_text': '', 'name': 'taskstatus'}
 
+        # Initialise Data class only once
+        if not self.data:
+            if self.mode == 'auto':
+                # Only 'auto' picks a mode by the detected version
+                self.capabilities = Capabilities(
+                    self._get_cache_file(), self.timeout)
+            # See if we can find taskwarrior.
+            if self.mode != 'native' and not (
+                    self.capabilities.binary if self.capabilities
+                    else which('task')):
+                raise TaskstatusException("failed to execute 'task'")
+            self.data = Data(self._get_mode(), self.data_location or None,
+                             self.timeout, self._get_filters())
+            if self.background:
+                self.refresher = Refresher(self.data, self._get_interval())
+                self.refresher.start()
+
+        if self.mode == 'auto':
+            # Switch modes once the version probe finished
+            self.data.mode = self._get_mode()
+
         # Reset error message
         # -1 means we can't recover from this error
         if (self.data.error[0] and
@@ -105,7 +814,24 @@ class Py3status:
                     self.data.error[1] != -1)):
             self.data.error = (None, None)
 
-        tasks, overdue = self.data.get_tasks()
+        stale = False
+        if self.refresher and self.data.error[0]:
+            response['full_text'] = "%s %s" % (self.name, self.data.error[0])
+            response['color'] = i3status_config['color_bad']
+            response['cached_until'] = time() + 1
+            return response
+        if self.refresher:
+            # Only read the latest snapshot, never wait for 'task'
+            if not self.data.snapshot:
+                response['full_text'] = "%s -" % self.name
+                response['cached_until'] = time() + 1
+                return response
+            tasks, overdue, taken, counters = self.data.snapshot
+            age = time() - taken
+            stale = age > self._get_interval() + self.timeout
+        else:
+            tasks, overdue = self.data.get_tasks()
+            counters = self.data.get_counters()
 
         if overdue > 0:
             response['color'] = i3status_config['color_bad']
@@ -115,6 +841,17 @@ class Py3status:
             response['full_text'] = "%s %d" % \
                 (self.name, tasks)
 
+        if self.format:
+            response['full_text'] = "%s %s" % (self.name, self.format.format(
+                tasks=tasks, overdue=overdue, **counters))
+
+        if stale:
+            response['full_text'] += self.stale_indicator
+
         response['cached_until'] = time() + self.cache_timeout
+        if self.refresher:
+            # Render again once the next snapshot is due
+            response['cached_until'] = max(
+                taken + self._get_interval(), time() + 1)
 
         return response
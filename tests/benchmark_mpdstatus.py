@@ -0,0 +1,98 @@
+"""Benchmark mpdstatus refreshes against a fake MPD server.
+
+Measures MPD round trips and wall time per refresh of ``Py3status.mpdstatus``
+for each connection mode. Run from the repository root: ::
+
+   $ python -m tests.benchmark_mpdstatus --latency 0.005
+
+"""
+
+import argparse
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, time
+
+from mpdstatus.mpdstatus import Py3status
+from tests.fixtures.mpdstatus import FakeMPDServer
+
+
+MODES = ('polling', 'events')
+TRANSPORTS = ('tcp', 'unix')
+I3CONFIG = {
+    'color_bad': '#FF0000',
+    'color_degraded': '#FFFF00',
+    'color_good': '#00FF00',
+}
+
+
+class Py3:
+    """Stand-in for py3status' helper which counts requested refreshes."""
+
+    def __init__(self):
+        """Initialisation."""
+        self.updates = 0
+
+    def update(self):
+        """Record refresh request."""
+        self.updates += 1
+
+
+def measure(server, mode, refreshes=100):
+    """Return round trips and seconds per refresh of mode.
+
+    The first refresh, which starts connecting to MPD, and the wait for
+    the connection aren't measured.
+
+    """
+    module = Py3status()
+    module.host, module.port = server.host, server.port
+    module.events = mode == 'events'
+    module.py3 = Py3()
+    try:
+        module.mpdstatus([], I3CONFIG)
+        deadline = time() + 5
+        while ((module.data.snapshot is None if module.events
+                else not module.data.connection.connected) and
+               time() < deadline):
+            sleep(0.01)
+        round_trips = server.round_trips
+        start = perf_counter()
+        for _ in range(refreshes):
+            module.mpdstatus([], I3CONFIG)
+        seconds = perf_counter() - start
+        round_trips = server.round_trips - round_trips
+    finally:
+        module.kill([], I3CONFIG, None)
+    return round_trips / refreshes, seconds / refreshes
+
+
+def main():
+    """Print measurements of all connection modes."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--refreshes', type=int, default=100,
+                        help="refreshes per mode (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds before each response of the server "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    print("{:<10}{:<10}{:>12}{:>14}".format(
+        "transport", "mode", "round trips", "ms/refresh"))
+    with TemporaryDirectory() as tmpdir:
+        for transport in TRANSPORTS:
+            for mode in MODES:
+                socket = path.join(tmpdir, transport + mode)
+                server = FakeMPDServer(
+                    path=socket if transport == 'unix' else None,
+                    latency=args.latency)
+                try:
+                    round_trips, seconds = measure(server, mode,
+                                                   args.refreshes)
+                finally:
+                    server.close()
+                print("{:<10}{:<10}{:>12.2f}{:>14.3f}".format(
+                    transport, mode, round_trips, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
 from tests.fixtures.common import *
 from tests.fixtures.mailstatus import *
 from tests.fixtures.mpdstatus import *
+from tests.fixtures.taskstatus import *
+from tests.fixtures.alsastatus import *
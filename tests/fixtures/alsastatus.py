@@ -0,0 +1,390 @@
+"""Fixtures for the ``alsastatus`` module."""
+
+import os
+import socket
+import struct
+import threading
+
+import pytest
+
+
+class FakeControl:
+    """Simple mixer control of FakeLibasound."""
+
+    def __init__(self, value=40, vmax=87, switch=1, capture=False):
+        self.min = 0
+        self.max = vmax
+        self.value = value
+        self.switch = switch
+        self.capture = capture
+
+
+class FakeLibasound:
+    """Stand-in for libasound.
+
+    The default card has 'Master' and 'Capture' controls, card 'hw:1' has a
+    'PCM' control. Attributes like ``value`` refer to 'Master'. Arguments
+    passed by reference are written through their ``_obj``.
+    ``unplug`` and ``plug`` remove and add back the default card.
+
+    """
+
+    def __init__(self):
+        self.master = FakeControl()
+        self.cards = {
+            b'default': {
+                b'Master': self.master,
+                b'Capture': FakeControl(39, 63, capture=True),
+            },
+            b'hw:1': {b'PCM': FakeControl(255, 255)},
+        }
+        self.handles = {}
+        self.elems = []
+        self.name = None
+        self.calls = []
+        self.unplugged = False
+        self.events = None
+        self.plug()
+
+    def __getattr__(self, name):
+        # Capture functions behave just like their playback counterparts
+        if '_capture_' in name:
+            return getattr(self, name.replace('_capture_', '_playback_'))
+        raise AttributeError(name)
+
+    def _attr(name):
+        return property(lambda self: getattr(self.master, name),
+                        lambda self, value: setattr(self.master, name, value))
+
+    min = _attr('min')
+    max = _attr('max')
+    value = _attr('value')
+    switch = _attr('switch')
+    del _attr
+
+    def signal(self):
+        """Signal a mixer event."""
+        os.write(self.events[1], b'x')
+
+    def plug(self):
+        """Make the default card available."""
+        self.unplugged = False
+        if self.events:
+            os.close(self.events[0])
+        # Mixer events are signalled by writing to this pipe
+        self.events = os.pipe()
+        os.set_blocking(self.events[0], False)
+
+    def unplug(self):
+        """Remove the default card, hanging up its poll descriptor."""
+        self.unplugged = True
+        os.close(self.events[1])
+        self.events = (self.events[0], None)
+
+    def snd_mixer_open(self, handle, mode):
+        self.calls.append('open')
+        handle._obj.value = len(self.handles) + 1
+        self.handles[handle._obj.value] = None
+        return 0
+
+    def snd_mixer_attach(self, handle, card):
+        if card not in self.cards:
+            return -2
+        if self.unplugged and card == b'default':
+            return -19
+        self.handles[handle.value] = card
+        return 0
+
+    def snd_mixer_selem_register(self, handle, options, classp):
+        return 0
+
+    def snd_mixer_load(self, handle):
+        return 0
+
+    def snd_mixer_close(self, handle):
+        self.calls.append('close')
+        return 0
+
+    def snd_mixer_handle_events(self, handle):
+        self.calls.append('handle_events')
+        if self.unplugged and self.handles[handle.value] == b'default':
+            return -19
+        try:
+            os.read(self.events[0], 64)
+        except BlockingIOError:
+            pass
+        return 0
+
+    def snd_mixer_poll_descriptors_count(self, handle):
+        return 1
+
+    def snd_mixer_poll_descriptors(self, handle, pfds, space):
+        pfds[0].fd = self.events[0]
+        pfds[0].events = 1  # POLLIN
+        return 1
+
+    def snd_mixer_selem_id_malloc(self, sid):
+        sid._obj.value = 1
+        return 0
+
+    def snd_mixer_selem_id_free(self, sid):
+        pass
+
+    def snd_mixer_selem_id_set_index(self, sid, index):
+        pass
+
+    def snd_mixer_selem_id_set_name(self, sid, name):
+        self.name = name
+
+    def snd_mixer_find_selem(self, handle, sid):
+        control = self.cards[self.handles[handle.value]].get(self.name)
+        if not control:
+            return None
+        self.elems.append(control)
+        return len(self.elems)
+
+    def _control(self, elem):
+        return self.elems[elem.value - 1]
+
+    def snd_mixer_selem_has_playback_volume(self, elem):
+        return int(not self._control(elem).capture)
+
+    def snd_mixer_selem_has_capture_volume(self, elem):
+        return int(self._control(elem).capture)
+
+    def snd_mixer_selem_get_playback_volume_range(self, elem, vmin, vmax):
+        vmin._obj.value = self._control(elem).min
+        vmax._obj.value = self._control(elem).max
+        return 0
+
+    def snd_mixer_selem_get_playback_volume(self, elem, channel, value):
+        value._obj.value = self._control(elem).value
+        return 0
+
+    def snd_mixer_selem_set_playback_volume_all(self, elem, value):
+        self.calls.append('set_volume')
+        self._control(elem).value = value.value
+        return 0
+
+    def snd_mixer_selem_has_playback_switch(self, elem):
+        return 1
+
+    def snd_mixer_selem_get_playback_switch(self, elem, channel, value):
+        value._obj.value = self._control(elem).switch
+        return 0
+
+    def snd_mixer_selem_set_playback_switch_all(self, elem, value):
+        self.calls.append('set_switch')
+        self._control(elem).switch = value
+        return 0
+
+
+AMIXER = """#!/bin/sh
+cd "$(dirname "$0")"
+echo "$@" >> log
+state=state
+if [ "$1" = -D ]; then
+    state="state-$2"
+    shift 2
+fi
+if [ "$1" = get ] || [ "$1" = scontents ]; then
+    cat "$state"
+fi
+"""
+
+AMIXER_STATE = """Simple mixer control 'Master',0
+  Capabilities: pvolume pvolume-joined pswitch pswitch-joined
+  Playback channels: Mono
+  Limits: Playback 0 - 87
+  Mono: Playback 40 [46%] [-35.25dB] [on]
+"""
+
+
+def _string(value):
+    return b't' + value + b'\0'
+
+
+def _u32(value):
+    return b'L' + struct.pack('>I', value)
+
+
+def _u64(value):
+    return b'U' + struct.pack('>Q', value)
+
+
+def _proplist(props):
+    out = b'P'
+    for key, value in props:
+        out += _string(key) + _u32(len(value) + 1)
+        out += b'x' + struct.pack('>I', len(value) + 1) + value + b'\0'
+    return out + b'N'
+
+
+# Sink info as sent by pipewire-pulse for protocol version 32, with the
+# volume and mute fields left out
+SINK_NAME = b'alsa_output.pci-0000_00_1f.3.analog-stereo'
+SINK_INFO_HEAD = (
+    _u32(0) + _string(SINK_NAME) + _string(b'Built-in Audio Analog Stereo') +
+    b'a' + struct.pack('>BBI', 3, 2, 48000) + b'm\x02\x01\x02' + _u32(6))
+SINK_INFO_TAIL = (
+    _u32(1) + _string(SINK_NAME + b'.monitor') + _u64(0) +
+    _string(b'PipeWire') + _u32(0x3d7) +
+    _proplist([(b'device.description', b'Built-in Audio Analog Stereo'),
+               (b'device.class', b'sound')]) +
+    _u64(0) + b'V' + struct.pack('>I', 0x10000) + _u32(0) + _u32(65537) +
+    _u32(0) + _u32(1) + _string(b'analog-output-speaker') +
+    _string(b'Speakers') + _u32(10000) + _u32(0) +
+    _string(b'analog-output-speaker') + b'B\x01' + b'fB\x01' +
+    _proplist([]))
+
+
+class FakePulseServer:
+    """PulseAudio server replaying recorded replies for a single sink.
+
+    Volume and mute commands update the sink and are confirmed by a change
+    event, just like with a real server. While readonly is set they fail.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.volume = [0x8000, 0x8000]
+        self.mute = False
+        self.readonly = False
+        self.commands = []
+        self.conn = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                self.conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.conn:
+                self._handle()
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _send(self, payload):
+        header = struct.pack('>5I', len(payload), 0xffffffff, 0, 0, 0)
+        self.conn.sendall(header + payload)
+
+    def _reply(self, tag, payload=b''):
+        self._send(_u32(2) + _u32(tag) + payload)
+
+    def event(self, event=0x10, index=0):
+        """Send subscription event, a sink change by default."""
+        self._send(_u32(66) + _u32(0xffffffff) + _u32(event) + _u32(index))
+
+    def disconnect(self):
+        """Drop the client connection."""
+        self.conn.shutdown(socket.SHUT_RDWR)
+
+    def _handle(self):
+        while True:
+            try:
+                length = struct.unpack('>5I', self._recv(20))[0]
+                payload = self._recv(length)
+            except (EOFError, OSError):
+                return
+            command, tag = struct.unpack_from('>xIxI', payload)
+            self.commands.append(command)
+            if command == 8:
+                # AUTH
+                self._reply(tag, _u32(32))
+            elif command == 9:
+                # SET_CLIENT_NAME
+                self._reply(tag, _u32(42))
+            elif command == 21:
+                # GET_SINK_INFO by name
+                name = payload[16:payload.index(b'\0', 16)]
+                if name not in (b'@DEFAULT_SINK@', SINK_NAME):
+                    # PA_ERR_NOENTITY
+                    self._send(_u32(0) + _u32(tag) + _u32(5))
+                    continue
+                volume = b'v' + struct.pack(
+                    '>B2I', len(self.volume), *self.volume)
+                mute = b'1' if self.mute else b'0'
+                self._reply(tag, SINK_INFO_HEAD + volume + mute +
+                            SINK_INFO_TAIL)
+            elif command == 35:
+                # SUBSCRIBE
+                self._reply(tag)
+            elif command in (36, 39) and self.readonly:
+                # PA_ERR_ACCESS
+                self._send(_u32(0) + _u32(tag) + _u32(1))
+            elif command == 36:
+                # SET_SINK_VOLUME by index, no name
+                count = payload[17]
+                self.volume = list(struct.unpack_from(
+                    '>{}I'.format(count), payload, 18))
+                self._reply(tag)
+                self.event()
+            elif command == 39:
+                # SET_SINK_MUTE by index, no name
+                self.mute = payload[-1:] == b'1'
+                self._reply(tag)
+                self.event()
+
+    def close(self):
+        self.sock.close()
+        if self.conn:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+@pytest.fixture
+def pulse_server(tmpdir):
+    """Fake PulseAudio server listening on a socket in tmpdir."""
+    server = FakePulseServer(str(tmpdir.join("native")))
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def amixer_binary(tmpdir, monkeypatch):
+    """Fake ``amixer`` binary.
+
+    ``get`` and ``scontents`` print the ``state`` file next to it, or
+    ``state-<card>`` if a card is given. All calls are logged to ``log``.
+
+    """
+    bindir = tmpdir.mkdir("bin")
+    amixer = bindir.join("amixer")
+    amixer.write(AMIXER)
+    amixer.chmod(0o755)
+    bindir.join("state").write(AMIXER_STATE)
+    bindir.join("log").write("")
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    return amixer
+
+
+@pytest.fixture
+def libasound():
+    """Fake libasound."""
+    lib = FakeLibasound()
+    yield lib
+    for fd in lib.events:
+        if fd is not None:
+            os.close(fd)
+
+
+__all__ = (
+    'amixer_binary',
+    'libasound',
+    'pulse_server',
+)
@@ -28,6 +28,101 @@ def maildir_new_mail(maildir):
     return maildir
 
 
+MBOX_MESSAGES = (
+    b"From alice@example.com Mon Jan  1 00:00:00 2018\n"
+    b"Subject: read\n"
+    b"Status: RO\n"
+    b"\n"
+    b">From the body, escaped.\n"
+    b"\n"
+    b"From bob@example.com Mon Jan  1 00:00:00 2018\n"
+    b"Subject: unread\n"
+    b"Status: O\n"
+    b"\n"
+    b"Hello\n"
+    b"\n"
+    b"From carol@example.com Mon Jan  1 00:00:00 2018\n"
+    b"Subject: deleted\n"
+    b"X-Status: D\n"
+    b"\n"
+    b"Bye\n"
+    b"\n"
+    b"From dave@example.com Mon Jan  1 00:00:00 2018\n"
+    b"Subject: new\n"
+    b"\n"
+    b"Hi\n"
+)
+
+
+@pytest.fixture
+def mbox_file(tmpdir):
+    """Mbox fixture containing two unread messages."""
+    mbox = tmpdir.join("mbox")
+    mbox.write_binary(MBOX_MESSAGES)
+    return mbox
+
+
+@pytest.fixture
+def mh_folder(tmpdir):
+    """MH fixture containing one unseen and one seen message."""
+    path_string = str(tmpdir.join("mh"))
+    mh = mailbox.MH(path_string)
+    for sequences in (['unseen'], []):
+        message = mailbox.MHMessage()
+        message.set_sequences(sequences)
+        mh.add(message)
+    mh.close()
+    return tmpdir.join("mh")
+
+
+@pytest.fixture
+def babyl_file(tmpdir):
+    """Babyl fixture containing one unseen and one seen message."""
+    path_string = str(tmpdir.join("babyl"))
+    babyl = mailbox.Babyl(path_string)
+    for labels in (['unseen'], []):
+        message = mailbox.BabylMessage()
+        message.set_labels(labels)
+        babyl.add(message)
+    babyl.close()
+    return tmpdir.join("babyl")
+
+
+@pytest.fixture
+def notmuch_stub(tmpdir, monkeypatch):
+    """Stand-in for the notmuch2 module.
+
+    Counts are looked up in the returned dict, opened databases are
+    recorded in its 'opened' list. Opening fails while 'locked' is set.
+
+    """
+    from mailstatus import mailstatus
+    tmpdir.mkdir(".notmuch").mkdir("xapian").join("iamglass").write("")
+    counts = {'opened': []}
+
+    class NotmuchError(Exception):
+        pass
+
+    class Database:
+        def __init__(self, path=None):
+            if path == "invalid":
+                raise NotmuchError("no database")
+            if counts.get('locked'):
+                raise NotmuchError("database locked")
+            self.path = tmpdir
+            counts['opened'].append(path)
+
+        def count_messages(self, query):
+            return counts.get(query, 0)
+
+        def close(self):
+            pass
+
+    stub = mock.Mock(Database=Database, NotmuchError=NotmuchError)
+    monkeypatch.setattr(mailstatus, 'notmuch2', stub)
+    return counts
+
+
 @pytest.fixture
 def invalid_maildir(tmpdir):
     """Empty maildir fixture."""
@@ -83,6 +178,10 @@ __all__ = (
     'maildir',
     'maildir_new_mail',
     'invalid_maildir',
+    'mbox_file',
+    'mh_folder',
+    'babyl_file',
+    'notmuch_stub',
     'read_mailboxes_fixture',
     'mailstatus_response_none',
     'mailstatus_response_some',
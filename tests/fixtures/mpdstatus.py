@@ -1,8 +1,272 @@
 """Fixtures for the ``mpdstatus`` module."""
 
+import asyncio
+import shlex
+import threading
+
 import pytest
 
 
+class FakeMPDServer:
+    """MPD server speaking enough of the text protocol for mpdstatus.
+
+    Runs an asyncio event loop in a background thread. All received commands
+    are recorded in ``commands``, each response counts as one round trip.
+
+    ``latency`` seconds pass before the greeting and each response.
+    ``password`` may be changed at any time to reject further attempts.
+
+    """
+
+    def __init__(self, password=None, path=None, latency=0):
+        self.password = password
+        self.latency = latency
+        self.song = {
+            'file': 'music/Best Artist/best_song.flac',
+            'Artist': 'Best Artist',
+            'Title': 'Best Song',
+            'Album': 'Best Album',
+            'Time': '200',
+            'duration': '200.000',
+            'Pos': '0',
+            'Id': '1',
+        }
+        self.status = {
+            'volume': '50',
+            'repeat': '0',
+            'random': '0',
+            'single': '0',
+            'consume': '0',
+            'playlist': '2',
+            'playlistlength': '1',
+            'state': 'play',
+            'song': '0',
+            'songid': '1',
+            'time': '10:200',
+            'elapsed': '10.000',
+            'duration': '200.000',
+        }
+        self.commands = []
+        self.connections = 0
+        self.round_trips = 0
+        # Requests to answer before closing a connection instead
+        self.disconnect_after = None
+        # Per connection state
+        self.clients = []
+        self.writers = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        if path:
+            self.server = self._call(
+                asyncio.start_unix_server(self._handle, path))
+            self.host, self.port = path, None
+        else:
+            self.server = self._call(
+                asyncio.start_server(self._handle, '127.0.0.1', 0))
+            self.host = '127.0.0.1'
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def change(self, subsystem='player', song=None, **status):
+        """Update song and status and notify idling clients.
+
+        Like MPD, changes are remembered until the next ``idle``.
+
+        """
+        async def change():
+            if song is not None:
+                self.song = song
+            self.status.update(status)
+            for state in self.clients:
+                state['changes'].add(subsystem)
+                if state['idle']:
+                    state['idle'].set()
+        self._call(change())
+
+    def drop(self):
+        """Close all client connections."""
+        async def drop():
+            for writer in list(self.writers):
+                writer.close()
+        self._call(drop())
+
+    def disconnect(self, after=0):
+        """Close the connection of a request instead of answering it.
+
+        after requests are answered normally before that.
+
+        """
+        self.disconnect_after = after
+
+    def close(self):
+        """Stop the server."""
+        if not self.loop.is_running():
+            return
+
+        async def close():
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+        self._call(close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    @staticmethod
+    def _format(items):
+        return "".join("{}: {}\n".format(key, value)
+                       for key, value in items.items())
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        state = {'authorised': self.password is None, 'changes': set(),
+                 'idle': None}
+        self.clients.append(state)
+        try:
+            await asyncio.sleep(self.latency)
+            writer.write(b"OK MPD 0.23.5\n")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, *args = shlex.split(line.decode('utf-8'))
+                self.commands.append(command)
+                if command == 'close':
+                    break
+                response = await self._command(command, args, reader, state)
+                if response is None:
+                    break
+                if self.disconnect_after == 0:
+                    self.disconnect_after = None
+                    break
+                elif self.disconnect_after is not None:
+                    self.disconnect_after -= 1
+                await asyncio.sleep(self.latency)
+                self.round_trips += 1
+                writer.write(response.encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.remove(state)
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _idle(self, args, reader, state):
+        subsystems = set(args or ('player', 'mixer', 'options'))
+        read = None
+        while not state['changes'] & subsystems:
+            state['idle'] = asyncio.Event()
+            read = read or asyncio.ensure_future(reader.readline())
+            wait = asyncio.ensure_future(state['idle'].wait())
+            try:
+                await asyncio.wait([wait, read],
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                state['idle'] = None
+                wait.cancel()
+            if read.done():
+                if not read.result():
+                    return None
+                # noidle
+                self.commands.append(read.result().decode('utf-8').strip())
+                break
+        else:
+            if read:
+                read.cancel()
+                try:
+                    line = await read
+                except asyncio.CancelledError:
+                    pass
+                else:
+                    # noidle arrived together with the changes
+                    if line:
+                        self.commands.append(line.decode('utf-8').strip())
+
+        changed = state['changes'] & subsystems
+        state['changes'] -= subsystems
+        return "".join("changed: {}\n".format(subsystem)
+                       for subsystem in sorted(changed)) + "OK\n"
+
+    async def _command_list(self, reader, state):
+        commands = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                return None
+            command, *args = shlex.split(line.decode('utf-8'))
+            self.commands.append(command)
+            if command == 'command_list_end':
+                break
+            commands.append((command, args))
+
+        response = ""
+        for command, args in commands:
+            result = await self._command(command, args, reader, state)
+            if result.startswith("ACK"):
+                return response + result
+            response += result[:-len("OK\n")] + "list_OK\n"
+        return response + "OK\n"
+
+    async def _command(self, command, args, reader, state):
+        if command == 'password':
+            if args and args[0] == self.password:
+                state['authorised'] = True
+                return "OK\n"
+            return "ACK [3@0] {password} incorrect password\n"
+        if not state['authorised']:
+            return "ACK [4@0] {{{}}} you don't have permission for \"{}\"\n" \
+                .format(command, command)
+        if command == 'status':
+            return self._format(self.status) + "OK\n"
+        if command == 'currentsong':
+            return self._format(self.song) + "OK\n"
+        if command == 'idle':
+            return await self._idle(args, reader, state)
+        if command == 'command_list_ok_begin':
+            return await self._command_list(reader, state)
+        if command in ('ping', 'pause', 'next', 'previous'):
+            return "OK\n"
+        return "ACK [5@0] {{{}}} unknown command \"{}\"\n".format(
+            command, command)
+
+
+@pytest.fixture
+def mpd_server():
+    """Fake MPD server listening on a local TCP port."""
+    server = FakeMPDServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def mpd_slow_server():
+    """Fake MPD server answering after 50 milliseconds."""
+    server = FakeMPDServer(latency=0.05)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def mpd_password_server():
+    """Fake MPD server requiring a password."""
+    server = FakeMPDServer(password='secret')
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def mpd_socket_server(tmpdir):
+    """Fake MPD server listening on a UNIX socket."""
+    server = FakeMPDServer(path=str(tmpdir.join("socket")))
+    yield server
+    server.close()
+
+
 @pytest.fixture
 def current_song():
     """Mock current_song method of MPD client class."""
@@ -93,6 +357,10 @@ def mpdstatus_response_stopped():
 
 __all__ = (
     'current_song',
+    'mpd_password_server',
+    'mpd_server',
+    'mpd_slow_server',
+    'mpd_socket_server',
     'mpd_state_play',
     'mpd_state_pause',
     'mpd_state_stop',
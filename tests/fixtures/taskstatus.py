@@ -0,0 +1,24 @@
+"""Fixtures for the ``taskstatus`` module."""
+
+import pytest
+
+
+@pytest.fixture
+def task_binary(tmpdir, monkeypatch):
+    """Fake ``task`` binary reporting version 2.6.2.
+
+    Also points $XDG_CACHE_HOME to a temporary directory.
+
+    """
+    bindir = tmpdir.mkdir("bin")
+    task = bindir.join("task")
+    task.write("#!/bin/sh\necho 2.6.2\n")
+    task.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
+    return task
+
+
+__all__ = (
+    'task_binary',
+)
@@ -0,0 +1,422 @@
+"""Tests for the alsastatus module."""
+
+from threading import Event
+from time import sleep, time
+
+import mock
+import pytest
+from alsastatus import alsastatus
+from alsastatus.alsastatus import (AlsastatusException, Controls, Data,
+                                   LibasoundData, pack_tags, parse_amixer,
+                                   PulseData, Py3status, unpack_tags)
+
+I3STATUS_CONFIG = {'color_bad': '#FF0000', 'color_degraded': '#FFFF00'}
+
+STEREO_STATE = """Simple mixer control 'Master',0
+  Capabilities: pvolume pswitch pswitch-joined
+  Playback channels: Front Left - Front Right
+  Limits: Playback 0 - 87
+  Mono:
+  Front Left: Playback 87 [100%] [0.00dB] [on]
+  Front Right: Playback 87 [100%] [0.00dB] [on]
+Simple mixer control 'Capture',0
+  Capabilities: cvolume cswitch
+  Capture channels: Front Left - Front Right
+  Limits: Capture 0 - 63
+  Front Left: Capture 39 [62%] [12.00dB] [off]
+  Front Right: Capture 39 [62%] [12.00dB] [off]
+"""
+
+PCM_STATE = """Simple mixer control 'PCM',0
+  Capabilities: pvolume
+  Playback channels: Front Left - Front Right
+  Limits: Playback 0 - 255
+  Mono:
+  Front Left: Playback 0 [0%] [-51.00dB]
+  Front Right: Playback 0 [0%] [-51.00dB]
+"""
+
+
+def wait_for_writer(data):
+    """Wait until queued changes were applied."""
+    deadline = time() + 5
+    while data.writer and time() < deadline:
+        sleep(0.01)
+    assert not data.writer
+
+
+class TestData:
+    """Test Data functions."""
+
+    def test_get_stats(self, amixer_binary):
+        """Test reading volume, mute state and limits."""
+        data = Data('Master')
+        assert data.get_stats() == ("46%", False)
+        assert data.raw == 40
+        assert data.limits == (0, 87)
+
+    def test_parse_amixer(self):
+        """Test parsing several stereo controls."""
+        controls = parse_amixer(STEREO_STATE.encode().splitlines())
+        assert list(controls) == ['Master', 'Capture']
+        assert controls['Master'] == ("100%", False, 87, (0, 87))
+        assert controls['Capture'] == ("62%", True, 39, (0, 63))
+
+    def test_clicks(self, amixer_binary):
+        """Test coalescing clicks into a single write."""
+        bindir = amixer_binary.dirpath()
+        data = Data('Master')
+        data.get_stats()
+
+        # Keep the writer from picking up changes until all clicks are done
+        release = Event()
+        write = data._write
+
+        def delayed_write():
+            release.wait()
+            write()
+        data._write = delayed_write
+
+        for _ in range(5):
+            data.increase_volume(3)
+        data.decrease_volume(3)
+        data.toggle_mute()
+        # Cached state is updated right away
+        assert data.get_stats() == ("60%", True)
+        release.set()
+        wait_for_writer(data)
+
+        writes = [line for line in bindir.join("log").read().splitlines()
+                  if line.startswith("-q sset")]
+        assert writes == ["-q sset Master 12+ toggle"]
+
+        # Reconciled with the (unchanged) fake mixer
+        calls = len(bindir.join("log").read().splitlines())
+        assert data.get_stats() == ("46%", False)
+        assert len(bindir.join("log").read().splitlines()) == calls
+
+
+class TestControls:
+    """Test Controls functions."""
+
+    def test_libasound(self, libasound):
+        """Test sharing one mixer handle per card."""
+        data = Controls(['Master', 'Capture', 'PCM@hw:1'], 'libasound',
+                        lib=libasound)
+        assert libasound.calls.count('open') == 2
+        assert data.get_stats() == [
+            ("46%", False), ("62%", False), ("100%", False)]
+        assert libasound.calls.count('handle_events') == 2
+
+        data.toggle_mute()
+        assert data.get_stats()[0] == ("46%", True)
+
+        data.close()
+        assert libasound.calls.count('close') == 2
+
+    def test_libasound_unplug(self, libasound):
+        """Test reopening a card which went away."""
+        data = Controls(['Master', 'Capture'], 'libasound', lib=libasound)
+        try:
+            libasound.unplug()
+            with pytest.raises(AlsastatusException):
+                data.get_stats()
+            with pytest.raises(AlsastatusException) as e:
+                data.get_stats()
+            assert "failed to attach mixer" in str(e)
+
+            libasound.plug()
+            libasound.value = 87
+            assert data.get_stats() == [("100%", False), ("62%", False)]
+            assert data.data[1].handle is data.data[0].handle
+            assert libasound.calls.count('open') == 3
+        finally:
+            data.close()
+
+    def test_amixer(self, amixer_binary):
+        """Test reading all controls of a card with one call."""
+        bindir = amixer_binary.dirpath()
+        bindir.join("state").write(STEREO_STATE)
+        bindir.join("state-hw:1").write(PCM_STATE)
+        data = Controls(['Master', 'Capture', 'PCM@hw:1'])
+        assert data.get_stats() == [
+            ("100%", False), ("62%", True), ("0%", False)]
+        assert bindir.join("log").read().splitlines() == [
+            "scontents", "-D hw:1 scontents"]
+
+    def test_unknown_mixer(self, amixer_binary):
+        """Test control missing from amixer output."""
+        data = Controls(['Master', 'Nope'])
+        with pytest.raises(AlsastatusException):
+            data.get_stats()
+        assert data.error == ("unknown mixer Nope", -1)
+
+
+class TestLibasoundData:
+    """Test LibasoundData functions."""
+
+    def test_get_stats(self, libasound):
+        """Test reading volume and mute state."""
+        data = LibasoundData('Master', lib=libasound)
+        assert data.get_stats() == ("46%", False)
+
+        libasound.switch = 0
+        libasound.value = 87
+        assert data.get_stats() == ("100%", True)
+
+    def test_controls(self, libasound):
+        """Test changing volume and mute state."""
+        data = LibasoundData('Master', lib=libasound)
+        data.increase_volume(3)
+        assert libasound.value == 43
+        data.decrease_volume(50)
+        assert libasound.value == 0
+
+        data.toggle_mute()
+        assert libasound.switch == 0
+        assert data.mute is True
+        data.toggle_mute()
+        assert libasound.switch == 1
+        assert data.mute is False
+
+    def test_invalid_mixer(self, libasound):
+        """Test unknown mixer and card."""
+        with pytest.raises(AlsastatusException) as e:
+            LibasoundData('Nope', lib=libasound)
+        assert "unknown mixer" in str(e)
+
+        with pytest.raises(AlsastatusException) as e:
+            LibasoundData('Master', 'hw:9', lib=libasound)
+        assert "failed to attach mixer" in str(e)
+
+    def test_events(self, libasound):
+        """Test updating cached state from mixer events."""
+        changed = Event()
+        data = LibasoundData('Master', lib=libasound)
+        data.start_events(changed.set)
+        try:
+            assert data.get_stats() == ("46%", False)
+            calls = len(libasound.calls)
+            assert data.get_stats() == ("46%", False)
+            # Cached state is returned without touching the mixer
+            assert len(libasound.calls) == calls
+
+            libasound.value = 87
+            libasound.signal()
+            assert changed.wait(5)
+            assert data.get_stats() == ("100%", False)
+
+            changed.clear()
+            libasound.switch = 0
+            libasound.signal()
+            assert changed.wait(5)
+            assert data.get_stats() == ("100%", True)
+        finally:
+            data.close()
+        assert data.events is None
+
+    def test_unplug(self, libasound):
+        """Test falling back to polling when the card goes away."""
+        changed = Event()
+        data = LibasoundData('Master', lib=libasound)
+        data.start_events(changed.set)
+        try:
+            libasound.unplug()
+            assert changed.wait(5)
+            data.events.join(5)
+            assert not data.events.is_alive()
+            assert data.error[0] == "mixer disconnected"
+            assert data.lost
+
+            with pytest.raises(AlsastatusException) as e:
+                data.get_stats()
+            assert "failed to attach mixer" in str(e)
+            assert data.events is None
+
+            libasound.plug()
+            libasound.value = 87
+            assert data.get_stats() == ("100%", False)
+            assert not data.lost
+            assert libasound.calls.count('open') == 3
+
+            # Polling notices errors as well
+            libasound.unplug()
+            with pytest.raises(AlsastatusException):
+                data.get_stats()
+            assert data.lost
+        finally:
+            data.close()
+
+
+def wait_for(condition):
+    """Wait until condition is true."""
+    deadline = time() + 5
+    while not condition() and time() < deadline:
+        sleep(0.01)
+    assert condition()
+
+
+class TestPulseData:
+    """Test PulseData functions."""
+
+    def test_tags(self):
+        """Test packing and unpacking tagstructs."""
+        data = pack_tags(('L', 7), ('t', 'Master'), ('t', None), ('b', True),
+                         ('v', [1, 65536]), ('x', b'ab'),
+                         ('P', {'application.name': 'py3status'}))
+        assert unpack_tags(data) == [
+            7, 'Master', None, True, [1, 65536], b'ab',
+            {'application.name': 'py3status'}]
+
+    def test_get_stats(self, pulse_server):
+        """Test reading the default sink and following changes."""
+        changed = Event()
+        data = PulseData(server=pulse_server.path, callback=changed.set)
+        try:
+            assert data.get_stats() == ("50%", False)
+            assert data.index == 0
+
+            pulse_server.volume = [0x10000, 0x8000]
+            pulse_server.mute = True
+            pulse_server.event()
+            assert changed.wait(5)
+            assert data.get_stats() == ("100%", True)
+
+            # Unrelated sinks are ignored
+            commands = len(pulse_server.commands)
+            pulse_server.event(index=3)
+            data.toggle_mute()
+            wait_for(lambda: len(pulse_server.commands) == commands + 2)
+            assert not pulse_server.mute
+            assert pulse_server.commands[commands:] == [39, 21]
+        finally:
+            data.close()
+
+    def test_controls(self, pulse_server):
+        """Test changing volume and mute state."""
+        data = PulseData('alsa_output.pci-0000_00_1f.3.analog-stereo',
+                         server=pulse_server.path)
+        try:
+            data.increase_volume(3)
+            # Updated right away, before the server confirms the change
+            assert data.get_stats() == ("53%", False)
+            wait_for(lambda: pulse_server.volume == [0x87ae, 0x87ae])
+
+            pulse_server.volume = [0x8000, 0x4000]
+            pulse_server.event()
+            wait_for(lambda: data.channels == [0x8000, 0x4000])
+            data.decrease_volume(50)
+            wait_for(lambda: pulse_server.volume == [0, 0])
+
+            data.toggle_mute()
+            assert data.get_stats() == ("0%", True)
+            wait_for(lambda: pulse_server.mute)
+        finally:
+            data.close()
+
+    def test_above_norm(self, pulse_server):
+        """Test raising a volume which is already above 100%."""
+        pulse_server.volume = [0x18000, 0x18000]
+        data = PulseData(server=pulse_server.path)
+        try:
+            assert data.get_stats() == ("150%", False)
+            commands = len(pulse_server.commands)
+            data.increase_volume(3)
+            assert data.get_stats() == ("150%", False)
+            # Wait for the confirmation to settle
+            wait_for(lambda: pulse_server.commands[commands:] == [36, 21])
+            wait_for(lambda: not data.querying)
+            assert pulse_server.volume == [0x18000, 0x18000]
+
+            data.decrease_volume(3)
+            assert data.get_stats() == ("147%", False)
+            wait_for(lambda: pulse_server.volume == [96337, 96337])
+
+            pulse_server.volume = [0xfd71, 0xfd71]
+            pulse_server.event()
+            wait_for(lambda: data.channels == [0xfd71, 0xfd71])
+            data.increase_volume(3)
+            assert data.get_stats() == ("100%", False)
+        finally:
+            data.close()
+
+    def test_failed_write(self, pulse_server):
+        """Test rolling back the shown state after a rejected change."""
+        changed = Event()
+        data = PulseData(server=pulse_server.path, callback=changed.set)
+        try:
+            pulse_server.readonly = True
+            data.increase_volume(10)
+            data.toggle_mute()
+            assert data.get_stats() == ("60%", True)
+            wait_for(lambda: data.get_stats() == ("50%", False))
+            assert changed.is_set()
+            assert data.error[0] == "PulseAudio error 1"
+        finally:
+            data.close()
+
+    def test_errors(self, pulse_server, tmpdir):
+        """Test unknown device, missing server and reconnecting."""
+        with pytest.raises(AlsastatusException) as e:
+            PulseData('nope', server=pulse_server.path)
+        assert "unknown device nope" in str(e)
+
+        with pytest.raises(AlsastatusException) as e:
+            PulseData(server=str(tmpdir.join("missing")))
+        assert "failed to connect to PulseAudio" in str(e)
+
+        data = PulseData(server=pulse_server.path)
+        try:
+            pulse_server.disconnect()
+            wait_for(lambda: data.error[0] == "disconnected from PulseAudio")
+            pulse_server.volume = [0x4000, 0x4000]
+            assert data.get_stats() == ("25%", False)
+        finally:
+            data.close()
+
+
+class TestPy3status:
+    """Test Py3status functions."""
+
+    def test_controls(self, amixer_binary):
+        """Test formatting several controls."""
+        bindir = amixer_binary.dirpath()
+        bindir.join("state").write(STEREO_STATE)
+        bindir.join("state-hw:1").write(PCM_STATE)
+        module = Py3status()
+        module.controls = ['Master', 'Capture', 'PCM@hw:1']
+        response = module.alsastatus([], I3STATUS_CONFIG)
+        assert response['full_text'] == "ALSA: 100% [M] 62% 0%"
+        assert 'color' not in response
+
+        module = Py3status()
+        module.controls = ['Master', 'PCM@hw:1']
+        module.format = "{0} / {control[PCM@hw:1]}"
+        response = module.alsastatus([], I3STATUS_CONFIG)
+        assert response['full_text'] == "ALSA: 100% / 0%"
+
+    def test_events(self, libasound, monkeypatch):
+        """Test polling again after mixer events failed."""
+        monkeypatch.setattr(alsastatus, 'load_libasound', lambda: libasound)
+        module = Py3status()
+        module.backend = 'libasound'
+        module.events = True
+        module.py3 = mock.Mock()
+        try:
+            response = module.alsastatus([], I3STATUS_CONFIG)
+            assert response['full_text'] == "ALSA: 46%"
+            assert response['cached_until'] > time() + 60
+
+            libasound.unplug()
+            wait_for(lambda: not module.data.events.is_alive())
+            response = module.alsastatus([], I3STATUS_CONFIG)
+            assert response['full_text'] == "ALSA: mixer disconnected"
+
+            # The mixer is reopened once the error expired
+            libasound.plug()
+            module.data.error = (module.data.error[0], time() - 60)
+            response = module.alsastatus([], I3STATUS_CONFIG)
+            assert response['full_text'] == "ALSA: 46%"
+            assert response['cached_until'] < time() + 60
+        finally:
+            module.kill([], I3STATUS_CONFIG, None)
@@ -1,7 +1,13 @@
 """Tests for the mailstatus module."""
 
+import json
+import threading
+from time import sleep, time
+
 import pytest
-from mailstatus.mailstatus import Data, MailstatusException
+from mailstatus import mailstatus
+from mailstatus.mailstatus import (
+    Data, MailstatusException, MboxScanner, NotmuchData, Py3status)
 
 
 class TestData:
@@ -37,3 +43,499 @@ class TestData:
         with pytest.raises(MailstatusException) as e:
             Data(["This path should not exist"])
         assert "invalid path" in str(e)
+
+    def test_maildir_watch(self, maildir):
+        """Test inotify driven unread counter."""
+        path_string = maildir.dirname + "/" + maildir.basename
+        data = Data([path_string], watch=True)
+        if not data.watcher:
+            pytest.skip("inotify not available")
+        assert data.get_unread() == 0
+
+        maildir.join("new", "1.host").write("")
+        maildir.join("new", "2.host").write("")
+        assert data.get_unread() == 2
+
+        maildir.join("new", "1.host").move(maildir.join("cur", "1.host:2,S"))
+        assert data.get_unread() == 1
+
+        maildir.join("new", "2.host").remove()
+        assert data.get_unread() == 0
+        data.stop_watcher()
+
+    def test_maildir_watch_rescan(self, maildir, monkeypatch):
+        """Test that mails arriving during a rescan are counted once."""
+        path_string = maildir.dirname + "/" + maildir.basename
+        data = Data([path_string], watch=True)
+        if not data.watcher:
+            pytest.skip("inotify not available")
+
+        count = data._get_unread_maildir
+
+        def deliver(mbox):
+            maildir.join("new", "1.host").write("")
+            return count(mbox)
+        monkeypatch.setattr(data, '_get_unread_maildir', deliver)
+        assert data.get_unread() == 1
+
+        monkeypatch.setattr(data, '_get_unread_maildir', count)
+        assert data.get_unread() == 1
+        data.stop_watcher()
+
+    def test_maildir_watch_after_scan(self, maildir, monkeypatch):
+        """Test that mails arriving right after a rescan are counted."""
+        path_string = maildir.dirname + "/" + maildir.basename
+        data = Data([path_string], watch=True)
+        if not data.watcher:
+            pytest.skip("inotify not available")
+
+        scan = data._scan
+
+        def deliver(*args, **kwargs):
+            scan(*args, **kwargs)
+            maildir.join("new", "1.host").write("")
+        monkeypatch.setattr(data, '_scan', deliver)
+        assert data.get_unread() == 0
+
+        monkeypatch.setattr(data, '_scan', scan)
+        assert data.get_unread() == 1
+        assert data.get_unread() == 1
+        data.stop_watcher()
+
+    def test_maildir_watch_overflow(self, maildir_new_mail):
+        """Test fallback to rescan after inotify queue overflow."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        data = Data([path_string])
+        data.unread = [5]
+        assert data._apply_events([(None, 0, None)], set()) is None
+        data.mbox_state = ['']
+        data._scan()
+        assert data.unread == [1]
+
+    def test_maildir_unchanged(self, maildir_new_mail, monkeypatch):
+        """Test that unchanged maildirs are not rescanned."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        data = Data([path_string])
+        assert data.get_unread() == 1
+
+        calls = []
+
+        def count(mbox):
+            calls.append(mbox)
+            return 1
+        monkeypatch.setattr(data, '_get_unread_maildir', count)
+
+        # Recently modified maildirs are rescanned to be safe
+        assert data.get_unread() == 1
+        assert len(calls) == 1
+
+        # Old enough modification times are trusted
+        data.mbox_checked[0] += 10
+        assert data.get_unread() == 1
+        assert len(calls) == 1
+
+        # New mail changes the signature
+        maildir_new_mail.join("new", "2.host").write("")
+        data.get_unread()
+        assert len(calls) == 2
+
+    def test_maildir_count_mode_flags(self, maildir):
+        """Test counting unseen messages in 'cur' by their flags."""
+        path_string = maildir.dirname + "/" + maildir.basename
+        maildir.join("new", "1.host").write("")
+        maildir.join("cur", "2.host:2,S").write("")
+        maildir.join("cur", "3.host:2,FR").write("")
+        maildir.join("cur", "4.host:2,RS").write("")
+        maildir.join("cur", "5.host").write("")
+
+        data = Data([path_string])
+        assert data.get_unread() == 1
+
+        data = Data([path_string], count_mode='flags')
+        assert data.get_unread() == 3
+
+    def test_mbox_unread(self, mbox_file):
+        """Test mbox with two unread mails."""
+        data = Data([str(mbox_file)])
+        assert data.get_unread() == 2
+
+    def test_mbox_incremental(self, mbox_file):
+        """Test that only appended mails are parsed."""
+        scanner = MboxScanner(str(mbox_file))
+        assert scanner.count() == 2
+        offset = scanner.offset
+
+        parsed = []
+        parse = scanner._parse
+
+        def spy(buf, start):
+            parsed.append(start)
+            return parse(buf, start)
+        scanner._parse = spy
+
+        # Header still being written is not counted yet
+        mbox_file.write(b"\nFrom eve@example.com Mon Jan  1 00:00:00 "
+                        b"2018\nSubject: partial", mode='ab')
+        assert scanner.count() == 2
+        assert parsed == [offset]
+
+        mbox_file.write(b"\n\nBody\n", mode='ab')
+        assert scanner.count() == 3
+        assert parsed[1] > offset
+
+        # Rewriting the mbox triggers a full reparse
+        mbox_file.write_binary(b"From x@example.com Mon Jan  1 00:00:00 2018"
+                               b"\nStatus: RO\n\n" + b"x" * 1024 + b"\n")
+        assert scanner.count() == 0
+        assert parsed[2] == 0
+
+    def test_mbox_shrinking(self, mbox_file, monkeypatch):
+        """Test keeping the count while the mbox file shrinks."""
+        scanner = MboxScanner(str(mbox_file))
+        assert scanner.count() == 2
+
+        def shrunk(*args, **kwargs):
+            raise ValueError("mmap length is greater than file size")
+        mmap = mailstatus.mmap
+        monkeypatch.setattr(mailstatus, 'mmap', shrunk)
+        mbox_file.write(b"\n", mode='ab')
+        assert scanner.count() == 2
+
+        parsed = []
+        parse = scanner._parse
+
+        def spy(buf, start):
+            parsed.append(start)
+            return parse(buf, start)
+        scanner._parse = spy
+        monkeypatch.setattr(mailstatus, 'mmap', mmap)
+        assert scanner.count() == 2
+        assert parsed == [0]
+
+    def test_mh_unread(self, mh_folder):
+        """Test MH folder with one unseen mail."""
+        data = Data([str(mh_folder)])
+        assert data.get_unread() == 1
+
+    def test_babyl_unread(self, babyl_file):
+        """Test Babyl file with one unseen mail."""
+        data = Data([str(babyl_file)])
+        assert data.get_unread() == 1
+
+    def test_parallel_stale(self, maildir_new_mail, tmpdir, monkeypatch):
+        """Test that stalled mailboxes keep their last count."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        other = tmpdir.mkdir("other")
+        for subdir in ("cur", "new", "tmp"):
+            other.mkdir(subdir)
+        other.join("new", "1.host").write("")
+        data = Data([path_string, str(other)], workers=2, scan_timeout=0.1)
+        assert data.get_unread() == 2
+        assert data.stale == [False, False]
+
+        release = threading.Event()
+        count = data._count_unread
+
+        def stall(mbox, scanner):
+            if mbox._path == str(other):
+                release.wait()
+            return count(mbox, scanner)
+        monkeypatch.setattr(data, '_count_unread', stall)
+
+        other.join("new", "2.host").write("")
+        maildir_new_mail.join("new", "2.host").write("")
+        assert data.get_unread() == 3
+        assert data.stale == [False, True]
+
+        release.set()
+        data.pending[1].result()
+        assert data.get_unread() == 4
+        assert data.stale == [False, False]
+        data.close()
+
+    def test_hung_scan(self, maildir_new_mail, monkeypatch):
+        """Test that a scan which never returns is only waited for once."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        data = Data([path_string], scan_timeout=0.2)
+        assert data.get_unread() == 1
+
+        hang = threading.Event()
+        monkeypatch.setattr(data, '_count_unread',
+                            lambda mbox, scanner: hang.wait())
+        try:
+            maildir_new_mail.join("new", "2.host").write("")
+            start = time()
+            assert data.get_unread() == 1
+            assert 0.2 <= time() - start < 1
+            assert data.stale == [True]
+
+            start = time()
+            assert data.get_unread() == 1
+            assert time() - start < 0.1
+            assert data.stale == [True]
+        finally:
+            hang.set()
+            data.close()
+
+    def test_hung_first_scan(self, tmpdir, monkeypatch):
+        """Test that a hung mailbox doesn't hold up the others."""
+        for account in ("hung", "healthy"):
+            inbox = tmpdir.mkdir(account)
+            for subdir in ("cur", "new", "tmp"):
+                inbox.mkdir(subdir)
+        data = Data([str(tmpdir.join("hung")), str(tmpdir.join("healthy"))],
+                    scan_timeout=0.2)
+        count = data._count_unread
+        hang = threading.Event()
+
+        def hang_first(mbox, scanner):
+            if mbox is data.mboxes[0]:
+                hang.wait()
+            return count(mbox, scanner)
+        monkeypatch.setattr(data, '_count_unread', hang_first)
+        try:
+            assert data.get_unread() == 0
+            assert data.stale[0] is True
+
+            tmpdir.join("healthy", "new", "1.host").write("")
+            deadline = time() + 5
+            while data.get_unread() != 1 and time() < deadline:
+                sleep(0.05)
+            assert data.get_unread() == 1
+            assert data.stale == [True, False]
+        finally:
+            hang.set()
+            data.close()
+
+    def test_glob(self, tmpdir, monkeypatch):
+        """Test glob expansion of mailboxes."""
+        for account in ("work", "home"):
+            inbox = tmpdir.mkdir(account).mkdir("INBOX")
+            for subdir in ("cur", "new", "tmp"):
+                inbox.mkdir(subdir)
+        tmpdir.join("home", "INBOX", "new", "1.host").write("")
+        data = Data([str(tmpdir) + "/*/INBOX"])
+        assert data.names == ["home/INBOX", "work/INBOX"]
+        assert data.get_unread() == 1
+        assert data.get_breakdown() == {"home/INBOX": 1, "work/INBOX": 0}
+
+        expanded = []
+        expand = data._expand
+
+        def spy(pattern):
+            expanded.append(pattern)
+            return expand(pattern)
+        monkeypatch.setattr(data, '_expand', spy)
+
+        # Unchanged directories are not globbed again
+        data.sources[0]['checked'] += 10
+        data.get_unread()
+        assert expanded == []
+
+        inbox = tmpdir.mkdir("lists").mkdir("INBOX")
+        for subdir in ("cur", "new", "tmp"):
+            inbox.mkdir(subdir)
+        inbox.join("new", "1.host").write("")
+        assert data.get_unread() == 2
+        assert len(expanded) == 1
+        assert data.names == ["home/INBOX", "lists/INBOX", "work/INBOX"]
+
+    def test_cache(self, maildir_new_mail, tmpdir, monkeypatch):
+        """Test serving cached counts while they are validated."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        cache_file = str(tmpdir.join("cache", "mailstatus.json"))
+        data = Data([path_string], cache_file=cache_file)
+        assert data.get_unread() == 1
+        assert data.validator is None
+
+        maildir_new_mail.join("new", "2.host").write("")
+        data = Data([path_string], cache_file=cache_file)
+        assert data.unread == [1]
+
+        release = threading.Event()
+        scan = data._scan
+
+        def delayed_scan(*args, **kwargs):
+            release.wait()
+            scan(*args, **kwargs)
+        monkeypatch.setattr(data, '_scan', delayed_scan)
+
+        assert data.get_unread() == 1
+        assert data.get_unread() == 1
+        release.set()
+        data.validator.join()
+        assert data.get_unread() == 2
+
+        # Counts for another count_mode are not reused
+        data = Data([path_string], count_mode='flags', cache_file=cache_file)
+        assert data.validate is False
+
+    def test_cache_writes(self, maildir_new_mail, tmpdir, monkeypatch):
+        """Test writing the cache only when counts changed."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        cache_file = str(tmpdir.join("cache", "mailstatus.json"))
+        data = Data([path_string], cache_file=cache_file)
+        data.cache['/removed'] = {'count_mode': 'new_only'}
+
+        saved = []
+        save = data.save_cache
+
+        def spy():
+            saved.append(True)
+            save()
+        monkeypatch.setattr(data, 'save_cache', spy)
+        assert data.get_unread() == 1
+        assert len(saved) == 1
+        assert list(data.cache) == [path_string]
+
+        # Recently modified maildirs are rescanned without any changes
+        assert data.get_unread() == 1
+        assert len(saved) == 1
+
+        maildir_new_mail.join("new", "2.host").write("")
+        assert data.get_unread() == 2
+        assert len(saved) == 2
+
+    def test_cache_watch(self, maildir_new_mail, tmpdir):
+        """Test saving counts updated by inotify events."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        cache_file = str(tmpdir.join("cache", "mailstatus.json"))
+        data = Data([path_string], watch=True, cache_file=cache_file)
+        if not data.watcher:
+            pytest.skip("inotify not available")
+        assert data.get_unread() == 1
+
+        maildir_new_mail.join("new", "2.host").write("")
+        assert data.get_unread() == 2
+        data.stop_watcher()
+        with open(cache_file) as f:
+            assert json.load(f)[path_string]['unread'] == 2
+
+    def test_cache_error(self, maildir_new_mail, tmpdir, monkeypatch):
+        """Test reporting errors while validating cached counts."""
+        path_string = (maildir_new_mail.dirname + "/" +
+                       maildir_new_mail.basename)
+        cache_file = str(tmpdir.join("cache", "mailstatus.json"))
+        Data([path_string], cache_file=cache_file).get_unread()
+
+        data = Data([path_string], cache_file=cache_file)
+
+        def fail(*args, **kwargs):
+            raise OSError("Input/output error")
+        monkeypatch.setattr(data, '_scan', fail)
+        assert data.get_unread() == 1
+        data.validator.join()
+        assert "failed to validate cache" in data.get_unread()
+        assert "Input/output error" in data.error[0]
+
+
+class TestNotmuchData:
+    """Test NotmuchData functions."""
+
+    def test_unread(self, notmuch_stub):
+        """Test counting unread mails through the notmuch index."""
+        notmuch_stub['tag:unread'] = 4
+        data = NotmuchData()
+        assert data.get_unread() == 4
+        assert data.get_breakdown() == {'unread': 4}
+        # No scan threads for a backend which never scans
+        assert data.executor is None
+
+    def test_queries(self, notmuch_stub, tmpdir):
+        """Test per-folder queries and index change detection."""
+        notmuch_stub['tag:unread and (folder:work)'] = 2
+        notmuch_stub['tag:unread and (tag:lists)'] = 3
+        notmuch_stub['tag:unread and ((folder:work) or (tag:lists))'] = 4
+        data = NotmuchData(queries=[('work', 'folder:work'),
+                                    ('lists', 'tag:lists')])
+        assert data.get_unread() == 4
+        assert data.get_breakdown() == {'work': 2, 'lists': 3}
+        assert len(notmuch_stub['opened']) == 1
+
+        # Unchanged index is not queried again
+        data.index_checked += 10
+        notmuch_stub['tag:unread and ((folder:work) or (tag:lists))'] = 5
+        assert data.get_unread() == 4
+        assert len(notmuch_stub['opened']) == 1
+
+        tmpdir.join(".notmuch", "xapian", "iamglass").write("changed")
+        assert data.get_unread() == 5
+        assert len(notmuch_stub['opened']) == 2
+
+    def test_failed_open(self, notmuch_stub, tmpdir):
+        """Test querying again after the database couldn't be opened."""
+        notmuch_stub['tag:unread'] = 1
+        data = NotmuchData()
+        assert data.get_unread() == 1
+
+        notmuch_stub['locked'] = True
+        notmuch_stub['tag:unread'] = 2
+        tmpdir.join(".notmuch", "xapian", "iamglass").write("changed")
+        assert "database locked" in data.get_unread()
+        assert data.stale == [True]
+
+        # The index didn't change again, but the counts are still outdated
+        notmuch_stub['locked'] = False
+        data.index_checked += 10
+        assert data.get_unread() == 2
+        assert data.stale == [False]
+
+    def test_invalid_database(self, notmuch_stub):
+        """Test error message on missing database."""
+        data = NotmuchData("invalid")
+        assert "failed to open database" in data.get_unread()
+
+
+class TestPy3status:
+    """Test Py3status class."""
+
+    def test_notmuch_queries(self, notmuch_stub):
+        """Test validation of notmuch queries."""
+        module = Py3status()
+        module.engine = 'notmuch'
+        module.notmuch_queries = 'work=folder:work lists'
+        module.data = NotmuchData()
+        module._validate_config()
+        assert module.data.error == (
+            "configuration error: invalid notmuch_queries", -1)
+
+    def test_cache_files(self, tmpdir, i3config, monkeypatch):
+        """Test that instances with other mailboxes keep their own cache."""
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join("cache")))
+        for account in ("work", "home"):
+            inbox = tmpdir.mkdir(account)
+            for subdir in ("cur", "new", "tmp"):
+                inbox.mkdir(subdir)
+        tmpdir.join("home", "new", "1.host").write("")
+
+        for restart in (False, True):
+            for account in ("work", "home"):
+                module = Py3status()
+                module.cache = True
+                module.mailboxes = str(tmpdir.join(account))
+                response = module.mailstatus([], i3config)
+                assert response['full_text'] == "MAIL: {}".format(
+                    int(account == "home"))
+                # Only cached counts are validated in the background
+                assert (module.data.validator is not None) is restart
+                module.kill([], i3config, None)
+        assert len(tmpdir.join("cache", "py3status-modules").listdir()) == 2
+
+    def test_format(self, maildir_new_mail, i3config):
+        """Test per-mailbox placeholders."""
+        module = Py3status()
+        module.name = 'MAIL:'
+        module.mailboxes = (maildir_new_mail.dirname + "/" +
+                            maildir_new_mail.basename)
+        module.format = ('{unread} ({mailbox[maildir]}/{mailbox[x]}) '
+                         '{breakdown}')
+        response = module.mailstatus([], i3config)
+        assert response['full_text'] == 'MAIL: 1 (1/0) maildir:1'
+        assert response['color'] == i3config['color_degraded']
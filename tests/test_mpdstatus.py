@@ -1,5 +1,8 @@
 """Tests for the mpdstatus module."""
 
+from threading import Event
+from time import monotonic, sleep, time
+
 import pytest
 import mock
 
@@ -11,7 +14,11 @@ try:
 except ImportError:
     pass
 else:
-    from mpdstatus.mpdstatus import Data, MPDstatusException
+    from mpdstatus import mpdstatus
+    from mpdstatus.mpdstatus import (Clock, compile_format, Connection, Data,
+                                     format_time, get_clusters, Marquee,
+                                     MPDClient, MPDstatusException, Py3status)
+    from tests.benchmark_mpdstatus import measure
     MPD = True
 
 
@@ -27,21 +34,22 @@ class TestData:
     @mock.patch('mpd.MPDClient.connect', side_effect=command_error)
     def test_incorrect_password(self, mock_connection):
         """Test Data initialisation with incorrect password."""
-        data = None
-        with pytest.raises(MPDstatusException) as e:
-            data = Data('', 6600, "", None)
-        assert "incorrect password" in str(e)
-        assert data is None
+        data = connect(Data('', 6600, "", None))
+        assert data.refresh() is False
+        assert data.error[0] == "incorrect password"
 
     @mock.patch('mpd.MPDClient.status')
     @mock.patch('mpd.MPDClient.connect')
     def test_connection(self, mock_connection, mock_status):
         """Test MPD connection check."""
         data = None
-        data = Data('', 6600, "", None)
+        data = connect(Data('', 6600, "", None))
         assert data.has_connection() is True
 
+        # Recent responses are trusted without asking MPD again
         mock_status.side_effect = Exception
+        assert data.has_connection() is True
+        data.connection.last_success = None
         assert data.has_connection() is False
 
     @mock.patch('mpd.MPDClient.connect')
@@ -51,7 +59,7 @@ class TestData:
     def test_controls(self, mock_prev, mock_next, mock_pause, mock_connection):
         """Check control commands."""
         data = None
-        data = Data('', 6600, "", None)
+        data = connect(Data('', 6600, "", None))
 
         data.previous()
         data.next()
@@ -62,21 +70,22 @@ class TestData:
     def test_controls_fail(self, mock_connection):
         """Check control commands without MPD connection."""
         data = None
-        data = Data('', 6600, "", None)
+        data = connect(Data('', 6600, "", None))
 
-        with pytest.raises(mpd.ConnectionError):
-            data.previous()
-        with pytest.raises(mpd.ConnectionError):
-            data.next()
-        with pytest.raises(mpd.ConnectionError):
-            data.pause()
+        # Left to the connector instead of connecting on the bar's thread
+        data.previous()
+        connect(data)
+        assert data.connection.command is None
+        assert data.connection.connected is False
+        data.next()
+        data.pause()
         assert data is not None
 
     @mock.patch('mpd.MPDClient.connect')
     def test_reconnect_fail(self, mock_connection):
         """Check reconnecting without MPD connection."""
         data = None
-        data = Data('', 6600, "", None)
+        data = connect(Data('', 6600, "", None))
         assert data is not None
 
         data.reconnect()
@@ -88,10 +97,499 @@ class TestData:
                        mpd_state_play):
         """Test playback information retrieval."""
         data = None
-        data = Data('', 6600, "", None)
+        data = connect(Data('', 6600, "", None))
         data.client = mock.Mock(currentsong=current_song,
                                 status=mpd_state_play)
         artist, title, state = data.get_stats()
         assert artist == "Best Artist"
         assert title == "Best Song"
         assert state == "play"
+
+
+def wait_for(condition):
+    """Wait until condition is true."""
+    deadline = time() + 5
+    while not condition() and time() < deadline:
+        sleep(0.01)
+    assert condition()
+
+
+def connect(data):
+    """Wait for the background connection attempt of data to finish."""
+    wait_for(lambda: not data.connection.connector.is_alive())
+    return data
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestClock:
+    """Test Clock class."""
+
+    def test_position(self, monkeypatch):
+        """Test extrapolating the playback position."""
+        now = [100.0]
+        monkeypatch.setattr(mpdstatus, 'monotonic', lambda: now[0])
+        clock = Clock()
+        clock.sync({'state': 'play', 'elapsed': '10.500',
+                    'duration': '200.000'})
+        now[0] += 2
+        assert clock.position() == 12.5
+        now[0] += 500
+        assert clock.position() == 200
+        assert clock.progress() == 1
+
+        clock.sync({'state': 'pause', 'time': '30:60'})
+        now[0] += 2
+        assert clock.position() == 30
+        assert clock.progress() == 0.5
+
+    def test_format_time(self):
+        """Test formatting times."""
+        assert format_time(0) == "0:00"
+        assert format_time(75.9) == "1:15"
+        assert format_time(3725) == "1:02:05"
+
+
+def display_width(text):
+    """Return display width of text."""
+    return sum(width for _, width in get_clusters(text))
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestMarquee:
+    """Test Marquee class."""
+
+    def test_clusters(self):
+        """Test measuring wide characters and combining marks."""
+        assert get_clusters("Cafe\u0301") == [
+            ("C", 1), ("a", 1), ("f", 1), ("e\u0301", 1)]
+        assert get_clusters("\u6771\u4eacA") == [
+            ("\u6771", 2), ("\u4eac", 2), ("A", 1)]
+
+    def test_frames(self):
+        """Test scrolling through precomputed frames."""
+        marquee = Marquee(4, separator=" ")
+        assert marquee.frame("abc") == "abc"
+        assert not marquee.is_scrolling()
+
+        frames = [marquee.frame("abcde", now) for now in range(7)]
+        assert frames == ["abcd", "bcde", "cde ", "de a", "e ab", " abc",
+                          "abcd"]
+        # Frames are not rebuilt for the same text
+        cached = marquee.frames
+        marquee.frame("abcde", 7)
+        assert marquee.frames is cached
+
+        # Only time advances the frame, not extra calls
+        assert marquee.frame("abcde", 7.5) == "bcde"
+        assert marquee.frame("abcde", 7.9) == "bcde"
+        assert marquee.remaining(7.75) == 0.25
+
+    def test_width(self):
+        """Test frames of text with wide characters and combining marks."""
+        marquee = Marquee(5)
+        text = "\u6771\u4eac Cafe\u0301 \u30c6\u30ec\u30d3"
+        assert marquee.frame(text, 0) == "\u6771\u4eac "
+        assert marquee.frame(text, 1) == "\u4eac Ca"
+        assert all(display_width(frame) == 5 for frame in marquee.frames)
+        # Combining marks are never separated from their base character
+        assert not any(frame.startswith("\u0301")
+                       for frame in marquee.frames)
+        # Padded where a wide character doesn't fit
+        assert "fe\u0301 \u30c6" in marquee.frames
+        assert "e\u0301 \u30c6 " in marquee.frames
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestFormat:
+    """Test compiled format strings."""
+
+    def test_placeholders(self):
+        """Test placeholders and fallbacks."""
+        render = compile_format('{artist} - {albumartist|Artist|"?"}')
+        assert render.fields == {'artist', 'albumartist'}
+        assert render({'artist': 'A'}.get) == "A - A"
+        assert render({'albumartist': 'B', 'artist': 'A'}.get) == "A - B"
+        assert render({}.get) == " - ?"
+        assert compile_format('{{{title}}}')({'title': 'T'}.get) == "{T}"
+
+    def test_sections(self):
+        """Test sections with missing placeholders."""
+        render = compile_format(r'{title}[ ({album}[, {date}])] \[x\]')
+        assert render({'title': 'T'}.get) == "T [x]"
+        assert render({'title': 'T', 'album': 'A'}.get) == "T (A) [x]"
+        assert render({'title': 'T', 'album': 'A', 'date': '1999'}.get) == \
+            "T (A, 1999) [x]"
+        assert render({'album': 'A', 'date': ''}.get) == " (A) [x]"
+
+    def test_invalid(self):
+        """Test syntax errors."""
+        for template in ('[{title}', '{title}]', '{title', '{a b}', '\\'):
+            with pytest.raises(MPDstatusException):
+                compile_format(template)
+
+    def test_render(self, mpd_server, i3config):
+        """Test rendering tags from a fake MPD server."""
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.format = '{title}[ on {album}][ ({date})] {track|"-"}'
+        try:
+            module.mpdstatus([], i3config)
+            connect(module.data)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Song on Best Album -"
+            assert not module.ticking
+
+            mpd_server.change(song=dict(mpd_server.song, Date='1999',
+                                        Track='3'))
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Song on Best Album (1999) 3"
+        finally:
+            module.kill([], i3config, None)
+
+    def test_missing_tags(self, mpd_server, i3config):
+        """Test fallbacks and sections for a song without artist."""
+        song = dict(mpd_server.song, AlbumArtist='Best Band')
+        del song['Artist']
+        mpd_server.change(song=song)
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.format = '[{artist} - ]{title}'
+        try:
+            module.mpdstatus([], i3config)
+            connect(module.data)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: Best Song"
+
+            module.render = compile_format('{artist|albumartist|"?"}')
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: Best Band"
+
+            del song['AlbumArtist']
+            mpd_server.change(song=song)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: ?"
+        finally:
+            module.kill([], i3config, None)
+
+    def test_default_format(self, mpd_server, i3config):
+        """Test placeholders of missing tags in the default format."""
+        song = dict(mpd_server.song)
+        del song['Artist'], song['Title']
+        mpd_server.change(song=song)
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        try:
+            module.mpdstatus([], i3config)
+            connect(module.data)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Unknown Artist - best_song.flac"
+        finally:
+            module.kill([], i3config, None)
+
+    def test_invalid_config(self, mpd_server, i3config):
+        """Test falling back to the default format."""
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.format = '[{title}'
+        try:
+            module.mpdstatus([], i3config)
+            connect(module.data)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Artist - Best Song"
+            assert "invalid format" in module.data.error[0]
+        finally:
+            module.kill([], i3config, None)
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestConnection:
+    """Test Connection class."""
+
+    def test_backoff(self, mpd_server):
+        """Test delaying attempts after failures."""
+        port = mpd_server.port
+        mpd_server.close()
+        connection = Connection(MPDClient(), '127.0.0.1', port, "")
+        for failures, delay in enumerate((1, 2, 4, 8), 1):
+            assert connection.connect() is False
+            assert connection.failures == failures
+            assert delay / 2 <= connection.delay() <= delay
+
+        # No attempts while backing off
+        connection.reconnect()
+        assert connection.connector is None
+
+    def test_socket(self, mpd_socket_server):
+        """Test connecting to a UNIX socket."""
+        data = connect(Data(mpd_socket_server.host, 6600, "", None))
+        try:
+            assert data.refresh() is True
+            assert data.get_stats() == ("Best Artist", "Best Song", "play")
+            assert data.has_connection() is True
+        finally:
+            data.disconnect()
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestRefresh:
+    """Test polling mode against a fake MPD server."""
+
+    def test_command_list(self, mpd_server, i3config):
+        """Test fetching song and status in a single round trip."""
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        try:
+            response = module.mpdstatus([], i3config)
+            # The first refresh doesn't wait for the connection
+            assert response['full_text'] == "MPD_TEST: disconnected"
+            connect(module.data)
+            commands = len(mpd_server.commands)
+            response = module.mpdstatus([], i3config)
+            assert mpd_server.commands[commands:] == [
+                'command_list_ok_begin', 'currentsong', 'status',
+                'command_list_end']
+            assert response['full_text'] == \
+                "MPD_TEST: Best Artist - Best Song"
+            assert response['color'] == i3config['color_good']
+
+            mpd_server.drop()
+            connections = mpd_server.connections
+            for _ in range(3):
+                start = time()
+                response = module.mpdstatus([], i3config)
+                assert time() - start < 0.5
+                assert response['full_text'] == "MPD_TEST: disconnected"
+            # Waiting for the backoff to expire
+            assert mpd_server.connections == connections
+
+            module.data.connection.next_attempt = 0
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: disconnected"
+            wait_for(lambda: module.data.connection.connected)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Artist - Best Song"
+        finally:
+            module.kill([], i3config, None)
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestIdle:
+    """Test event mode against a fake MPD server."""
+
+    def test_snapshot(self, mpd_server):
+        """Test updating the snapshot on MPD events."""
+        changed = Event()
+        data = connect(Data(mpd_server.host, mpd_server.port, "", None))
+        data.start_idle(changed.set)
+        try:
+            assert changed.wait(5)
+            assert data.has_connection() is True
+            commands = len(mpd_server.commands)
+            assert data.get_stats() == ("Best Artist", "Best Song", "play")
+            # Served from the snapshot
+            assert len(mpd_server.commands) == commands
+
+            changed.clear()
+            mpd_server.change(state='pause')
+            assert changed.wait(5)
+            assert data.get_stats()[2] == "pause"
+        finally:
+            data.stop_idle()
+            data.disconnect()
+        assert data.idler is None
+
+    def test_reconnect(self, mpd_server, monkeypatch):
+        """Test losing and regaining the idle connection."""
+        monkeypatch.setattr(mpdstatus, 'BACKOFF_MIN', 0.05)
+        data = connect(Data(mpd_server.host, mpd_server.port, "", None))
+        data.start_idle()
+        try:
+            wait_for(data.has_connection)
+            mpd_server.drop()
+            wait_for(lambda: mpd_server.connections >= 3)
+            wait_for(data.has_connection)
+
+            # Commands reconnect the dropped main connection
+            data.pause()
+            wait_for(lambda: mpd_server.commands[-1] == 'pause')
+        finally:
+            data.stop_idle()
+            data.disconnect()
+
+    def test_render(self, mpd_server, i3config):
+        """Test rendering from the snapshot."""
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.events = True
+        module.py3 = mock.Mock()
+        try:
+            response = module.mpdstatus([], i3config)
+            wait_for(lambda: module.py3.update.called)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Artist - Best Song"
+            assert response['cached_until'] > time() + 60
+        finally:
+            module.kill([], i3config, None)
+
+    def test_progress(self, mpd_server, i3config):
+        """Test ticking clock without MPD traffic."""
+        mpd_server.change(elapsed='50.000')
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.format = '{title} {elapsed}/{duration} {bar}'
+        module.events = True
+        module.py3 = mock.Mock()
+        try:
+            module.mpdstatus([], i3config)
+            wait_for(lambda: module.py3.update.called)
+            commands = len(mpd_server.commands)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Song 0:50/3:20 [##________]"
+            assert response['cached_until'] <= time() + 1
+
+            # Paused clocks don't tick
+            module.py3.update.reset_mock()
+            mpd_server.change(state='pause', elapsed='100.000')
+            wait_for(lambda: module.py3.update.called)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == \
+                "MPD_TEST: Best Song 1:40/3:20 [#####_____]"
+            assert response['cached_until'] > time() + 60
+            # Only the requests following the pause event
+            assert mpd_server.commands[commands:] == [
+                'currentsong', 'status', 'idle']
+        finally:
+            module.kill([], i3config, None)
+
+    def test_scroll(self, mpd_server, i3config):
+        """Test scrolling long titles."""
+        module = Py3status()
+        module.host, module.port = mpd_server.host, mpd_server.port
+        module.name = 'MPD_TEST:'
+        module.max_length = 8
+        module.scroll = True
+        try:
+            module.mpdstatus([], i3config)
+            connect(module.data)
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: Best Art - Best Son"
+            # Renders in between don't move the text
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: Best Art - Best Son"
+            assert response['cached_until'] <= time() + 1
+
+            for marquee in module.marquees:
+                marquee.started -= 1
+            response = module.mpdstatus([], i3config)
+            assert response['full_text'] == "MPD_TEST: est Arti - est Song"
+        finally:
+            module.kill([], i3config, None)
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestFakeServer:
+    """Test failures injected by the fake MPD server."""
+
+    def test_latency(self, mpd_slow_server):
+        """Test slow responses and timeouts."""
+        data = connect(Data(mpd_slow_server.host, mpd_slow_server.port, "",
+                            None))
+        try:
+            start = monotonic()
+            assert data.refresh() is True
+            assert monotonic() - start >= 0.05
+        finally:
+            data.disconnect()
+
+        start = monotonic()
+        data = Data(mpd_slow_server.host, mpd_slow_server.port, "", None,
+                    timeout=0.01)
+        # The connection attempt doesn't block
+        assert monotonic() - start < 0.05
+        connect(data)
+        assert data.connection.connected is False
+        assert data.refresh() is False
+
+    def test_click_connecting(self, mpd_slow_server):
+        """Test that clicks don't wait for the connection."""
+        data = Data(mpd_slow_server.host, mpd_slow_server.port, "", None)
+        try:
+            start = monotonic()
+            data.pause()
+            assert monotonic() - start < 0.05
+            connect(data)
+            assert data.connection.connected is True
+            assert mpd_slow_server.commands.count('pause') == 1
+        finally:
+            data.disconnect()
+
+    def test_disconnect(self, mpd_server):
+        """Test losing the connection in the middle of a request."""
+        data = connect(Data(mpd_server.host, mpd_server.port, "", None))
+        try:
+            assert data.refresh() is True
+            mpd_server.disconnect(after=1)
+            assert data.refresh() is True
+            assert data.refresh() is False
+            assert data.connection.connected is False
+
+            data.connection.next_attempt = 0
+            data.reconnect()
+            wait_for(lambda: data.connection.connected)
+            assert data.refresh() is True
+        finally:
+            data.disconnect()
+
+    def test_wrong_password(self, mpd_password_server):
+        """Test rejected passwords."""
+        server = mpd_password_server
+        data = connect(Data(server.host, server.port, "wrong", None))
+        assert data.refresh() is False
+        assert data.error[0] == "incorrect password"
+
+        data = connect(Data(server.host, server.port, "secret", None))
+        try:
+            assert data.refresh() is True
+            server.password = 'changed'
+            server.drop()
+            assert data.refresh() is False
+            data.connection.next_attempt = 0
+            data.reconnect()
+            connect(data)
+            assert data.connection.connected is False
+            assert data.connection.delay() > 0
+            assert data.refresh() is False
+            assert data.error[0] == "incorrect password"
+        finally:
+            data.disconnect()
+
+
+@pytest.mark.skipif(not MPD, reason="requires python-mpd2")
+class TestBenchmark:
+    """Test round trips measured by the benchmark."""
+
+    def test_polling(self, mpd_slow_server):
+        """Test one round trip per refresh in polling mode."""
+        round_trips, seconds = measure(mpd_slow_server, 'polling', 3)
+        assert round_trips == 1
+        assert seconds >= 0.05
+
+    def test_events(self, mpd_slow_server):
+        """Test refreshing without round trips in event mode."""
+        round_trips, seconds = measure(mpd_slow_server, 'events', 3)
+        assert round_trips == 0
+        assert seconds < 0.05
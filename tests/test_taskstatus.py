@@ -1,8 +1,36 @@
 """Tests for the taskstatus module."""
 
+from io import BytesIO
+import json
+import sqlite3
 from subprocess import CalledProcessError
+import threading
+from time import gmtime, sleep, strftime, time
+
+import pytest
+
 from taskstatus import taskstatus
-from taskstatus.taskstatus import Data
+from taskstatus.taskstatus import (
+    Capabilities, Data, Py3status, TaskstatusException)
+
+PENDING_DATA = """\
+[description:"overdue &open;1&close;" due:"{past}" entry:"1500000000" \
+status:"pending" uuid:"a"]
+[description:"due later" due:"{future}" entry:"1500000000" status:"pending" \
+uuid:"b"]
+[description:"waiting" entry:"1500000000" status:"pending" uuid:"c" \
+wait:"{future}"]
+[description:"done" end:"1500000000" entry:"1500000000" status:"completed" \
+uuid:"d"]
+"""
+
+FILTER_DATA = """\
+[description:"a" due:"{past}" entry:"{old}" priority:"H" project:"work.x" \
+status:"pending" tags:"next" uuid:"a"]
+[depends:"a" description:"b" due:"{later}" entry:"{past}" status:"pending" \
+uuid:"b"]
+[description:"c" due:"{tomorrow}" entry:"{past}" status:"pending" uuid:"c"]
+"""
 
 
 class TestData:
@@ -50,3 +78,313 @@ class TestData:
         data = Data()
         tasks = data.get_tasks()
         assert tasks == (1, 1)
+
+    def test_native_ff4(self, tmpdir, monkeypatch):
+        """Test reading Taskwarrior 2.x data files directly."""
+        def mockreturn(*args, **kwargs):
+            raise AssertionError("task must not be executed")
+        monkeypatch.setattr(taskstatus, 'check_output', mockreturn)
+        now = int(time())
+        tmpdir.join("pending.data").write(PENDING_DATA.format(
+            past=now - 3600, future=now + 3600))
+        data = Data('native', str(tmpdir))
+        assert data.get_tasks() == (2, 1)
+        assert data.tasks[0]['description'] == "overdue [1]"
+
+        # Unchanged data file is not read again
+        monkeypatch.setattr(taskstatus, 'read_ff4', mockreturn)
+        assert data.get_tasks() == (2, 1)
+
+    def test_native_waiting_overdue(self, tmpdir, monkeypatch):
+        """Test that waiting tasks aren't overdue until they are shown."""
+        now = int(time())
+        tmpdir.join("pending.data").write(
+            '[description:"a" due:"{past}" entry:"1500000000" '
+            'status:"pending" uuid:"a" wait:"{wait}"]\n'.format(
+                past=now - 3600, wait=now + 60))
+        data = Data('native', str(tmpdir))
+        assert data.get_tasks() == (0, 0)
+
+        monkeypatch.setattr(taskstatus, 'time', lambda: now + 120)
+        assert data.get_tasks() == (1, 1)
+
+    def test_data_file_lookup(self, tmpdir, monkeypatch):
+        """Test looking up the data file only once."""
+        locations = []
+
+        def find_data_location():
+            locations.append(True)
+            return str(tmpdir)
+        monkeypatch.setattr(taskstatus, 'find_data_location',
+                            find_data_location)
+        tmpdir.join("pending.data").write("")
+        data = Data('native')
+        for _ in range(3):
+            assert data.get_tasks() == (0, 0)
+        assert len(locations) == 1
+
+        # Looked up again after the file went away
+        tmpdir.join("pending.data").remove()
+        with pytest.raises(TaskstatusException):
+            data.get_tasks()
+        tmpdir.join("pending.data").write("")
+        assert data.get_tasks() == (0, 0)
+        assert len(locations) == 2
+
+    def test_native_sqlite(self, tmpdir):
+        """Test reading Taskwarrior 3 databases directly."""
+        now = int(time())
+        db = sqlite3.connect(str(tmpdir.join("taskchampion.sqlite3")))
+        db.execute("CREATE TABLE tasks (uuid STRING PRIMARY KEY, data STRING)")
+        for uuid, task in (
+                ('a', {'status': 'pending', 'due': str(now - 60)}),
+                ('b', {'status': 'pending', 'tag_work': ''}),
+                ('c', {'status': 'deleted', 'due': str(now - 60)})):
+            db.execute("INSERT INTO tasks VALUES (?, ?)",
+                       (uuid, json.dumps(task)))
+        db.commit()
+        db.close()
+        data = Data('native', str(tmpdir))
+        assert data.get_tasks() == (2, 1)
+        assert data.tasks[1]['tags'] == {'work'}
+
+    def test_native_wal(self, tmpdir):
+        """Test noticing writes to the write-ahead log of the database."""
+        filename = str(tmpdir.join("taskchampion.sqlite3"))
+        db = sqlite3.connect(filename)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA wal_autocheckpoint=0")
+        db.execute("CREATE TABLE tasks (uuid STRING PRIMARY KEY, data STRING)")
+        db.commit()
+        try:
+            data = Data('native', str(tmpdir))
+            assert data.get_tasks() == (0, 0)
+            mtime = tmpdir.join("taskchampion.sqlite3").mtime()
+
+            db.execute("INSERT INTO tasks VALUES (?, ?)",
+                       ('a', json.dumps({'status': 'pending'})))
+            db.commit()
+            # Only the log changed
+            assert tmpdir.join("taskchampion.sqlite3").mtime() == mtime
+            assert data.get_tasks() == (1, 0)
+        finally:
+            db.close()
+
+    def test_export(self, tmpdir, monkeypatch):
+        """Test counting tasks from a single 'task export'."""
+        now = time()
+        due = strftime('%Y%m%dT%H%M%SZ', gmtime(now + 2))
+        output = (
+            b'[\n'
+            b'{"uuid":"a","status":"pending","due":"20000101T000000Z"},\n'
+            b'{"uuid":"b","status":"pending","due":"' + due.encode() + b'"}\n'
+            b']\n')
+        calls = []
+
+        class Popen:
+            def __init__(self, args, **kwargs):
+                calls.append(args)
+                self.stdout = BytesIO(output)
+                self.returncode = 0
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+        monkeypatch.setattr(taskstatus, 'Popen', Popen)
+        tmpdir.join("pending.data").write("")
+        data = Data('export', str(tmpdir))
+        assert data.get_tasks() == (2, 1)
+        assert calls[0][-2:] == ["status:pending", "export"]
+
+        # Overdue tasks are recomputed without running 'task' again
+        monkeypatch.setattr(taskstatus, 'time', lambda: now + 3)
+        assert data.get_tasks() == (2, 2)
+        assert len(calls) == 1
+
+        tmpdir.join("pending.data").write("changed")
+        data.get_tasks()
+        assert len(calls) == 2
+
+    def test_export_invalid(self, monkeypatch):
+        """Test malformed 'task export' output."""
+        for output in (b'{"uuid": "a",\n', b'{"description": "\xff"}\n'):
+            monkeypatch.setattr(taskstatus, 'EXPORT_COMMAND',
+                                ["printf", output])
+            data = Data('export', "/nonexistent")
+            with pytest.raises(TaskstatusException) as e:
+                data.get_tasks()
+            assert "invalid 'task export' output" in str(e)
+
+    def test_timeout(self, monkeypatch):
+        """Test that hanging 'task' processes are killed."""
+        monkeypatch.setattr(taskstatus, 'EXPORT_COMMAND', ["sleep", "10"])
+        data = Data('export', "/nonexistent", timeout=0.1)
+        with pytest.raises(TaskstatusException) as e:
+            data.get_tasks()
+        assert "timed out" in str(e)
+
+        data.refresh()
+        assert "timed out" in data.error[0]
+        assert data.snapshot is None
+
+        # Partial output of the killed process
+        monkeypatch.setattr(taskstatus, 'EXPORT_COMMAND', [
+            "sh", "-c", 'printf \'{"uuid": "a", \'; exec sleep 10'])
+        with pytest.raises(TaskstatusException) as e:
+            data.get_tasks()
+        assert "timed out" in str(e)
+
+    def test_filters(self, tmpdir, monkeypatch):
+        """Test counting several filters in one pass."""
+        now = int(time())
+        tmpdir.join("pending.data").write(FILTER_DATA.format(
+            past=now - 60, tomorrow=now + 86400, later=now + 30 * 86400,
+            old=now - 400 * 86400))
+        filters = [
+            ('overdue_work', 'project:work +OVERDUE'),
+            ('blocked', '+BLOCKED'),
+            ('blocking', '+BLOCKING'),
+            ('soon', 'due.before:now due.after:2000-01-01'),
+            ('high', 'urgency.over:10'),
+            ('low', 'urgency.under:0'),
+            ('above', 'urgency.above:10'),
+            ('below', 'urgency.below:0'),
+            ('untagged', '-TAGGED status:pending'),
+        ]
+        data = Data('native', str(tmpdir), filters=filters)
+        assert data.get_tasks() == (3, 1)
+        counters = data.get_counters()
+        assert counters['overdue_work'] == 1
+        assert counters['blocked'] == 1
+        assert counters['blocking'] == 1
+        assert counters['soon'] == 1
+        assert counters['high'] == 1
+        assert counters['low'] == 1
+        assert counters['above'] == 1
+        assert counters['below'] == 1
+        assert counters['untagged'] == 2
+
+        # Cached until the tasks change
+        data.tasks = []
+        assert data.get_counters() is counters
+
+    def test_filters_blocked(self, tmpdir):
+        """Test that only pending dependencies lower the urgency."""
+        now = int(time())
+        tmpdir.join("pending.data").write(
+            '[depends:"z" description:"a" entry:"{now}" status:"pending" '
+            'uuid:"a"]\n'.format(now=now))
+        data = Data('native', str(tmpdir),
+                    filters=[('blocked', '+BLOCKED'),
+                             ('low', 'urgency.below:-1')])
+        data.get_tasks()
+        assert data.get_counters() == {'blocked': 0, 'low': 0}
+
+    def test_filters_invalid(self):
+        """Test invalid filter terms."""
+        for text in ('urgency.over:abc', 'due.later:now', 'project'):
+            with pytest.raises(TaskstatusException) as e:
+                Data('native', filters=[('invalid', text)])
+            assert "invalid filter" in str(e)
+
+    def test_filters_stats(self):
+        """Test that filters are rejected without a task list."""
+        with pytest.raises(TaskstatusException):
+            Data('stats', filters=[('all', 'status:pending')])
+
+
+class TestCapabilities:
+    """Test Capabilities class."""
+
+    def test_probe(self, task_binary, tmpdir, monkeypatch):
+        """Test lazy version probe and its cache."""
+        cache_file = str(tmpdir.join("cache", "taskstatus.json"))
+        capabilities = Capabilities(cache_file)
+        assert capabilities.binary == str(task_binary)
+        capabilities.prober.join()
+        assert capabilities.version == (2, 6, 2)
+        assert capabilities.get_mode() == 'export'
+
+        # Cached version is used without running 'task'
+        def mockreturn(*args, **kwargs):
+            raise AssertionError("task must not be executed")
+        monkeypatch.setattr(taskstatus, 'check_output', mockreturn)
+        capabilities = Capabilities(cache_file)
+        assert capabilities.prober is None
+        assert capabilities.version == (2, 6, 2)
+
+    def test_unknown_version(self, task_binary, tmpdir, monkeypatch):
+        """Test mode selection while the version is unknown."""
+        task_binary.write("#!/bin/sh\necho 1.9.4\n")
+        capabilities = Capabilities()
+        capabilities.prober.join()
+        assert capabilities.version == (1, 9, 4)
+        assert capabilities.get_mode() == 'stats'
+        assert capabilities.get_mode(filters=True) == 'stats'
+        capabilities.version = None
+        assert capabilities.get_mode() == 'stats'
+        assert capabilities.get_mode(filters=True) == 'export'
+
+    def test_missing_binary(self, monkeypatch, tmpdir, i3config):
+        """Test missing taskwarrior."""
+        monkeypatch.setenv("PATH", str(tmpdir))
+        assert Capabilities().binary is None
+        with pytest.raises(TaskstatusException) as e:
+            Py3status().taskstatus([], i3config)
+        assert "failed to execute 'task'" in str(e)
+
+        module = Py3status()
+        module.mode = 'auto'
+        with pytest.raises(TaskstatusException) as e:
+            module.taskstatus([], i3config)
+        assert "failed to execute 'task'" in str(e)
+
+
+class TestPy3status:
+    """Test Py3status class."""
+
+    def test_background(self, monkeypatch, i3config, task_binary):
+        """Test rendering snapshots of a background refresher."""
+        module = Py3status()
+        module.background = True
+        release = threading.Event()
+
+        def get_tasks(self):
+            release.wait()
+            return 3, 1
+        monkeypatch.setattr(Data, 'get_tasks', get_tasks)
+
+        response = module.taskstatus([], i3config)
+        assert response['full_text'] == 'TASK: -'
+        # 'auto' is opt-in
+        assert module.data.mode == 'stats'
+        # The version is only probed in 'auto' mode
+        assert module.capabilities is None
+
+        release.set()
+        while not module.data.snapshot:
+            sleep(0.01)
+        response = module.taskstatus([], i3config)
+        assert response['full_text'] == 'TASK: 1/3'
+        assert response['color'] == i3config['color_bad']
+        assert response['cached_until'] > time()
+
+        module.kill([], i3config, None)
+        module.data.snapshot = (3, 1, time() - 60, {})
+        response = module.taskstatus([], i3config)
+        assert response['full_text'] == 'TASK: 1/3?'
+
+    def test_format(self, tmpdir, i3config):
+        """Test format string with filter counters."""
+        tmpdir.join("pending.data").write(
+            '[description:"a" project:"work" status:"pending" uuid:"a"]\n'
+            '[description:"b" project:"home" status:"pending" uuid:"b"]\n')
+        module = Py3status()
+        module.mode = 'native'
+        module.data_location = str(tmpdir)
+        module.filters = "work=project:work home='project:home +next'"
+        module.format = '{tasks} work:{work} home:{home}'
+        response = module.taskstatus([], i3config)
+        assert response['full_text'] == 'TASK: 2 work:1 home:0'